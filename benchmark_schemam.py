@@ -0,0 +1,992 @@
+"""
+Offline benchmarks for generate_schemam.py.
+
+Drives the pipeline against synthetic Figma documents and the deterministic
+stub model backend, so no API keys or network are needed. Results are written
+as JSON (one file per run, tagged with the git commit) and can be compared
+against an earlier run with --compare.
+
+    python benchmark_schemam.py
+    python benchmark_schemam.py --sizes 10 100 --compare benchmarks/abc1234.json
+"""
+
+import os
+import argparse
+import json
+import logging
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Dict, Any, List, Callable, Optional, Set
+
+import generate_schemam as gs
+
+# --- ⚙️ 1. CONFIGURATION ---
+BENCHMARK_SIZES = [10, 100, 1000, 10000]
+BENCHMARK_MAX_DEPTH = 6
+BENCHMARK_MAX_FAN_OUT = 24
+BENCHMARK_CONCURRENCY = 8
+BENCHMARK_RESULTS_DIR = "benchmarks"
+BENCHMARK_SEED = 1234
+CORRECTION_CORPUS_SIZE = 2000
+CORRECTION_CORPUS_NAMES = 200
+# Adversarial inputs are built at this size and at REDOS_GROWTH times it; a
+# linear rule takes about REDOS_GROWTH times longer on the bigger one.
+REDOS_INPUT_CHARS = 200_000
+REDOS_GROWTH = 4
+REDOS_RULE_BUDGET_SECONDS = 0.5  # Per rule, per input, at the larger size
+
+SECTION_KINDS = [
+    "Hero",
+    "Features",
+    "Team",
+    "Testimonials",
+    "Pricing",
+    "FAQ",
+    "Gallery",
+    "Contact",
+    "Stats",
+    "Logos",
+]
+
+
+# --- 🧪 2. SYNTHETIC FIGMA DOCUMENTS ---
+
+
+def _text(name: str, characters: str) -> dict:
+    return {
+        "id": f"t-{name}",
+        "name": name,
+        "type": "TEXT",
+        "characters": characters,
+        "style": {"fontFamily": "Inter", "fontSize": 16},
+        "absoluteBoundingBox": {"x": 0, "y": 0, "width": 320, "height": 24},
+    }
+
+
+def _image(name: str) -> dict:
+    return {
+        "id": f"i-{name}",
+        "name": name,
+        "type": "RECTANGLE",
+        "fills": [{"type": "IMAGE", "scaleMode": "FILL", "imageRef": "abc123"}],
+        "absoluteBoundingBox": {"x": 0, "y": 0, "width": 320, "height": 200},
+    }
+
+
+def _card(index: int) -> dict:
+    return {
+        "id": f"card-{index}",
+        "name": "Card",
+        "type": "INSTANCE",
+        "children": [
+            _image("Photo"),
+            _text("Title", f"Card title {index}"),
+            _text("Body", f"Supporting copy for card number {index}."),
+            {
+                "name": "Button",
+                "type": "FRAME",
+                "children": [_text("Label", "Learn more")],
+            },
+        ],
+    }
+
+
+def _nested(depth: int, index: int) -> dict:
+    node = {
+        "name": f"Wrapper {depth}",
+        "type": "FRAME",
+        "layoutMode": "VERTICAL",
+        "children": [_text("Eyebrow", f"Level {depth} of section {index}")],
+    }
+    if depth > 1:
+        node["children"].append(_nested(depth - 1, index))
+    return node
+
+
+def make_section(index: int, depth: int, fan_out: int) -> dict:
+    kind = SECTION_KINDS[index % len(SECTION_KINDS)]
+    children = [
+        _text("Heading", f"{kind} heading {index}"),
+        _text("Subheading", f"A short description of the {kind.lower()} section."),
+        _nested(depth, index),
+    ]
+    if fan_out:
+        children.append(
+            {
+                "name": "Grid",
+                "type": "FRAME",
+                "layoutMode": "HORIZONTAL",
+                "children": [_card(i) for i in range(fan_out)],
+            }
+        )
+    return {
+        "id": f"section-{index}",
+        "name": f"{kind} Section {index}",
+        "type": "FRAME",
+        "children": children,
+    }
+
+
+def make_main_frame(
+    section_count: int,
+    max_depth: int = BENCHMARK_MAX_DEPTH,
+    max_fan_out: int = BENCHMARK_MAX_FAN_OUT,
+    seed: int = BENCHMARK_SEED,
+) -> dict:
+    """
+    Builds a main frame with `section_count` uniquely named sections whose
+    nesting depth and grid fan-out vary pseudo-randomly (but reproducibly).
+    """
+    rng = random.Random(seed)
+    sections = [
+        make_section(i, rng.randint(1, max_depth), rng.randint(0, max_fan_out))
+        for i in range(section_count - 2)
+    ]
+    header = {"name": "Header", "type": "FRAME", "children": [_text("Logo", "Acme")]}
+    footer = {"name": "Footer", "type": "FRAME", "children": [_text("Legal", "(c)")]}
+    return {
+        "name": gs.FIGMA_MAIN_FRAME_NAME,
+        "type": "FRAME",
+        "children": [header] + sections + [footer],
+    }
+
+
+def make_schema_corpus(
+    count: int = CORRECTION_CORPUS_SIZE,
+    name_count: int = CORRECTION_CORPUS_NAMES,
+    seed: int = BENCHMARK_SEED,
+) -> tuple:
+    """
+    Builds `count` generated-looking schemas (stub template output) and
+    injects the mistakes the correction rules exist for, at random.
+    Returns (schemas, valid_names).
+    """
+    rng = random.Random(seed)
+    names = [f"{SECTION_KINDS[i % len(SECTION_KINDS)].lower()}Block{i}" for i in range(name_count)]
+    plan = {"documents": ["page", "siteSettings"], "objects": names}
+    stub = gs.StubBackend()
+    faults = [
+        "    defineField({name: 'mainTitle', title: 'Title', type: 'string', validation: (Rule: Rule) => Rule.required()}),",
+        "    defineField({name: 'image', title: 'Image', type: 'internationalizedArrayImage', fields: [{name: 'alt', type: 'string'}]}),",
+        "    defineField({name: 'body', title: 'Body', type: 'internationalizedArrayBlock'}),",
+        "    defineField({name: 'summary', title: 'Summary', type: 'internationalizedArrayText', of: [{type: 'block'}]}),",
+        "    defineField({name: 'items', title: 'Items', type: 'array', of: [defineType({name: 'item', type: 'object', fields: [defineField({name: 'label', type: 'string'})]})]}),",
+        "    defineField({name: 'links', title: 'Links', type: 'array', of: [{type: 'url', name: 'external', title: 'External'}, {type: 'reference', to: [{type: 'page'}]}]}),",
+        "    defineField({name: 'related', title: 'Related', type: 'array', of: [{'RELATED'}]}),",
+        "    defineField({name: 'featuredImage', title: 'Image', type: 'image'}),",
+    ]
+    schemas = []
+    for i in range(count):
+        name = names[i % name_count]
+        schema_type = "object" if rng.random() < 0.8 else "document"
+        code = stub._template_code(name, schema_type, plan)
+        lines = code.split("\n")
+        insert_at = lines.index("  ],")
+        for fault in rng.sample(faults, rng.randint(0, 4)):
+            other = rng.choice(names)
+            lines.insert(insert_at, fault.replace("RELATED", other.upper() if rng.random() < 0.5 else other))
+        if rng.random() < 0.3:
+            lines.insert(insert_at, f"    defineField({{name: 'ref', type: 'reference', to: [{{type: '{rng.choice(names).lower()}'}}]}}),")
+        if rng.random() < 0.2:
+            # The model sometimes picks the wrong schema type
+            lines = [line.replace(f"type: '{schema_type}'", "type: 'document'" if schema_type == "object" else "type: 'object'", 1) for line in lines]
+        schemas.append({"name": name, "type": schema_type, "code": "\n".join(lines)})
+    return schemas, set(plan["documents"]) | set(names)
+
+
+def make_ir_corpus(
+    count: int = CORRECTION_CORPUS_SIZE,
+    name_count: int = CORRECTION_CORPUS_NAMES,
+    seed: int = BENCHMARK_SEED,
+) -> tuple:
+    """
+    Builds `count` phase-two IR responses of realistic size and variety (i18n
+    text and media, references, section arrays, inline objects, options),
+    as the model would write them. Returns (schemas, valid_names).
+    """
+    rng = random.Random(seed)
+    names = [f"{SECTION_KINDS[i % len(SECTION_KINDS)].lower()}Block{i}" for i in range(name_count)]
+    documents = ["page", "siteSettings", "teamMember", "post"]
+    pool = [
+        lambda: {"name": "title", "type": "string", "i18n": True, "required": True},
+        lambda: {"name": "description", "type": "text", "i18n": True},
+        lambda: {"name": "image", "type": "image", "i18n": True},
+        lambda: {"name": "link", "type": "url", "i18n": True},
+        lambda: {"name": "author", "type": "reference", "to": [rng.choice(documents)]},
+        lambda: {"name": "items", "type": "array", "of": rng.sample(names, rng.randint(1, 3))},
+        lambda: {"name": "members", "type": "array", "of": [{"type": "reference", "to": ["teamMember"]}]},
+        lambda: {
+            "name": "button",
+            "type": "object",
+            "fields": [
+                {"name": "label", "type": "string", "i18n": True, "required": True},
+                {"name": "href", "type": "url"},
+            ],
+        },
+        lambda: {"name": "layout", "type": "string", "options": {"list": ["left", "right"], "layout": "radio"}},
+        lambda: {"name": "count", "type": "number"},
+    ]
+    schemas = []
+    for i in range(count):
+        name = names[i % name_count]
+        fields = [make() for make in rng.sample(pool, rng.randint(3, 6))]
+        ir = {"type": "object", "fields": fields}
+        if rng.random() < 0.5:
+            ir["preview"] = {"title": fields[0]["name"]}
+        schemas.append({"name": name, "type": "object", "response": json.dumps(ir, separators=(",", ":"))})
+    return schemas, set(documents) | set(names)
+
+
+def make_schema_set(count: int, seed: int = BENCHMARK_SEED) -> tuple:
+    """
+    Builds a corrected-looking schema set of `count` section objects (each
+    embedding a few later sections and referencing a document) plus the
+    documents, with dangling references, duplicate names, embedding cycles
+    and pageBuilder gaps injected. Returns (schemas, plan, expected issue
+    count per graph check).
+    """
+    rng = random.Random(seed)
+    names = [f"{SECTION_KINDS[i % len(SECTION_KINDS)].lower()}Block{i}" for i in range(count)]
+    documents = ["page", "siteSettings", "teamMember", "post"]
+    plan = {"documents": documents, "objects": names}
+    valid_names = set(names) | set(documents)
+    stub = gs.StubBackend()
+    faults = max(1, count // 100)
+    # Sections left out of pageBuilder and embedded nowhere else
+    gaps = {names[i] for i in rng.sample(range(2 * faults, count), faults)}
+    schemas = []
+    for name in documents:
+        code = stub._template_code(name, "document", plan)
+        for gap in gaps if name == "page" else []:
+            code = code.replace(f"        {{type: '{gap}'}},\n", "")
+        code = gs.correct_generated_code(code, valid_names, "document")
+        schemas.append({"name": name, "type": "document", "code": code})
+    for i, name in enumerate(names):
+        later = [other for other in names[i + 1 :] if other not in gaps]
+        fields = [
+            f"    defineField({{name: 'part{j}', title: 'Part', type: '{other}'}}),"
+            for j, other in enumerate(rng.sample(later, min(len(later), rng.randint(0, 3))))
+        ]
+        fields.append(
+            f"    defineField({{name: 'items', title: 'Items', type: 'array', of: "
+            f"[{{type: 'reference', to: [{{type: '{rng.choice(documents)}'}}]}}]}}),"
+        )
+        if i < faults:
+            fields.append(f"    defineField({{name: 'broken', title: 'Broken', type: '{name}Missing'}}),")
+            # Cycle i → i + faults → i
+            fields.append(f"    defineField({{name: 'loop', title: 'Loop', type: '{names[i + faults]}'}}),")
+        elif i < 2 * faults:
+            fields.append(f"    defineField({{name: 'loop', title: 'Loop', type: '{names[i - faults]}'}}),")
+        lines = stub._template_code(name, "object", plan).split("\n")
+        insert_at = lines.index("  ],")
+        lines[insert_at:insert_at] = fields
+        code = gs.correct_generated_code("\n".join(lines), valid_names, "object")
+        schemas.append({"name": name, "type": "object", "code": code})
+    for name in names[-faults:]:
+        # A second file declaring an existing name
+        schemas.append({"name": f"{name}Copy", "type": "object", "code": schemas[-faults]["code"]})
+    expected = {
+        "dangling": faults,
+        "duplicates": 2 * faults,  # "declared twice" plus "not the planned name"
+        "unused": 0,
+        "cycles": faults,
+        "page_builder": 1,  # One issue listing every gap
+    }
+    return schemas, plan, expected
+
+
+def make_adversarial_inputs(chars: int = REDOS_INPUT_CHARS) -> Dict[str, str]:
+    """
+    Malformed or oversized "model output" shaped to hit the backtracking and
+    rescanning hazards of the correction and validation rules, each about
+    `chars` long.
+    """
+    def repeat(unit: str) -> str:
+        return unit * max(1, chars // len(unit))
+
+    template = gs.StubBackend()._template_code(
+        "heroBlock", "object", {"documents": ["page"], "objects": ["heroBlock"]}
+    )
+    return {
+        "huge_file": repeat(template + "\n"),
+        "unbalanced_braces": repeat("of: [{type: 'url', name: 'a', title: 'b', "),
+        "unclosed_objects": repeat("{name: 'x', "),
+        "type_runs": "defineType({" + repeat("type: 'internationalizedArrayImage', "),
+        "i18n_runs": repeat("{type: 'internationalizedArrayText', of: ["),
+        "whitespace_fence": "```ts\nx" + repeat(" ") + "y```",
+        "long_import_line": "import " + repeat("defineType from "),
+        "mixed_array_segment": "of: [{type: 'url'}, " + repeat("{type: 'url', {"),
+        "unquoted_items": repeat("of: [{'")[: chars // 2] + "a" * (chars // 2),
+        "unterminated_string": "of: [{type: '" + repeat("a, [{"),
+    }
+
+
+# --- 🕰️ 3. LEGACY BASELINES ---
+
+
+def legacy_correct_generated_code(
+    code: str, all_valid_names: Set[str], expected_type: str = None
+) -> str:
+    """
+    Frozen copy of correct_generated_code() as it was before CorrectionEngine:
+    the chained re.sub passes, kept verbatim (bugs included) as the
+    throughput baseline for the correction suite.
+    """
+    original_code = code
+    corrections_applied = []
+
+    # Correction 0: Remove markdown formatting from generated code
+    # Pattern: ```typescript or ```javascript or ``` at start/end of code
+    if code.startswith("```") or code.endswith("```"):
+        # Remove markdown code blocks
+        code = re.sub(
+            r"^```(?:typescript|javascript|ts|js)?\s*", "", code, flags=re.MULTILINE
+        )
+        code = re.sub(r"\s*```\s*$", "", code, flags=re.MULTILINE)
+        corrections_applied.append("removed markdown formatting")
+
+    # Also remove any stray markdown that might be in the middle
+    if re.search(r";```\w*", code):
+        code = re.sub(r";```\w*\s*", "", code)
+        corrections_applied.append("removed stray markdown syntax")
+
+    # Correction 0.5: Fix incorrect schema type (CRITICAL FIX for the main issue)
+    if expected_type:
+        # Find current type declaration
+        type_pattern = r"type:\s*['\"]([^'\"]+)['\"]"
+        type_match = re.search(type_pattern, code)
+        if type_match:
+            current_type = type_match.group(1)
+            if current_type != expected_type:
+                # Replace the type with the expected type
+                code = re.sub(type_pattern, f"type: '{expected_type}'", code)
+                corrections_applied.append(
+                    f"schema type: '{current_type}' → '{expected_type}'"
+                )
+
+    # Correction 1: Fix incorrect validation function typing, e.g., (Rule: Rule) -> (Rule)
+    validation_pattern = r"\(Rule:\s*[A-Za-z_][A-Za-z0-9_]*\)"
+    code = re.sub(validation_pattern, r"(Rule)", code)
+    if original_code != code:
+        corrections_applied.append("validation function syntax (Rule: Rule) → (Rule)")
+
+    # Correction 2: Fix defineType inside array 'of' properties
+    # Pattern: of: [ defineType({ ... }) ] -> of: [ { ... } ]
+    defineType_in_array_pattern = r"of:\s*\[\s*defineType\s*\(\s*\{"
+    if re.search(defineType_in_array_pattern, code):
+        code = re.sub(r"of:\s*\[\s*defineType\s*\(\s*\{", "of: [{", code)
+        # Also fix the closing: }),] -> },]
+        code = re.sub(r"\}\s*\)\s*,?\s*\]", "}]", code)
+        corrections_applied.append("defineType inside arrays → plain objects")
+
+    # Correction 3: Fix missing 'type:' property in array items
+    # Pattern: of: [{'typeName'}] -> of: [{type: 'typeName'}]
+    missing_type_pattern = r"of:\s*\[\s*\{\s*['\"]([^'\"]+)['\"]\s*\}\s*\]"
+    if re.search(missing_type_pattern, code):
+        code = re.sub(missing_type_pattern, r"of: [{type: '\1'}]", code)
+        corrections_applied.append("added missing 'type:' property in array items")
+
+    # Correction 4: Remove 'fields' property from internationalizedArray image types
+    # Pattern: type: 'internationalizedArrayImage', ... fields: [...] -> type: 'internationalizedArrayImage', ...
+    i18n_image_fields_pattern = r"(type:\s*['\"]internationalizedArray(Image|File)['\"][^}]*?),\s*fields:\s*\[[^\]]*?\]"
+    if re.search(i18n_image_fields_pattern, code, re.DOTALL):
+        code = re.sub(i18n_image_fields_pattern, r"\1", code, flags=re.DOTALL)
+        corrections_applied.append("removed 'fields' from internationalizedArray type")
+
+    # Correction 5: Remove 'of' property from internationalizedArray text/array types
+    # Pattern: type: 'internationalizedArrayText', ... of: [...] -> type: 'internationalizedArrayText', ...
+    i18n_array_of_pattern = r"(type:\s*['\"]internationalizedArray(?:Text|String|Url|Slug)['\"][^}]*?),\s*of:\s*\[[^\]]*?\]"
+    if re.search(i18n_array_of_pattern, code, re.DOTALL):
+        code = re.sub(i18n_array_of_pattern, r"\1", code, flags=re.DOTALL)
+        corrections_applied.append("removed 'of' from internationalizedArray type")
+
+    # Correction 6: Fix type name casing (existing logic)
+    name_map = {name.lower(): name for name in all_valid_names}
+    type_corrections = []
+
+    def replace_type_reference(match):
+        quote_char = match.group(1)
+        type_name = match.group(2)
+        # Skip correcting built-in types or i18n types
+        built_in_types = {
+            "string",
+            "text",
+            "image",
+            "file",
+            "url",
+            "slug",
+            "number",
+            "boolean",
+            "array",
+            "object",
+            "reference",
+            "block",
+            "date",
+            "datetime",
+        }
+        if type_name in built_in_types or "internationalizedArray" in type_name:
+            return match.group(0)
+
+        type_name_lower = type_name.lower()
+        if type_name_lower in name_map:
+            correct_name = name_map[type_name_lower]
+            if type_name != correct_name:
+                type_corrections.append(f"'{type_name}' → '{correct_name}'")
+                return f"{quote_char}{correct_name}{quote_char}"
+        return match.group(0)
+
+    type_pattern = r"type:\s*(['\"])([^'\"]+)\1"
+    code = re.sub(type_pattern, replace_type_reference, code)
+
+    if type_corrections:
+        corrections_applied.append(
+            f"type name casing: {', '.join(sorted(list(set(type_corrections))))}"
+        )
+
+    # Correction 5: Ensure imports are present (existing logic)
+    if "defineType" not in code and "defineField" not in code:
+        if "name:" in code and "title:" in code and "type:" in code:
+            code = f"import {{defineType, defineField}} from 'sanity'\n\n{code}"
+            corrections_applied.append("added missing defineType/defineField import")
+
+    # Correction 6: Fix invalid internationalizedArray type names
+    # Available types: String, Text, Image, File, Url, Slug
+    invalid_i18n_types = {
+        "internationalizedArrayOfPortableText": "internationalizedArrayText",
+        "internationalizedArrayPortableText": "internationalizedArrayText",
+        "internationalizedArrayRichText": "internationalizedArrayText",
+        "internationalizedArrayBlock": "internationalizedArrayText",
+        "internationalizedArrayContent": "internationalizedArrayText",
+        "internationalizedArrayArray": "internationalizedArrayText",
+        "internationalizedArrayReference": "reference",
+        "internationalizedArrayCrossDatasetReference": "crossDatasetReference",
+        "internationalizedArrayDocument": "reference",
+    }
+    for incorrect_name, correct_name in invalid_i18n_types.items():
+        if incorrect_name in code:
+            code = code.replace(incorrect_name, correct_name)
+            corrections_applied.append(
+                f"corrected invalid i18n type: {incorrect_name} → {correct_name}"
+            )
+
+    # Correction 7: Simplify verbose field names (anti-over-engineering)
+    verbose_replacements = {
+        r"name:\s*['\"]primaryTitle['\"]": "name: 'title'",
+        r"name:\s*['\"]mainTitle['\"]": "name: 'title'",
+        r"name:\s*['\"]headerTitle['\"]": "name: 'title'",
+        r"name:\s*['\"]sectionTitle['\"]": "name: 'title'",
+        r"name:\s*['\"]primaryDescription['\"]": "name: 'description'",
+        r"name:\s*['\"]mainDescription['\"]": "name: 'description'",
+        r"name:\s*['\"]sectionDescription['\"]": "name: 'description'",
+        r"name:\s*['\"]primaryText['\"]": "name: 'text'",
+        r"name:\s*['\"]mainText['\"]": "name: 'text'",
+        r"name:\s*['\"]heroImage['\"]": "name: 'image'",
+        r"name:\s*['\"]mainImage['\"]": "name: 'image'",
+        r"name:\s*['\"]primaryImage['\"]": "name: 'image'",
+        r"name:\s*['\"]featuredImage['\"]": "name: 'image'",
+    }
+
+    simplified_names = []
+    for pattern, replacement in verbose_replacements.items():
+        if re.search(pattern, code, re.IGNORECASE):
+            code = re.sub(pattern, replacement, code, flags=re.IGNORECASE)
+            simplified_names.append(pattern.split("'")[1])  # Extract the original name
+
+    if simplified_names:
+        corrections_applied.append(
+            f"simplified verbose field names: {', '.join(simplified_names[:3])}{'...' if len(simplified_names) > 3 else ''}"
+        )
+
+    # Correction 8: Fix mixed primitive/object types in arrays (CRITICAL SANITY FIX)
+    mixed_array_pattern = r'of:\s*\[\s*\{[^}]*type:\s*[\'"]url[\'"][^}]*\}[^}]*\{[^}]*type:\s*[\'"]reference[\'"]'
+    if re.search(mixed_array_pattern, code, re.DOTALL):
+        # Fix url type by wrapping it in object structure
+        url_object_fix = r'(\s*\{\s*type:\s*[\'"])url([\'"][^}]*name:\s*[\'"]([^\'\"]+)[\'"][^}]*title:\s*[\'"]([^\'\"]+)[\'"][^}]*)\},'
+        code = re.sub(
+            url_object_fix,
+            r'\1object\2fields: [defineField({name: "url", title: "URL", type: "url", validation: (Rule) => Rule.required()})],},',
+            code,
+            flags=re.DOTALL,
+        )
+        corrections_applied.append("fixed mixed primitive/object types in arrays")
+
+    # Log all corrections applied
+    if corrections_applied:
+        logging.info(
+            f"    🔧 Auto-corrections applied: {' | '.join(corrections_applied)}"
+        )
+
+    return code
+
+
+
+# --- 📏 4. MEASUREMENT ---
+
+
+class MeteredStubBackend(gs.StubBackend):
+    """Stub backend that also counts prompt bytes per phase."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.prompt_bytes: Dict[str, int] = {"plan": 0, "schema": 0}
+
+    def generate(self, prompt: str, task: Optional[dict] = None) -> str:
+        phase = (task or {}).get("phase", "schema")
+        with self.lock:
+            self.prompt_bytes[phase] = self.prompt_bytes.get(phase, 0) + len(
+                prompt.encode("utf-8")
+            )
+        return super().generate(prompt, task)
+
+
+def measure(stages: Dict[str, float], name: str, func: Callable, *args) -> Any:
+    """
+    Runs one stage and records its wall time, or its tracemalloc peak when
+    tracing is on (tracing slows allocation-heavy code, so the two are taken
+    in separate passes).
+    """
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        result = func(*args)
+        stages[name] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+        return result
+    started = time.perf_counter()
+    result = func(*args)
+    stages[name] = round(time.perf_counter() - started, 4)
+    return result
+
+
+def _pipeline_pass(
+    main_frame: dict, args: argparse.Namespace, track_memory: bool
+) -> tuple:
+    gs.get_figma_main_frame = lambda: main_frame
+    backend = MeteredStubBackend(latency=args.stub_latency)
+    stages: Dict[str, float] = {}
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        if track_memory:
+            tracemalloc.start()
+        try:
+            sections = measure(stages, "extract", gs.get_figma_page_sections)
+            section_index = measure(stages, "index", gs.build_section_index, sections)
+            del sections
+            plan = measure(
+                stages, "plan", gs.phase_one_architect_plan, section_index, backend
+            )
+            planned = [
+                {"name": name, "type": "document"} for name in plan["documents"]
+            ] + [{"name": name, "type": "object"} for name in plan["objects"]]
+            schemas = measure(
+                stages,
+                "phase_two",
+                gs.generate_all_schema_code,
+                planned,
+                plan,
+                section_index,
+                backend,
+                args.concurrency,
+                float("inf"),
+            )
+            valid_names = set(plan["documents"]) | set(plan["objects"])
+
+            engine = gs.CorrectionEngine(valid_names)
+
+            def correct_all():
+                for schema in schemas:
+                    schema["code"] = gs.correct_generated_code(
+                        schema["code"], valid_names, schema["type"], engine
+                    )
+
+            def validate_all():
+                for schema in schemas:
+                    schema["issues"] = gs.validate_generated_code(
+                        schema["code"], schema["name"]
+                    )
+
+            measure(stages, "correct", correct_all)
+            measure(stages, "validate", validate_all)
+            measure(stages, "write", gs.generate_all_files, schemas, plan)
+        finally:
+            tracemalloc.stop()
+            os.chdir(workdir)
+    return stages, len(schemas), dict(backend.prompt_bytes)
+
+
+def run_pipeline(section_count: int, args: argparse.Namespace) -> dict:
+    """
+    get_figma_page_sections -> plan -> phase two -> correct -> validate ->
+    generate_all_files, each stage measured separately, inside a scratch dir.
+    """
+    main_frame = make_main_frame(section_count, args.max_depth, args.max_fan_out)
+    seconds, schema_count, prompt_bytes = _pipeline_pass(main_frame, args, False)
+    peaks = {}
+    if not args.no_memory:
+        peaks = _pipeline_pass(main_frame, args, True)[0]
+    return {
+        "sections": section_count,
+        "schemas": schema_count,
+        "stages": {
+            name: {"seconds": seconds[name], "peak_mb": peaks.get(name)}
+            for name in seconds
+        },
+        "total_seconds": round(sum(seconds.values()), 4),
+        "peak_mb": max(peaks.values()) if peaks else None,
+        "prompt_bytes": prompt_bytes,
+    }
+
+
+def run_pipeline_suite(args: argparse.Namespace) -> List[dict]:
+    results = []
+    for size in args.sizes:
+        print(f"  pipeline: {size} sections...", flush=True)
+        results.append(run_pipeline(size, args))
+    return results
+
+
+def _time_corrections(correct: Callable, schemas: List[dict]) -> tuple:
+    started = time.perf_counter()
+    outputs = [correct(schema) for schema in schemas]
+    return time.perf_counter() - started, outputs
+
+
+def run_correction_suite(args: argparse.Namespace) -> List[dict]:
+    """
+    Throughput of the legacy regex chain against CorrectionEngine on the same
+    corpus, plus how often their outputs differ and which rules fired.
+    """
+    print(f"  correction: {args.corpus_size} schemas...", flush=True)
+    schemas, valid_names = make_schema_corpus(args.corpus_size)
+    corpus_mb = sum(len(s["code"]) for s in schemas) / 1024 / 1024
+    engine = gs.CorrectionEngine(valid_names)
+    fired: Dict[str, int] = {}
+
+    def engine_correct(schema: dict) -> str:
+        code, corrections = engine.correct(schema["code"], schema["type"])
+        for correction in corrections:
+            rule = correction.split(": ")[0].split(" (")[0]
+            fired[rule] = fired.get(rule, 0) + 1
+        return code
+
+    variants = {
+        "legacy": lambda s: legacy_correct_generated_code(s["code"], valid_names, s["type"]),
+        "engine": engine_correct,
+        "engine_per_call": lambda s: gs.correct_generated_code(s["code"], valid_names, s["type"]),
+    }
+    results = []
+    outputs = {}
+    for name, correct in variants.items():
+        seconds, outputs[name] = _time_corrections(correct, schemas)
+        results.append(
+            {
+                "variant": name,
+                "schemas": len(schemas),
+                "seconds": round(seconds, 4),
+                "schemas_per_second": round(len(schemas) / seconds, 1),
+                "mb_per_second": round(corpus_mb / seconds, 3),
+            }
+        )
+    differing = sum(a != b for a, b in zip(outputs["legacy"], outputs["engine"]))
+    results.append(
+        {"variant": "summary", "outputs_differing_from_legacy": differing, "rules_fired": fired}
+    )
+    return results
+
+
+def run_redos_suite(args: argparse.Namespace) -> List[dict]:
+    """
+    Times the correction engine and every validation rule on each adversarial
+    input at two sizes. Rows carry the growth ratio (≈REDOS_GROWTH when
+    linear) and whether the larger run stayed inside the per-rule budget.
+    """
+    valid_names = {"heroBlock", "page"}
+    engine = gs.CorrectionEngine(valid_names)
+    rules: List[tuple] = [
+        ("bracket_index", lambda code, index: gs._BracketIndex(code)),
+        ("correct", lambda code, index: engine.correct(code, "object")),
+    ] + list(gs.VALIDATION_RULES)
+    small = make_adversarial_inputs(args.redos_size)
+    large = make_adversarial_inputs(args.redos_size * REDOS_GROWTH)
+    results = []
+    for input_name in small:
+        print(f"  redos: {input_name}...", flush=True)
+        timings = {}
+        for size_name, code in (("small", small[input_name]), ("large", large[input_name])):
+            index = gs._BracketIndex(code)
+            for rule_name, rule in rules:
+                started = time.perf_counter()
+                rule(code, index)
+                timings.setdefault(rule_name, {})[size_name] = time.perf_counter() - started
+        for rule_name, seconds in timings.items():
+            results.append(
+                {
+                    "input": input_name,
+                    "rule": rule_name,
+                    "chars": len(large[input_name]),
+                    "seconds": round(seconds["large"], 4),
+                    "growth": round(seconds["large"] / max(seconds["small"], 1e-6), 1),
+                    "within_budget": seconds["large"] <= REDOS_RULE_BUDGET_SECONDS,
+                }
+            )
+    return results
+
+
+def run_ir_suite(args: argparse.Namespace) -> List[dict]:
+    """
+    Output size of the same schemas as IR JSON and as emitted TypeScript,
+    emitter throughput, determinism, and whether the emitted code still needs
+    corrections or fails validation.
+    """
+    print(f"  ir: {args.corpus_size} schemas...", flush=True)
+    schemas, valid_names = make_ir_corpus(args.corpus_size)
+    started = time.perf_counter()
+    emitted = [gs.schema_from_ir_response(s["response"], s, valid_names) for s in schemas]
+    emit_seconds = time.perf_counter() - started
+    engine = gs.CorrectionEngine(valid_names)
+    ir_tokens = sum(gs.estimate_tokens(s["response"]) for s in schemas)
+    ir_pretty_tokens = sum(gs.estimate_tokens(json.dumps(json.loads(s["response"]), indent=2)) for s in schemas)
+    ts_tokens = sum(gs.estimate_tokens(e["code"]) for e in emitted)
+    nondeterministic = sum(
+        gs.emit_schema_ts(json.loads(json.dumps(e["ir"]))) != e["code"] for e in emitted
+    )
+    needing_corrections = sum(
+        bool(engine.correct(e["code"], s["type"])[1]) for s, e in zip(schemas, emitted)
+    )
+    with_errors = sum(
+        any(issue.startswith("❌") for issue in gs.validate_generated_code(e["code"], s["name"]))
+        for s, e in zip(schemas, emitted)
+    )
+    return [
+        {
+            "schemas": len(schemas),
+            "ir_tokens_per_schema": round(ir_tokens / len(schemas), 1),
+            "ir_pretty_tokens_per_schema": round(ir_pretty_tokens / len(schemas), 1),
+            "ts_tokens_per_schema": round(ts_tokens / len(schemas), 1),
+            "token_reduction": round(1 - ir_tokens / ts_tokens, 3),
+            "emit_seconds": round(emit_seconds, 4),
+            "schemas_per_second": round(len(schemas) / emit_seconds, 1),
+            "nondeterministic": nondeterministic,
+            "needing_corrections": needing_corrections,
+            "with_validation_errors": with_errors,
+        }
+    ]
+
+
+def run_graph_suite(args: argparse.Namespace) -> List[dict]:
+    """
+    Builds the cross-schema graph for schema sets of each size and runs every
+    check. Rows carry build/check time, the cost of a type lookup (flat when
+    lookups are constant-time) and the issues found against those expected.
+    """
+    results = []
+    for size in args.sizes:
+        print(f"  graph: {size} schemas...", flush=True)
+        schemas, plan, expected = make_schema_set(max(size, 4))
+        started = time.perf_counter()
+        graph = gs.SchemaGraph(schemas, plan)
+        build_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        issues = graph.check()
+        check_seconds = time.perf_counter() - started
+        probes = [name for name in graph.declared] * max(1, 100_000 // len(graph.declared))
+        started = time.perf_counter()
+        for name in probes:
+            graph.resolves(name)
+            graph.referrers_of(name)
+        lookup_seconds = time.perf_counter() - started
+        results.append(
+            {
+                "schemas": len(schemas),
+                "build_seconds": round(build_seconds, 4),
+                "check_seconds": round(check_seconds, 4),
+                "schemas_per_second": round(len(schemas) / (build_seconds + check_seconds), 1),
+                "lookup_ns": round(lookup_seconds / len(probes) * 1e9, 1),
+                "found": {check: len(found) for check, found in issues.items()},
+                "expected": expected,
+            }
+        )
+    return results
+
+
+SUITES: Dict[str, Callable[[argparse.Namespace], List[dict]]] = {
+    "pipeline": run_pipeline_suite,
+    "correction": run_correction_suite,
+    "redos": run_redos_suite,
+    "ir": run_ir_suite,
+    "graph": run_graph_suite,
+}
+
+
+# --- 📊 5. REPORTING ---
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_pipeline_table(results: List[dict], baseline: Optional[List[dict]] = None):
+    stage_names = list(results[0]["stages"]) if results else []
+    header = f"{'sections':>9} " + " ".join(f"{s:>10}" for s in stage_names)
+    print(header + f" {'total s':>9} {'peak MB':>8} {'plan KB':>8} {'p2 KB':>9}")
+    previous = {r["sections"]: r for r in baseline or []}
+    for r in results:
+        cells = " ".join(f"{r['stages'][s]['seconds']:>10.3f}" for s in stage_names)
+        line = (
+            f"{r['sections']:>9} {cells} {r['total_seconds']:>9.3f} {r['peak_mb'] or 0:>8.1f}"
+            f" {r['prompt_bytes'].get('plan', 0) / 1024:>8.1f}"
+            f" {r['prompt_bytes'].get('schema', 0) / 1024:>9.1f}"
+        )
+        old = previous.get(r["sections"])
+        if old and old["total_seconds"]:
+            change = (r["total_seconds"] / old["total_seconds"] - 1) * 100
+            line += f"  ({change:+.1f}% vs baseline)"
+        print(line)
+
+
+def print_correction_table(results: List[dict], baseline: Optional[List[dict]] = None):
+    previous = {r["variant"]: r for r in baseline or []}
+    print(f"{'variant':<18}{'seconds':>10}{'schemas/s':>12}{'MB/s':>9}")
+    for r in results:
+        if r["variant"] == "summary":
+            print(f"outputs differing from legacy: {r['outputs_differing_from_legacy']}")
+            print("rules fired: " + ", ".join(f"{k}={v}" for k, v in sorted(r["rules_fired"].items())))
+            continue
+        line = f"{r['variant']:<18}{r['seconds']:>10.3f}{r['schemas_per_second']:>12.1f}{r['mb_per_second']:>9.2f}"
+        old = previous.get(r["variant"])
+        if old and old.get("seconds"):
+            line += f"  ({(r['seconds'] / old['seconds'] - 1) * 100:+.1f}% vs baseline)"
+        print(line)
+
+
+def print_redos_table(results: List[dict]):
+    """
+    Prints the slowest rule per adversarial input, then every rule that
+    blew its budget.
+    """
+    slowest: Dict[str, dict] = {}
+    for r in results:
+        if r["input"] not in slowest or r["seconds"] > slowest[r["input"]]["seconds"]:
+            slowest[r["input"]] = r
+    print(f"{'input':<22}{'chars':>10}{'slowest rule':>22}{'seconds':>10}{'growth':>8}")
+    for r in slowest.values():
+        print(f"{r['input']:<22}{r['chars']:>10}{r['rule']:>22}{r['seconds']:>10.3f}{r['growth']:>8.1f}")
+    over = [r for r in results if not r["within_budget"]]
+    if over:
+        print(f"❌ {len(over)} rule(s) over the {REDOS_RULE_BUDGET_SECONDS}s budget:")
+        for r in over:
+            print(f"   {r['input']} / {r['rule']}: {r['seconds']:.3f}s (growth {r['growth']}x)")
+    else:
+        print(f"✅ Every rule stayed within {REDOS_RULE_BUDGET_SECONDS}s per input")
+
+
+def print_ir_table(results: List[dict]):
+    r = results[0]
+    print(
+        f"output tokens/schema: IR {r['ir_tokens_per_schema']:.0f} "
+        f"(indented {r['ir_pretty_tokens_per_schema']:.0f}) vs TypeScript {r['ts_tokens_per_schema']:.0f} "
+        f"→ {r['token_reduction'] * 100:.0f}% fewer"
+    )
+    print(f"emitter: {r['schemas_per_second']:.0f} schemas/s over {r['schemas']} schemas")
+    print(
+        f"nondeterministic: {r['nondeterministic']}, needing corrections: "
+        f"{r['needing_corrections']}, with validation errors: {r['with_validation_errors']}"
+    )
+
+
+def print_graph_table(results: List[dict]):
+    checks = list(results[0]["found"]) if results else []
+    print(f"{'schemas':>8}{'build s':>10}{'check s':>10}{'schemas/s':>11}{'lookup ns':>11}  found/expected")
+    for r in results:
+        counts = ", ".join(
+            f"{check} {r['found'][check]}/{r['expected'].get(check, 0)}" for check in checks
+        )
+        print(
+            f"{r['schemas']:>8}{r['build_seconds']:>10.3f}{r['check_seconds']:>10.3f}"
+            f"{r['schemas_per_second']:>11.0f}{r['lookup_ns']:>11.0f}  {counts}"
+        )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark generate_schemam.py offline.")
+    parser.add_argument(
+        "--suite", choices=sorted(SUITES), nargs="+", default=["pipeline"]
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCHMARK_SIZES)
+    parser.add_argument("--max-depth", type=int, default=BENCHMARK_MAX_DEPTH)
+    parser.add_argument("--max-fan-out", type=int, default=BENCHMARK_MAX_FAN_OUT)
+    parser.add_argument("--concurrency", type=int, default=BENCHMARK_CONCURRENCY)
+    parser.add_argument("--stub-latency", type=float, default=0.0)
+    parser.add_argument("--corpus-size", type=int, default=CORRECTION_CORPUS_SIZE)
+    parser.add_argument("--redos-size", type=int, default=REDOS_INPUT_CHARS)
+    parser.add_argument(
+        "--no-memory", action="store_true", help="Skip the tracemalloc pass."
+    )
+    parser.add_argument(
+        "--output", help="Results file (default: benchmarks/<commit>_<timestamp>.json)."
+    )
+    parser.add_argument("--compare", help="Earlier results file to compare against.")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    logging.getLogger().setLevel(logging.CRITICAL)
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f).get("suites", {})
+
+    report = {
+        "commit": git_commit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "settings": {
+            "max_depth": args.max_depth,
+            "max_fan_out": args.max_fan_out,
+            "concurrency": args.concurrency,
+            "stub_latency": args.stub_latency,
+            "structure_format": gs.PROMPT_STRUCTURE_FORMAT,
+        },
+        "suites": {},
+    }
+    for suite in args.suite:
+        print(f"🏁 Running {suite} benchmarks...")
+        report["suites"][suite] = SUITES[suite](args)
+    if "pipeline" in report["suites"]:
+        print_pipeline_table(report["suites"]["pipeline"], baseline.get("pipeline"))
+    if "correction" in report["suites"]:
+        print_correction_table(report["suites"]["correction"], baseline.get("correction"))
+    if "redos" in report["suites"]:
+        print_redos_table(report["suites"]["redos"])
+    if "ir" in report["suites"]:
+        print_ir_table(report["suites"]["ir"])
+    if "graph" in report["suites"]:
+        print_graph_table(report["suites"]["graph"])
+
+    output = args.output or os.path.join(
+        BENCHMARK_RESULTS_DIR,
+        f"{report['commit']}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json",
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
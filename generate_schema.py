@@ -990,6 +990,8 @@ SCHEMAS_DIR = "schemaTypes1"
 FIGMA_PAGE_NAME = "Page 1"
 FIGMA_MAIN_FRAME_NAME = "Desktop"
 GEMINI_MODEL_NAME = "gemini-2.5-flash"
+FIGMA_CACHE_DIR = ".figma_cache"
+FIGMA_CACHE_MAX_BYTES = 512 * 1024 * 1024  # Oldest entries are evicted beyond this size
 
 
 # --- 🛠️ 2. HELPER & SETUP FUNCTIONS ---
@@ -1052,20 +1054,129 @@ def extract_json_from_response(text: str) -> Optional[dict]:
 # --- 🖼️ 3. FIGMA DATA & SUMMARIZATION ---
 
 
-def get_figma_document_data() -> Optional[dict]:
+def _figma_cache_path(cache_key: str) -> str:
+    safe_key = re.sub(r"[^A-Za-z0-9_.-]+", "_", cache_key)
+    return os.path.join(FIGMA_CACHE_DIR, f"{safe_key}.json")
+
+
+def read_figma_cache(cache_key: str) -> Optional[dict]:
+    path = _figma_cache_path(cache_key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"⚠️  Ignoring unreadable Figma cache entry '{path}': {e}")
+        return None
+    os.utime(path)  # Mark as recently used so eviction keeps it
+    return data
+
+
+def evict_figma_cache(max_bytes: Optional[int] = None):
+    """
+    Deletes the least recently used cache entries until the cache fits in max_bytes.
+    The most recent entry is always kept, even if it is larger than the limit.
+    """
+    entries = []
+    for file_name in os.listdir(FIGMA_CACHE_DIR):
+        if not file_name.endswith(".json"):
+            continue
+        path = os.path.join(FIGMA_CACHE_DIR, file_name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    max_bytes = FIGMA_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in entries[:-1]:
+        if total_bytes <= max_bytes:
+            break
+        os.remove(path)
+        total_bytes -= size
+        logging.debug(f"Evicted Figma cache entry: {path}")
+
+
+def write_figma_cache(cache_key: str, data: dict):
+    os.makedirs(FIGMA_CACHE_DIR, exist_ok=True)
+    path = _figma_cache_path(cache_key)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+    evict_figma_cache()
+
+
+def latest_figma_cache_key() -> Optional[str]:
+    """
+    Returns the cache key of the most recently used entry for FIGMA_FILE_KEY, if any.
+    """
+    if not os.path.isdir(FIGMA_CACHE_DIR):
+        return None
+    prefix = os.path.basename(_figma_cache_path(FIGMA_FILE_KEY))[: -len(".json")]
+    candidates = [
+        os.path.join(FIGMA_CACHE_DIR, f)
+        for f in os.listdir(FIGMA_CACHE_DIR)
+        if f.startswith(f"{prefix}_") and f.endswith(".json")
+    ]
+    if not candidates:
+        return None
+    latest = max(candidates, key=os.path.getmtime)
+    return os.path.basename(latest)[: -len(".json")]
+
+
+def get_figma_file_version() -> Optional[str]:
+    """
+    Cheap freshness check: a depth-limited request that only returns the file
+    metadata and the page list. Returns the cache key for the current version.
+    """
+    url = f"https://api.figma.com/v1/files/{FIGMA_FILE_KEY}"
+    headers = {"X-Figma-Token": FIGMA_API_KEY}
+    try:
+        response = requests.get(url, headers=headers, params={"depth": 1}, timeout=30)
+        response.raise_for_status()
+        meta = response.json()
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(f"⚠️  Could not check Figma file version: {e}")
+        return None
+    version = meta.get("version")
+    if not version:
+        return None
+    return f"{FIGMA_FILE_KEY}_{version}_{meta.get('lastModified', '')}"
+
+
+def get_figma_document_data(use_cache: bool = True) -> Optional[dict]:
     if not FIGMA_API_KEY or not FIGMA_FILE_KEY:
         logging.error("Figma API token or file ID missing.")
         return None
+    cache_key = get_figma_file_version() if use_cache else None
+    if cache_key:
+        cached = read_figma_cache(cache_key)
+        if cached:
+            logging.info("✅ Loaded Figma file data from local cache (file unchanged).")
+            return cached
     url = f"https://api.figma.com/v1/files/{FIGMA_FILE_KEY}"
     headers = {"X-Figma-Token": FIGMA_API_KEY}
     try:
         response = requests.get(url, headers=headers, timeout=60)
         response.raise_for_status()
         logging.info("✅ Fetched Figma file data successfully.")
-        return response.json()
+        figma_data = response.json()
     except requests.RequestException as e:
         logging.error(f"Error fetching Figma file data: {e}")
+        fallback_key = latest_figma_cache_key() if use_cache else None
+        if fallback_key:
+            logging.warning(f"⚠️  Falling back to last cached Figma data: {fallback_key}")
+            return read_figma_cache(fallback_key)
         return None
+    if use_cache:
+        cache_key = cache_key or (
+            f"{FIGMA_FILE_KEY}_{figma_data.get('version')}_{figma_data.get('lastModified', '')}"
+        )
+        try:
+            write_figma_cache(cache_key, figma_data)
+        except OSError as e:
+            logging.warning(f"⚠️  Could not write Figma cache: {e}")
+    return figma_data
 
 
 def clean_node_for_ai(node: dict, depth=0, max_depth=7) -> Optional[dict]:
@@ -1,13 +1,23 @@
 import os
+import random
 import re
+import argparse
+import bisect
+import codecs
+import gzip
+import hashlib
 import sys
 import time
 import json
 import logging
-import shutil
-from typing import Dict, Any, List, Set, Optional
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Set, Optional, Callable, Tuple
 from datetime import datetime
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import requests
 from dotenv import load_dotenv
 from json_repair import loads as json_repair_loads
@@ -23,28 +33,149 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 # --- Settings ---
 SCHEMAS_DIR = "schemaTypes1"
+# Per-schema fingerprints of the last run; unchanged schemas are not regenerated.
+SCHEMA_MANIFEST_PATH = f"{SCHEMAS_DIR}.manifest.json"
+# Bump whenever the phase-two prompt, the IR emitter or the correction rules
+# change meaningfully.
+PHASE_TWO_PROMPT_VERSION = 4
+# Ask Gemini for schema-constrained JSON for the phase-one plan so it parses on
+# the strict fast path; the json_repair fallback then only runs for backends
+# that ignore the schema.
+PLAN_STRUCTURED_OUTPUT = True
+PLAN_RESPONSE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "documents": {"type": "array", "items": {"type": "string"}},
+        "objects": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["documents", "objects"],
+}
+# What phase two asks the model for: "ts" (TypeScript, corrected afterwards)
+# or "ir" (compact JSON schema IR that emit_schema_ts() renders). IR files are
+# kept next to the schemas for diffing.
+PHASE_TWO_OUTPUT_FORMAT = "ts"
+PHASE_TWO_OUTPUT_FORMATS = ["ts", "ir"]
+SCHEMA_IR_DIR = f"{SCHEMAS_DIR}.ir"
+# Stub and replay runs write their schemas here instead of SCHEMAS_DIR, always
+# regenerate everything and never read or write the manifest, so placeholder
+# or replayed output can never be carried over into a real run.
+STUB_SCHEMAS_DIR = f"{SCHEMAS_DIR}.stub"
+REPLAY_SCHEMAS_DIR = f"{SCHEMAS_DIR}.replay"
+# Append-only run journals (plan + every phase-two result) used by --resume.
+RUNS_DIR = "runs"
 FIGMA_PAGE_NAME = "Page 1"
 FIGMA_MAIN_FRAME_NAME = "Desktop"
 GEMINI_MODEL_NAME = "gemini-2.5-flash"
+GEMINI_GENERATION_CONFIG: Dict[str, Any] = {}
+# USD per million tokens for GEMINI_MODEL_NAME; thinking tokens bill as output.
+GEMINI_PRICE_PER_MILLION_INPUT_TOKENS = 0.30
+GEMINI_PRICE_PER_MILLION_OUTPUT_TOKENS = 2.50
+# "nodes" resolves the frame with a shallow request and downloads only that subtree;
+# "stream" scans the full download and only parses the main frame;
+# "file" downloads and parses the whole document.
+FIGMA_FETCH_MODE = "nodes"
+# Collapse runs of structurally identical children (cards, logos, metrics) into
+# one representative with a repeat count and a few sample text values.
+DEDUPE_REPEATED_CHILDREN = True
+MAX_REPEAT_SAMPLE_TEXTS = 3
+# Token budgets for the Figma structure embedded in each prompt. When set, depth,
+# child sampling and text truncation are chosen per section to fit the budget;
+# None keeps the fixed max_depth=7 extraction. The phase-one budget is shared
+# evenly across all sections, but no section gets less than the minimum share
+# (so very large files can exceed the phase-one budget).
+PHASE_ONE_TOKEN_BUDGET: Optional[int] = 24000
+PHASE_ONE_MIN_SECTION_TOKENS = 150
+PHASE_TWO_TOKEN_BUDGET: Optional[int] = 6000
+CHARS_PER_TOKEN = 4  # Rough estimate used for budgeting prompt sizes
+# Encoding of the Figma structure block in prompts: "json" (indented, the
+# original format), "minified", "short_keys" (minified with one-letter keys)
+# or "outline" (an indented one-line-per-node DSL).
+PROMPT_STRUCTURE_FORMAT = "json"
+STRUCTURE_FORMATS = ["json", "minified", "short_keys", "outline"]
+STRUCTURE_SHORT_KEYS = {
+    "name": "n",
+    "type": "t",
+    "characters": "x",
+    "isImagePlaceholder": "img",
+    "children": "c",
+    "repeat": "r",
+    "sampleTexts": "s",
+    "omittedChildren": "o",
+}
+# (max_depth, max_children, max_text_len) from most to least detailed.
+BUDGET_EXTRACTION_LADDER = [
+    (12, None, None),
+    (9, None, 400),
+    (7, None, 200),
+    (7, 12, 120),
+    (6, 8, 80),
+    (5, 6, 60),
+    (4, 4, 40),
+    (3, 3, 30),
+    (2, 2, 20),
+]
+# Phase-two calls run on a thread pool; a shared token bucket spaces them out.
+PHASE_TWO_CONCURRENCY = 4
+GEMINI_REQUESTS_PER_MINUTE = 60
+# Transient Gemini failures (429/5xx/timeouts) are retried with jittered
+# exponential backoff, honoring server retry hints. Each call gets a timeout
+# per attempt and an overall deadline across all attempts.
+GEMINI_MAX_ATTEMPTS = 6
+GEMINI_BACKOFF_BASE_SECONDS = 2.0
+GEMINI_BACKOFF_MAX_SECONDS = 60.0
+GEMINI_ATTEMPT_TIMEOUT_SECONDS = 120
+GEMINI_CALL_DEADLINE_SECONDS = 600
+# Quota errors open a shared circuit breaker that pauses every worker; after
+# this many consecutive quota errors it stays open for the full cooldown.
+CIRCUIT_BREAKER_THRESHOLD = 3
+CIRCUIT_BREAKER_COOLDOWN_SECONDS = 60.0
+# Model backend used by both phases: "gemini", or "stub" for a deterministic
+# offline backend (template TypeScript, configurable latency and failures).
+MODEL_BACKEND = "gemini"
+STUB_LATENCY_SECONDS = 0.0
+STUB_FAILURE_RATE = 0.0
+# --record captures the Figma frame and every prompt/response pair into a
+# gzipped JSON archive that --replay can run end to end without network.
+ARCHIVES_DIR = "archives"
+# --dry-run assumptions: typical output sizes (thinking included) and latency
+# model (fixed overhead plus output-token throughput) for projecting runs.
+DRY_RUN_PLAN_OUTPUT_TOKENS = 1500
+DRY_RUN_SCHEMA_OUTPUT_TOKENS = 2500
+DRY_RUN_SCHEMA_IR_OUTPUT_TOKENS = 1000
+DRY_RUN_CALL_OVERHEAD_SECONDS = 2.0
+DRY_RUN_OUTPUT_TOKENS_PER_SECOND = 150.0
+# Generated code the text rules cannot correct exactly is parsed into a
+# schema tree, corrected structurally and printed back (Sanity's prettier
+# style: 100 columns, no bracket spacing). Deeper nesting than this, or
+# output longer than any real schema, is corrected as text.
+TS_PRINT_WIDTH = 100
+TS_MAX_NESTING = 200
+TS_TREE_MAX_CHARS = 100_000
+# Gemini responses are cached on disk, keyed by model, generation config and prompt.
+LLM_CACHE_DIR = ".llm_cache"
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 3600
+LLM_CACHE_MAX_BYTES = 256 * 1024 * 1024
+FIGMA_CACHE_DIR = ".figma_cache"
+FIGMA_CACHE_MAX_BYTES = 512 * 1024 * 1024  # Oldest entries are evicted beyond this size
 
 
 # --- 🛠️ 2. HELPER & SETUP FUNCTIONS ---
 
 
-def setup_logging():
+def setup_logging(run_id: Optional[str] = None):
     """
     Configures logging to output to both a clean console view and a detailed log file.
     """
     log_dir = "logs"
     os.makedirs(log_dir, exist_ok=True)
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    timestamp = run_id or datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     log_file_path = os.path.join(log_dir, f"ai-schema-architect_{timestamp}.log")
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
     if logger.hasHandlers():
         logger.handlers.clear()
     file_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    file_handler = logging.FileHandler(log_file_path, "w", "utf-8")
+    file_handler = logging.FileHandler(log_file_path, "a", "utf-8")
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(file_formatter)
     logger.addHandler(file_handler)
@@ -56,13 +187,338 @@ def setup_logging():
     logging.info(f"Logging configured. Detailed log saved to: {log_file_path}")
 
 
+_log_buffer = threading.local()
+
+
+class _BufferedLogFilter(logging.Filter):
+    """
+    Holds back records logged on threads that have an active buffer, so
+    concurrent phase-two logs can be replayed grouped and in plan order.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        records = getattr(_log_buffer, "records", None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+def run_with_buffered_logs(func, *args) -> tuple:
+    """Runs func on the current thread and returns (result, captured log records)."""
+    _log_buffer.records = []
+    try:
+        return func(*args), _log_buffer.records
+    finally:
+        _log_buffer.records = None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: allows bursts of `capacity` calls, then `rate`
+    calls per second across all threads.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Shared pause switch for all model workers. A quota error opens it for the
+    server's retry hint (or the backoff delay); repeated quota errors in a row
+    trip it for the full cooldown. Workers call wait() before every request.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self, deadline: Optional[float] = None):
+        while True:
+            with self.lock:
+                remaining = self.open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            if deadline is not None and time.monotonic() + remaining > deadline:
+                raise TimeoutError("Circuit breaker open past the call deadline.")
+            time.sleep(remaining)
+
+    def record_failure(self, pause: float):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                pause = max(pause, self.cooldown)
+                logging.warning(
+                    f"⛔ Quota exhausted {self.failures}x in a row; pausing all Gemini calls for {pause:.0f}s."
+                )
+            self.open_until = max(self.open_until, time.monotonic() + pause)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+
+class RunTrace:
+    """
+    Structured timing spans for a run, one JSON object per line. Spans nest per
+    thread, and code deep in a stage can attach attributes (retries, cache
+    hits) to the innermost open span via annotate(). Inert until start().
+    """
+
+    def __init__(self):
+        self.path: Optional[str] = None
+        self.file = None
+        self.started = time.monotonic()
+        self.spans: List[dict] = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def start(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8")
+        self.started = time.monotonic()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        record = {"span": name, **attrs}
+        stack.append(record)
+        started = time.monotonic()
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            record["start_s"] = round(started - self.started, 4)
+            record["duration_ms"] = round((time.monotonic() - started) * 1000, 2)
+            record["thread"] = threading.current_thread().name
+            self._emit(record)
+
+    def annotate(self, **attrs):
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            stack[-1].update(attrs)
+
+    def _emit(self, record: dict):
+        if not self.file:
+            return
+        with self.lock:
+            self.spans.append(record)
+            self.file.write(json.dumps(record, default=str) + "\n")
+            self.file.flush()
+
+    def log_summary(self, top: int = 5) -> dict:
+        """Logs per-stage totals and the schemas that took longest end to end."""
+        if not self.spans:
+            return {}
+        stages: Dict[str, List[float]] = {}
+        per_schema: Dict[str, float] = {}
+        for record in self.spans:
+            stages.setdefault(record["span"], []).append(record["duration_ms"])
+            if record.get("schema") and record["span"] != "model_call":
+                per_schema[record["schema"]] = (
+                    per_schema.get(record["schema"], 0) + record["duration_ms"]
+                )
+        lines = [f"{'stage':<14}{'count':>7}{'total s':>10}{'mean ms':>10}{'max ms':>10}"]
+        for name, durations in sorted(stages.items(), key=lambda kv: -sum(kv[1])):
+            lines.append(
+                f"{name:<14}{len(durations):>7}{sum(durations) / 1000:>10.2f}"
+                f"{sum(durations) / len(durations):>10.1f}{max(durations):>10.1f}"
+            )
+        slowest = sorted(per_schema.items(), key=lambda kv: -kv[1])[:top]
+        if slowest:
+            lines.append("slowest schemas: " + ", ".join(
+                f"{name} ({ms / 1000:.2f}s)" for name, ms in slowest
+            ))
+        logging.info("\n--- ⏱️  RUN TRACE SUMMARY ---\n" + "\n".join(lines))
+        logging.info(f"   Trace written to {self.path}")
+        return {
+            "stages": {
+                name: {
+                    "count": len(durations),
+                    "total_s": round(sum(durations) / 1000, 3),
+                    "max_ms": max(durations),
+                }
+                for name, durations in stages.items()
+            },
+            "slowest_schemas": [
+                {"schema": name, "seconds": round(ms / 1000, 3)} for name, ms in slowest
+            ],
+        }
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+run_trace = RunTrace()
+
+
+def positive_number(kind: Callable[[str], Any]) -> Callable[[str], Any]:
+    """argparse type= for a number that must be greater than zero."""
+
+    def parse(text: str):
+        try:
+            value = kind(text)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid {kind.__name__} value: '{text}'")
+        if value <= 0:
+            raise argparse.ArgumentTypeError(f"must be greater than 0, got {text}")
+        return value
+
+    return parse
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Generate Sanity schemas from a Figma design using Gemini."
+    )
+    parser.add_argument(
+        "--structure-format",
+        choices=STRUCTURE_FORMATS,
+        help="Encoding of the Figma structure in prompts (overrides PROMPT_STRUCTURE_FORMAT).",
+    )
+    parser.add_argument(
+        "--phase-two-format",
+        choices=PHASE_TWO_OUTPUT_FORMATS,
+        help="Ask phase two for TypeScript or for JSON schema IR (overrides PHASE_TWO_OUTPUT_FORMAT).",
+    )
+    parser.add_argument(
+        "--measure-formats",
+        action="store_true",
+        help="Report byte/token savings of each structure format per section, then exit.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Neither read nor write the Gemini response cache.",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ignore cached Gemini responses but store the fresh ones.",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Regenerate every schema, ignoring the fingerprint manifest.",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["gemini", "stub"],
+        default=MODEL_BACKEND,
+        help="Model backend for both phases; 'stub' runs offline and deterministically.",
+    )
+    parser.add_argument(
+        "--stub-latency",
+        type=float,
+        default=STUB_LATENCY_SECONDS,
+        help="Seconds the stub backend sleeps per call.",
+    )
+    parser.add_argument(
+        "--stub-failure-rate",
+        type=float,
+        default=STUB_FAILURE_RATE,
+        help="Fraction of stub backend calls that fail with a transient error.",
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help=f"Record the Figma frame and all model traffic to {ARCHIVES_DIR}/<run-id>.json.gz.",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="ARCHIVE",
+        help="Run end to end from a recorded archive, with no network access.",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        action="store_true",
+        help="When replaying, sleep for the recorded Figma and model latencies.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Fetch and build every prompt, then report estimated tokens, cost and time without calling the model.",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        help="Stop issuing model calls once this many input+output tokens are used.",
+    )
+    parser.add_argument(
+        "--max-cost",
+        type=float,
+        help="Stop issuing model calls once this many USD have been spent.",
+    )
+    parser.add_argument(
+        "--resume",
+        metavar="RUN_ID",
+        help="Resume an interrupted run from runs/<RUN_ID>.jsonl, only issuing missing LLM calls.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=positive_number(int),
+        default=PHASE_TWO_CONCURRENCY,
+        help="Number of phase-two schema generations to run in parallel.",
+    )
+    parser.add_argument(
+        "--requests-per-minute",
+        type=positive_number(float),
+        default=GEMINI_REQUESTS_PER_MINUTE,
+        help="Rate limit shared by all Gemini calls.",
+    )
+    args = parser.parse_args(argv)
+    if args.record and args.replay:
+        parser.error("--record cannot be combined with --replay")
+    return args
+
+
 def to_kebab_case(text: str) -> str:
     s1 = re.sub(r"([a-z0-9])([A-Z])", r"\1-\2", text)
     return re.sub(r"[-\s]+", "-", s1).strip("-").lower()
 
 
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
 def to_pascal_case(text: str) -> str:
-    return "".join(word.capitalize() for word in re.split(r"[\s_-]+", text))
+    # Keep existing camelCase humps ("teamMember" -> "TeamMember", not
+    # "Teammember"); all-caps words are still title-cased ("FAQ" -> "Faq").
+    return "".join(
+        word.capitalize() if word.isupper() else word[:1].upper() + word[1:]
+        for word in re.split(r"[\s_-]+", text)
+    )
 
 
 def to_camel_case(text: str) -> str:
@@ -70,6 +526,31 @@ def to_camel_case(text: str) -> str:
     return pascal[0].lower() + pascal[1:] if pascal else ""
 
 
+def to_title_case(name: str) -> str:
+    # "heroSection" -> "Hero Section"
+    return re.sub(r"(?<!^)(?=[A-Z])", " ", name[:1].upper() + name[1:])
+
+
+def parse_json_strict(text: str) -> Optional[Any]:
+    """
+    Fast path for well-formed responses: the raw body (as structured output
+    returns it) or the body of a single ```json fence. Returns None instead of
+    repairing, so callers can fall back to extract_json_from_response().
+    """
+    if not text:
+        return None
+    body = text.strip()
+    if body.startswith("```"):
+        first_newline = body.find("\n")
+        if first_newline == -1 or not body.endswith("```"):
+            return None
+        body = body[first_newline + 1 : -3].strip()
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
 def extract_json_from_response(text: str) -> Optional[dict]:
     if not text:
         logging.warning("Received empty text from AI.")
@@ -88,68 +569,696 @@ def extract_json_from_response(text: str) -> Optional[dict]:
 # --- 🖼️ 3. FIGMA DATA & SUMMARIZATION ---
 
 
-def get_figma_document_data() -> Optional[dict]:
+def _figma_cache_path(cache_key: str) -> str:
+    safe_key = re.sub(r"[^A-Za-z0-9_.-]+", "_", cache_key)
+    return os.path.join(FIGMA_CACHE_DIR, f"{safe_key}.json")
+
+
+def read_figma_cache(cache_key: str) -> Optional[dict]:
+    path = _figma_cache_path(cache_key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"⚠️  Ignoring unreadable Figma cache entry '{path}': {e}")
+        return None
+    os.utime(path)  # Mark as recently used so eviction keeps it
+    return data
+
+
+def evict_figma_cache(max_bytes: Optional[int] = None):
+    """
+    Deletes the least recently used cache entries until the cache fits in max_bytes.
+    The most recent entry is always kept, even if it is larger than the limit.
+    """
+    entries = []
+    for file_name in os.listdir(FIGMA_CACHE_DIR):
+        if not file_name.endswith(".json"):
+            continue
+        path = os.path.join(FIGMA_CACHE_DIR, file_name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    max_bytes = FIGMA_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in entries[:-1]:
+        if total_bytes <= max_bytes:
+            break
+        os.remove(path)
+        total_bytes -= size
+        logging.debug(f"Evicted Figma cache entry: {path}")
+
+
+def write_figma_cache(cache_key: str, data: dict):
+    os.makedirs(FIGMA_CACHE_DIR, exist_ok=True)
+    path = _figma_cache_path(cache_key)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+    evict_figma_cache()
+
+
+def latest_figma_cache_key() -> Optional[str]:
+    """
+    Returns the cache key of the most recently used entry for FIGMA_FILE_KEY, if any.
+    """
+    if not os.path.isdir(FIGMA_CACHE_DIR):
+        return None
+    prefix = os.path.basename(_figma_cache_path(FIGMA_FILE_KEY))[: -len(".json")]
+    candidates = [
+        os.path.join(FIGMA_CACHE_DIR, f)
+        for f in os.listdir(FIGMA_CACHE_DIR)
+        if f.startswith(f"{prefix}_") and f.endswith(".json")
+    ]
+    if not candidates:
+        return None
+    latest = max(candidates, key=os.path.getmtime)
+    return os.path.basename(latest)[: -len(".json")]
+
+
+def _figma_version_tag(meta: dict) -> str:
+    return f"{meta.get('version')}_{meta.get('lastModified', '')}"
+
+
+def get_figma_file_version() -> Optional[str]:
+    """
+    Cheap freshness check: a depth-limited request that only returns the file
+    metadata and the page list. Returns a tag identifying the current version.
+    """
+    url = f"https://api.figma.com/v1/files/{FIGMA_FILE_KEY}"
+    headers = {"X-Figma-Token": FIGMA_API_KEY}
+    try:
+        response = requests.get(url, headers=headers, params={"depth": 1}, timeout=30)
+        response.raise_for_status()
+        meta = response.json()
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(f"⚠️  Could not check Figma file version: {e}")
+        return None
+    if not meta.get("version"):
+        return None
+    return _figma_version_tag(meta)
+
+
+def get_figma_document_data(use_cache: bool = True) -> Optional[dict]:
     if not FIGMA_API_KEY or not FIGMA_FILE_KEY:
         logging.error("Figma API token or file ID missing.")
         return None
+    version_tag = get_figma_file_version() if use_cache else None
+    cache_key = f"{FIGMA_FILE_KEY}_{version_tag}" if version_tag else None
+    if cache_key:
+        cached = read_figma_cache(cache_key)
+        if cached:
+            logging.info("✅ Loaded Figma file data from local cache (file unchanged).")
+            return cached
     url = f"https://api.figma.com/v1/files/{FIGMA_FILE_KEY}"
     headers = {"X-Figma-Token": FIGMA_API_KEY}
     try:
         response = requests.get(url, headers=headers, timeout=60)
         response.raise_for_status()
         logging.info("✅ Fetched Figma file data successfully.")
-        return response.json()
+        figma_data = response.json()
     except requests.RequestException as e:
         logging.error(f"Error fetching Figma file data: {e}")
+        fallback_key = latest_figma_cache_key() if use_cache else None
+        if fallback_key:
+            logging.warning(f"⚠️  Falling back to last cached Figma data: {fallback_key}")
+            return read_figma_cache(fallback_key)
         return None
-
-
-def clean_node_for_ai(node: dict, depth=0, max_depth=7) -> Optional[dict]:
+    if use_cache:
+        cache_key = cache_key or f"{FIGMA_FILE_KEY}_{_figma_version_tag(figma_data)}"
+        try:
+            write_figma_cache(cache_key, figma_data)
+        except OSError as e:
+            logging.warning(f"⚠️  Could not write Figma cache: {e}")
+    return figma_data
+
+
+def _first_text(cleaned: dict) -> Optional[str]:
+    if cleaned.get("characters"):
+        return cleaned["characters"]
+    for child in cleaned.get("children", []):
+        text = _first_text(child)
+        if text:
+            return text
+    return None
+
+
+def _collapse_repeated_children(children: List[tuple]) -> List[dict]:
+    """
+    Replaces each run of consecutive children sharing a structural hash with the
+    first child, annotated with the run length and sample texts from the others.
+    """
+    collapsed = []
+    i = 0
+    while i < len(children):
+        cleaned, node_hash = children[i]
+        run_end = i + 1
+        while run_end < len(children) and children[run_end][1] == node_hash:
+            run_end += 1
+        if run_end - i > 1:
+            cleaned = dict(cleaned, repeat=run_end - i)
+            samples = []
+            for other, _ in children[i + 1 : run_end]:
+                text = _first_text(other)
+                if text and text not in samples:
+                    samples.append(text)
+                if len(samples) >= MAX_REPEAT_SAMPLE_TEXTS:
+                    break
+            if samples:
+                cleaned["sampleTexts"] = samples
+        collapsed.append(cleaned)
+        i = run_end
+    return collapsed
+
+
+def _clean_node(
+    node: dict,
+    depth: int,
+    max_depth: int,
+    max_children: Optional[int] = None,
+    max_text_len: Optional[int] = None,
+) -> Optional[tuple]:
+    """
+    Returns the cleaned node together with its structural hash. The hash covers
+    type, name (ignoring trailing numbers), image flags and child structure, but
+    not text content, so "Card 1" and "Card 2" with different copy hash equal.
+    """
     if not node or depth > max_depth or not node.get("visible", True):
         return None
     cleaned = {"name": node.get("name", "Untitled"), "type": node.get("type")}
     if node.get("type") == "TEXT":
-        cleaned["characters"] = node.get("characters")
+        characters = node.get("characters")
+        if max_text_len and characters and len(characters) > max_text_len:
+            characters = characters[:max_text_len] + "…"
+        cleaned["characters"] = characters
     if any(f.get("type") == "IMAGE" for f in node.get("fills", [])):
         cleaned["isImagePlaceholder"] = True
+    child_hashes = []
     if "children" in node:
         children = [
-            clean_node_for_ai(child, depth + 1, max_depth)
+            _clean_node(child, depth + 1, max_depth, max_children, max_text_len)
             for child in node.get("children", [])
         ]
-        cleaned_children = [c for c in children if c]
-        if cleaned_children:
+        children = [c for c in children if c]
+        child_hashes = [h for _, h in children]
+        if children:
+            cleaned_children = (
+                _collapse_repeated_children(children)
+                if DEDUPE_REPEATED_CHILDREN
+                else [c for c, _ in children]
+            )
+            if max_children and len(cleaned_children) > max_children:
+                cleaned["omittedChildren"] = len(cleaned_children) - max_children
+                cleaned_children = cleaned_children[:max_children]
             cleaned["children"] = cleaned_children
-    return cleaned
+    signature = "|".join(
+        [
+            str(cleaned["type"]),
+            re.sub(r"[\s_-]*\d+$", "", cleaned["name"] or ""),
+            "img" if cleaned.get("isImagePlaceholder") else "",
+            ",".join(child_hashes),
+        ]
+    )
+    return cleaned, hashlib.blake2b(signature.encode(), digest_size=8).hexdigest()
+
+
+def clean_node_for_ai(
+    node: dict,
+    depth=0,
+    max_depth=7,
+    max_children: Optional[int] = None,
+    max_text_len: Optional[int] = None,
+) -> Optional[dict]:
+    result = _clean_node(node, depth, max_depth, max_children, max_text_len)
+    return result[0] if result else None
+
+
+def _shorten_keys(structure: dict) -> dict:
+    shortened = {STRUCTURE_SHORT_KEYS.get(k, k): v for k, v in structure.items()}
+    if "children" in structure:
+        shortened["c"] = [_shorten_keys(child) for child in structure["children"]]
+    return shortened
+
+
+def _outline_lines(structure: dict, indent: int, lines: List[str]):
+    line = f"{'  ' * indent}{structure.get('type')} {json.dumps(structure.get('name'), ensure_ascii=False)}"
+    if structure.get("characters") is not None:
+        line += f": {json.dumps(structure['characters'], ensure_ascii=False)}"
+    if structure.get("isImagePlaceholder"):
+        line += " [image]"
+    if structure.get("repeat"):
+        line += f" x{structure['repeat']}"
+    if structure.get("sampleTexts"):
+        line += f" samples={json.dumps(structure['sampleTexts'], ensure_ascii=False)}"
+    if structure.get("omittedChildren"):
+        line += f" (+{structure['omittedChildren']} more)"
+    lines.append(line)
+    for child in structure.get("children", []):
+        _outline_lines(child, indent + 1, lines)
+
+
+def serialize_structure(structure: Any, fmt: Optional[str] = None) -> str:
+    """
+    Encodes a cleaned structure (or a list of {"name", "structure"} summaries)
+    for embedding in a prompt, using PROMPT_STRUCTURE_FORMAT by default.
+    """
+    fmt = fmt or PROMPT_STRUCTURE_FORMAT
+    if fmt == "json":
+        return json.dumps(structure, indent=2)
+    if fmt == "outline":
+        lines: List[str] = []
+        if isinstance(structure, list):
+            for summary in structure:
+                lines.append(f"## {summary['name']}")
+                if summary.get("structure"):
+                    _outline_lines(summary["structure"], 0, lines)
+        elif structure:
+            _outline_lines(structure, 0, lines)
+        return "\n".join(lines)
+    if fmt == "short_keys":
+        if isinstance(structure, list):
+            structure = [
+                {**s, "structure": _shorten_keys(s["structure"]) if s.get("structure") else None}
+                for s in structure
+            ]
+        elif structure:
+            structure = _shorten_keys(structure)
+    return json.dumps(structure, separators=(",", ":"), ensure_ascii=False)
+
+
+def structure_format_note(fmt: Optional[str] = None) -> str:
+    """Explains a compact encoding to the model; the indented JSON needs no note."""
+    fmt = fmt or PROMPT_STRUCTURE_FORMAT
+    if fmt == "short_keys":
+        legend = ", ".join(f"`{short}`={key}" for key, short in STRUCTURE_SHORT_KEYS.items())
+        return f"(Keys are abbreviated: {legend}.)"
+    if fmt == "outline":
+        return (
+            '(Outline format: one node per line as `TYPE "name"`, indented under its parent. '
+            '`: "..."` is text content, `[image]` an image placeholder, `xN` a repeat count, '
+            "`samples=[...]` texts of the repeats and `(+N more)` omitted children.)"
+        )
+    return ""
 
 
-def get_figma_page_sections() -> List[dict]:
-    logging.info(
-        f"📄 Fetching sections from Figma frame '{FIGMA_MAIN_FRAME_NAME}' on page '{FIGMA_PAGE_NAME}'..."
+def measure_structure_formats(section_index: Dict[str, dict]) -> List[dict]:
+    """
+    Compares every structure format against the indented JSON baseline per
+    section and logs byte and estimated token savings.
+    """
+    rows = []
+    for key, entry in section_index.items():
+        if not entry["structure"]:
+            continue
+        baseline = serialize_structure(entry["structure"], "json")
+        row = {"section": key, "json": {"bytes": len(baseline.encode()), "tokens": estimate_tokens(baseline)}}
+        for fmt in STRUCTURE_FORMATS[1:]:
+            encoded = serialize_structure(entry["structure"], fmt)
+            row[fmt] = {"bytes": len(encoded.encode()), "tokens": estimate_tokens(encoded)}
+        rows.append(row)
+    logging.info("📏 Structure format comparison (bytes / ~tokens, savings vs. indented JSON):")
+    totals = {fmt: 0 for fmt in STRUCTURE_FORMATS}
+    for row in rows:
+        parts = [f"json {row['json']['bytes']}B/{row['json']['tokens']}t"]
+        for fmt in STRUCTURE_FORMATS[1:]:
+            saving = 1 - row[fmt]["bytes"] / row["json"]["bytes"] if row["json"]["bytes"] else 0
+            parts.append(f"{fmt} {row[fmt]['bytes']}B/{row[fmt]['tokens']}t (-{saving:.0%})")
+        logging.info(f"   {row['section']}: {' | '.join(parts)}")
+        for fmt in STRUCTURE_FORMATS:
+            totals[fmt] += row[fmt]["tokens"]
+    if totals["json"]:
+        summary = ", ".join(
+            f"{fmt} ~{totals[fmt]}t (-{1 - totals[fmt] / totals['json']:.0%})"
+            for fmt in STRUCTURE_FORMATS
+        )
+        logging.info(f"   TOTAL: {summary}")
+    return rows
+
+
+def _trim_structure(
+    structure: dict,
+    depth: int,
+    max_depth: int,
+    max_children: Optional[int],
+    max_text_len: Optional[int],
+) -> Optional[dict]:
+    """
+    Applies a leaner extraction rung to an already cleaned structure: cuts
+    nodes below max_depth, extra children and long text. Repeated children
+    stay collapsed as they were at full detail.
+    """
+    if depth > max_depth:
+        return None
+    trimmed = dict(structure)
+    if max_text_len:
+        characters = trimmed.get("characters")
+        if characters and len(characters) > max_text_len:
+            trimmed["characters"] = characters[:max_text_len] + "…"
+        if "sampleTexts" in trimmed:
+            trimmed["sampleTexts"] = [
+                text if len(text) <= max_text_len else text[:max_text_len] + "…"
+                for text in trimmed["sampleTexts"]
+            ]
+    if "children" in structure:
+        children = [
+            _trim_structure(child, depth + 1, max_depth, max_children, max_text_len)
+            for child in structure["children"]
+        ]
+        children = [c for c in children if c]
+        if max_children and len(children) > max_children:
+            trimmed["omittedChildren"] = (
+                structure.get("omittedChildren", 0) + len(children) - max_children
+            )
+            children = children[:max_children]
+        if children:
+            trimmed["children"] = children
+        else:
+            del trimmed["children"]
+    return trimmed
+
+
+def clean_node_within_budget(
+    node: dict, token_budget: int, cleaned: Optional[dict] = None
+) -> tuple:
+    """
+    Walks BUDGET_EXTRACTION_LADDER from most to least detailed and returns the
+    first (structure, serialized, estimated_tokens, rung) that fits
+    token_budget, where rung 0 is full detail. Falls back to the leanest rung
+    if nothing fits. The node is cleaned once at full detail (or `cleaned`,
+    that result, is reused) and every leaner rung trims the cleaned tree.
+    """
+    if cleaned is None:
+        max_depth, max_children, max_text_len = BUDGET_EXTRACTION_LADDER[0]
+        cleaned = clean_node_for_ai(
+            node, max_depth=max_depth, max_children=max_children, max_text_len=max_text_len
+        )
+    for rung, (max_depth, max_children, max_text_len) in enumerate(
+        BUDGET_EXTRACTION_LADDER
+    ):
+        structure = (
+            _trim_structure(cleaned, 0, max_depth, max_children, max_text_len)
+            if cleaned and rung
+            else cleaned
+        )
+        serialized = serialize_structure(structure) if structure else ""
+        tokens = estimate_tokens(serialized)
+        if tokens <= token_budget:
+            break
+    logging.debug(
+        f"Budgeted extraction for '{node.get('name')}': depth={max_depth}, "
+        f"children={max_children}, text={max_text_len} -> ~{tokens}/{token_budget} tokens"
+    )
+    return structure, serialized, tokens, rung
+
+
+def find_main_frame(document: dict) -> dict:
+    target_page = next(
+        (p for p in document["children"] if p.get("name") == FIGMA_PAGE_NAME), None
+    )
+    if not target_page:
+        raise ValueError(f"Page '{FIGMA_PAGE_NAME}' not found.")
+    main_frame = next(
+        (
+            f
+            for f in target_page.get("children", [])
+            if f.get("type") == "FRAME" and f.get("name") == FIGMA_MAIN_FRAME_NAME
+        ),
+        None,
+    )
+    if not main_frame:
+        raise ValueError(f"Main frame '{FIGMA_MAIN_FRAME_NAME}' not found.")
+    return main_frame
+
+
+def get_figma_frame_node(use_cache: bool = True) -> Optional[dict]:
+    """
+    Two-step fetch: a depth=2 request lists pages and their top-level frames,
+    then only the main frame's subtree is downloaded via the nodes endpoint.
+    """
+    if not FIGMA_API_KEY or not FIGMA_FILE_KEY:
+        logging.error("Figma API token or file ID missing.")
+        return None
+    url = f"https://api.figma.com/v1/files/{FIGMA_FILE_KEY}"
+    headers = {"X-Figma-Token": FIGMA_API_KEY}
+    try:
+        response = requests.get(url, headers=headers, params={"depth": 2}, timeout=30)
+        response.raise_for_status()
+        shallow = response.json()
+    except requests.RequestException as e:
+        logging.error(f"Error fetching Figma page list: {e}")
+        return None
+    frame_id = find_main_frame(shallow["document"])["id"]
+    cache_key = f"{FIGMA_FILE_KEY}-frame-{frame_id}_{_figma_version_tag(shallow)}"
+    if use_cache:
+        cached = read_figma_cache(cache_key)
+        if cached:
+            logging.info("✅ Loaded Figma frame data from local cache (file unchanged).")
+            return cached
+    try:
+        response = requests.get(
+            f"{url}/nodes", headers=headers, params={"ids": frame_id}, timeout=60
+        )
+        response.raise_for_status()
+        nodes = response.json().get("nodes") or {}
+    except (requests.RequestException, ValueError) as e:
+        logging.error(f"Error fetching Figma frame '{frame_id}': {e}")
+        return None
+    # Figma answers null for a node the token cannot access (or that was deleted)
+    entry = nodes.get(frame_id)
+    frame_node = entry.get("document") if isinstance(entry, dict) else None
+    if not frame_node:
+        logging.error(
+            f"❌ Figma returned no document for frame '{frame_id}'; check that the "
+            "token can access the file and that the frame still exists."
+        )
+        return None
+    logging.info(f"✅ Fetched Figma frame '{FIGMA_MAIN_FRAME_NAME}' ({frame_id}) successfully.")
+    if use_cache:
+        try:
+            write_figma_cache(cache_key, frame_node)
+        except OSError as e:
+            logging.warning(f"⚠️  Could not write Figma cache: {e}")
+    return frame_node
+
+
+_STREAM_SKIP_RE = re.compile(r'(?:[^"{}\[\]]+|"(?:[^"\\]|\\.)*")*')
+_STREAM_TOKEN_RE = re.compile(
+    r'\s*(?:"((?:[^"\\]|\\.)*)"|([{}\[\],:])|([^\s{}\[\],:"]+))'
+)
+
+
+class FigmaFrameStreamExtractor:
+    """
+    Incrementally scans a raw /v1/files response and only builds dicts for the
+    main frame. Everything outside document > page > frame is skipped by
+    bracket counting, so memory is bounded by the frame size, not the file.
+    """
+
+    def __init__(self, page_name: str, frame_name: str):
+        self.page_name = page_name
+        self.frame_name = frame_name
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.stack: List[dict] = []
+        self.skip_depth = 0
+        self.capture_from: Optional[int] = None
+        self.captured_parts: List[str] = []
+        self.result: Optional[dict] = None
+        self.done = False
+
+    def feed(self, chunk: bytes, final: bool = False) -> bool:
+        """Consumes the next chunk of bytes. Returns True once the frame is found."""
+        self.buf += self.decoder.decode(chunk, final)
+        self._scan(final)
+        if self.capture_from is not None:
+            self.captured_parts.append(self.buf[self.capture_from : self.pos])
+            self.capture_from = 0
+        self.buf = self.buf[self.pos :]
+        self.pos = 0
+        return self.done
+
+    def _child_role(self, punct: str) -> Optional[str]:
+        if not self.stack:
+            return "root" if punct == "{" else None
+        top = self.stack[-1]
+        role, key = top["role"], top["key"]
+        if role == "root" and key == "document" and punct == "{":
+            return "document"
+        if role == "document" and key == "children" and punct == "[":
+            return "pages"
+        if role == "pages" and punct == "{":
+            return "page"
+        if role == "page" and key == "children" and punct == "[":
+            page_name = top["fields"].get("name")
+            return "frames" if page_name in (None, self.page_name) else None
+        if role == "frames" and punct == "{":
+            return "frame"
+        return None
+
+    def _set_field(self, top: dict, value: str):
+        top["fields"][top["key"]] = value
+        if top["role"] != "frame" or self.capture_from is None:
+            return
+        name, node_type = top["fields"].get("name"), top["fields"].get("type")
+        if name not in (None, self.frame_name) or node_type not in (None, "FRAME"):
+            self.capture_from = None
+            self.captured_parts = []
+
+    def _close(self, index: int):
+        node = self.stack.pop()
+        if node["role"] == "frame" and self.capture_from is not None:
+            self.captured_parts.append(self.buf[self.capture_from : index + 1])
+            self.capture_from = None
+            fields = node["fields"]
+            if fields.get("name") == self.frame_name and fields.get("type") == "FRAME":
+                frame = json.loads("".join(self.captured_parts))
+                page = self.stack[-2]
+                if page["fields"].get("name") == self.page_name:
+                    self.result = frame
+                    self.done = True
+                elif "name" not in page["fields"]:
+                    page.setdefault("candidate", frame)
+            self.captured_parts = []
+        elif node["role"] == "page" and node.get("candidate") is not None:
+            if node["fields"].get("name") == self.page_name:
+                self.result = node["candidate"]
+                self.done = True
+        elif node["role"] == "root":
+            self.done = True
+
+    def _scan(self, final: bool):
+        buf = self.buf
+        while not self.done:
+            if self.skip_depth:
+                end = _STREAM_SKIP_RE.match(buf, self.pos).end()
+                self.pos = end
+                if end >= len(buf) or buf[end] == '"':
+                    return  # Incomplete string or end of data: wait for more
+                self.pos = end + 1
+                self.skip_depth += 1 if buf[end] in "{[" else -1
+                continue
+            match = _STREAM_TOKEN_RE.match(buf, self.pos)
+            if not match or (match.end() == len(buf) and not final):
+                return
+            self.pos = match.end()
+            string, punct, _ = match.groups()
+            top = self.stack[-1] if self.stack else None
+            if punct == ",":
+                if top and top["kind"] == "obj":
+                    top["expect_key"] = True
+            elif punct in ("{", "["):
+                role = self._child_role(punct)
+                if role is None:
+                    self.skip_depth = 1
+                    continue
+                self.stack.append(
+                    {
+                        "role": role,
+                        "kind": "obj" if punct == "{" else "arr",
+                        "key": None,
+                        "expect_key": True,
+                        "fields": {},
+                    }
+                )
+                if role == "frame":
+                    self.capture_from = self.pos - 1
+                    self.captured_parts = []
+            elif punct in ("}", "]"):
+                self._close(self.pos - 1)
+            elif string is not None and top and top["kind"] == "obj":
+                value = json.loads(f'"{string}"')
+                if top["expect_key"]:
+                    top["key"] = value
+                    top["expect_key"] = False
+                elif top["role"] in ("page", "frame") and top["key"] in ("name", "type"):
+                    self._set_field(top, value)
+
+
+def get_figma_frame_streamed(use_cache: bool = True) -> Optional[dict]:
+    """
+    Streams the full file download through FigmaFrameStreamExtractor and stops
+    reading as soon as the main frame has been parsed.
+    """
+    if not FIGMA_API_KEY or not FIGMA_FILE_KEY:
+        logging.error("Figma API token or file ID missing.")
+        return None
+    version_tag = get_figma_file_version() if use_cache else None
+    cache_key = (
+        f"{FIGMA_FILE_KEY}-frame-{FIGMA_PAGE_NAME}-{FIGMA_MAIN_FRAME_NAME}_{version_tag}"
+        if version_tag
+        else None
     )
+    if cache_key:
+        cached = read_figma_cache(cache_key)
+        if cached:
+            logging.info("✅ Loaded Figma frame data from local cache (file unchanged).")
+            return cached
+    url = f"https://api.figma.com/v1/files/{FIGMA_FILE_KEY}"
+    headers = {"X-Figma-Token": FIGMA_API_KEY}
+    extractor = FigmaFrameStreamExtractor(FIGMA_PAGE_NAME, FIGMA_MAIN_FRAME_NAME)
+    try:
+        with requests.get(url, headers=headers, timeout=60, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                if extractor.feed(chunk):
+                    break
+            else:
+                extractor.feed(b"", final=True)
+    except requests.RequestException as e:
+        logging.error(f"Error streaming Figma file data: {e}")
+        return None
+    if extractor.result is None:
+        raise ValueError(
+            f"Main frame '{FIGMA_MAIN_FRAME_NAME}' not found on page '{FIGMA_PAGE_NAME}'."
+        )
+    logging.info(f"✅ Streamed Figma frame '{FIGMA_MAIN_FRAME_NAME}' successfully.")
+    if cache_key:
+        try:
+            write_figma_cache(cache_key, extractor.result)
+        except OSError as e:
+            logging.warning(f"⚠️  Could not write Figma cache: {e}")
+    return extractor.result
+
+
+def get_figma_main_frame() -> Optional[dict]:
+    if FIGMA_FETCH_MODE == "nodes":
+        return get_figma_frame_node()
+    if FIGMA_FETCH_MODE == "stream":
+        return get_figma_frame_streamed()
     figma_data = get_figma_document_data()
     if not figma_data:
-        return []
+        return None
+    return find_main_frame(figma_data["document"])
+
+
+def get_figma_page_sections(
+    archive: Optional["TrafficArchive"] = None, replay: bool = False
+) -> List[dict]:
+    """
+    Lists the named top-level sections of the main frame. With an archive the
+    fetched frame is recorded into it, or with replay=True read back from it.
+    """
+    logging.info(
+        f"📄 Fetching sections from Figma frame '{FIGMA_MAIN_FRAME_NAME}' on page '{FIGMA_PAGE_NAME}'..."
+    )
     try:
-        document = figma_data["document"]
-        target_page = next(
-            (p for p in document["children"] if p.get("name") == FIGMA_PAGE_NAME), None
-        )
-        if not target_page:
-            raise ValueError(f"Page '{FIGMA_PAGE_NAME}' not found.")
-        main_frame = next(
-            (
-                f
-                for f in target_page["children"]
-                if f.get("type") == "FRAME" and f.get("name") == FIGMA_MAIN_FRAME_NAME
-            ),
-            None,
-        )
+        with run_trace.span("fetch", mode="replay" if replay else FIGMA_FETCH_MODE):
+            if archive and replay:
+                main_frame = archive.replay_figma_frame()
+            else:
+                started = time.monotonic()
+                main_frame = get_figma_main_frame()
+                if archive and main_frame:
+                    archive.record_figma_frame(main_frame, time.monotonic() - started)
         if not main_frame:
-            raise ValueError(f"Main frame '{FIGMA_MAIN_FRAME_NAME}' not found.")
+            return []
         sections = [
             {"name": n.get("name"), "node": n}
-            for n in main_frame["children"]
+            for n in main_frame.get("children", [])
             if n.get("type") in ["FRAME", "COMPONENT", "INSTANCE"] and n.get("name")
         ]
         if not sections:
@@ -161,14 +1270,787 @@ def get_figma_page_sections() -> List[dict]:
         return []
 
 
+def build_section_index(sections: List[dict]) -> Dict[str, dict]:
+    """
+    Cleans every section exactly once and indexes the result by camelCase schema
+    name, so both phases reuse the same trees instead of re-walking the nodes.
+    Sections sharing a name are kept as extra instances of the first entry.
+    """
+    section_index: Dict[str, dict] = {}
+    plan_budget = (
+        max(PHASE_ONE_TOKEN_BUDGET // len(sections), PHASE_ONE_MIN_SECTION_TOKENS)
+        if PHASE_ONE_TOKEN_BUDGET and sections
+        else None
+    )
+    max_depth, max_children, max_text_len = BUDGET_EXTRACTION_LADDER[0]
+    for section in sections:
+        key = to_camel_case(section["name"])
+        entry = section_index.get(key)
+        # One full-detail clean per section; every budget rung trims it.
+        cleaned = (
+            clean_node_for_ai(
+                section["node"],
+                max_depth=max_depth,
+                max_children=max_children,
+                max_text_len=max_text_len,
+            )
+            if plan_budget or (PHASE_TWO_TOKEN_BUDGET and not entry)
+            else None
+        )
+        if entry:
+            plan_structure = (
+                clean_node_within_budget(section["node"], plan_budget, cleaned)[0]
+                if plan_budget
+                else clean_node_for_ai(section["node"])
+            )
+            entry["instances"].append(plan_structure)
+            continue
+        if PHASE_TWO_TOKEN_BUDGET:
+            structure, structure_text, tokens, rung = clean_node_within_budget(
+                section["node"], PHASE_TWO_TOKEN_BUDGET, cleaned
+            )
+        else:
+            structure = clean_node_for_ai(section["node"])
+            structure_text = serialize_structure(structure) if structure else ""
+            tokens = estimate_tokens(structure_text)
+            rung = 0
+        plan_structure = (
+            clean_node_within_budget(section["node"], plan_budget, cleaned)[0]
+            if plan_budget
+            else structure
+        )
+        section_index[key] = {
+            "name": section["name"],
+            "structure": structure,
+            "structure_text": structure_text or None,
+            "tokens": tokens,
+            "detail_level": rung,
+            "instances": [plan_structure],
+        }
+    logging.info(
+        f"✅ Indexed {len(section_index)} cleaned section structures "
+        f"(largest ~{max((e['tokens'] for e in section_index.values()), default=0)} tokens)."
+    )
+    return section_index
+
+
 # --- 🤖 4. AI ARCHITECT ---
 
 
-def phase_one_architect_plan(sections: List[dict], model) -> Optional[dict]:
-    logging.info("🤖 PHASE 1: Creating architectural plan from Figma JSON...")
+class LLMResponseCache:
+    """
+    Content-addressed on-disk cache of model responses. Entries expire after
+    ttl_seconds and the least recently used ones are evicted beyond max_bytes.
+    With refresh=True lookups always miss but new responses are still stored.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = LLM_CACHE_DIR,
+        ttl_seconds: float = LLM_CACHE_TTL_SECONDS,
+        max_bytes: int = LLM_CACHE_MAX_BYTES,
+        refresh: bool = False,
+    ):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(model_name: str, generation_config: Dict[str, Any], prompt: str) -> str:
+        material = json.dumps(
+            {
+                "model": model_name,
+                "config": generation_config,
+                "prompt": hashlib.sha256(prompt.encode()).hexdigest(),
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[tuple]:
+        """(text, usage) of a live entry; usage is None if it was not recorded."""
+        if self.refresh:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get("created", 0) > self.ttl_seconds:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        os.utime(path)  # Mark as recently used so eviction keeps it
+        if entry.get("text") is None:
+            return None
+        return entry["text"], entry.get("usage")
+
+    def put(self, key: str, text: str, usage: Optional[Dict[str, int]] = None):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "text": text, "usage": usage}, f)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            now = time.time()
+            for file_name in os.listdir(self.cache_dir):
+                if not file_name.endswith(".json"):
+                    continue
+                path = os.path.join(self.cache_dir, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            entries.sort()
+            total_bytes = sum(size for _, size, _ in entries)
+            for mtime, size, path in entries:
+                # mtime is refreshed on every hit, so it is a safe lower bound for expiry
+                if total_bytes <= self.max_bytes and now - mtime <= self.ttl_seconds:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total_bytes -= size
+
+
+gemini_circuit_breaker = CircuitBreaker(
+    CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN_SECONDS
+)
+
+_RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,  # Includes ResourceExhausted (429)
+    google_exceptions.ServerError,  # 500, 502, 503, 504
+    google_exceptions.DeadlineExceeded,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+_RETRY_HINT_RE = re.compile(
+    r"retry_delay\s*\{\s*seconds:\s*(\d+)|retry in (\d+(?:\.\d+)?)\s*s", re.I
+)
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    Extracts the server's retry hint from a Retry-After header, a RetryInfo
+    detail, or the 'Please retry in 17s' text Gemini puts in quota errors.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("Retry-After"):
+            return float(headers["Retry-After"])
+    except (TypeError, ValueError):
+        pass
+    for detail in getattr(error, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and hasattr(delay, "seconds"):
+            return delay.seconds + getattr(delay, "nanos", 0) / 1e9
+    match = _RETRY_HINT_RE.search(str(error))
+    if match:
+        return float(match.group(1) or match.group(2))
+    return None
+
+
+def call_with_retries(
+    func: Callable[[], Any],
+    rate_limiter: Optional[TokenBucket] = None,
+    description: str = "Model call",
+) -> Any:
+    """
+    Runs func() with jittered exponential backoff on transient errors, within
+    GEMINI_CALL_DEADLINE_SECONDS. Quota errors also open the shared circuit
+    breaker so every worker backs off together instead of hammering the API.
+    """
+    deadline = time.monotonic() + GEMINI_CALL_DEADLINE_SECONDS
+    for attempt in range(1, GEMINI_MAX_ATTEMPTS + 1):
+        gemini_circuit_breaker.wait(deadline)
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            result = func()
+            gemini_circuit_breaker.record_success()
+            return result
+        except _RETRYABLE_ERRORS as e:
+            backoff = min(
+                GEMINI_BACKOFF_MAX_SECONDS,
+                GEMINI_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1),
+            )
+            delay = random.uniform(0, backoff)  # Full jitter
+            hint = _retry_after_seconds(e)
+            if hint is not None:
+                delay = max(delay, hint)
+            if isinstance(e, google_exceptions.TooManyRequests):
+                gemini_circuit_breaker.record_failure(delay)
+            if attempt == GEMINI_MAX_ATTEMPTS:
+                raise
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(
+                    f"{description} would exceed its {GEMINI_CALL_DEADLINE_SECONDS}s deadline."
+                ) from e
+            logging.warning(
+                f"  🔁 {description} failed ({type(e).__name__}); retry {attempt}/{GEMINI_MAX_ATTEMPTS - 1} in {delay:.1f}s."
+            )
+            run_trace.annotate(retries=attempt)
+            time.sleep(delay)
+
+
+def heuristic_plan(section_names: List[str]) -> dict:
+    """
+    The plan phase one would produce if it made no grid splits: every section
+    becomes an object, plus the mandatory page/siteSettings/header/footer
+    documents. Used by the stub backend and by --dry-run estimates.
+    """
+    documents = {"page", "siteSettings"}
+    objects = set()
+    for name in section_names:
+        if name.lower() in ("header", "footer"):
+            documents.add(name)
+        else:
+            objects.add(name)
+    return {"documents": sorted(documents), "objects": sorted(objects)}
+
+
+class ModelBackend(ABC):
+    """
+    Interface both phases call through. `task` describes what the prompt asks
+    for ({"phase": "plan", ...} or {"phase": "schema", ...}); real backends
+    ignore it, the stub uses it to answer without parsing the prompt.
+    """
+
+    model_name = "unknown"
+    cacheable = True
+    # USD per million (input, output) tokens; None for backends that cost nothing.
+    prices: Optional[Tuple[float, float]] = None
+
+    @abstractmethod
+    def generate(
+        self, prompt: str, task: Optional[dict] = None
+    ) -> Tuple[str, Optional[Dict[str, int]]]:
+        """Returns the response text and its usage ({prompt,output}_tokens) if known."""
+
+
+class GeminiBackend(ModelBackend):
+    prices = (GEMINI_PRICE_PER_MILLION_INPUT_TOKENS, GEMINI_PRICE_PER_MILLION_OUTPUT_TOKENS)
+
+    def __init__(
+        self,
+        model_name: str = GEMINI_MODEL_NAME,
+        generation_config: Optional[Dict[str, Any]] = None,
+    ):
+        genai.configure(api_key=GEMINI_API_KEY)
+        self.model = genai.GenerativeModel(
+            model_name, generation_config=generation_config or None
+        )
+        self.model_name = getattr(self.model, "model_name", model_name)
+
+    def generate(
+        self, prompt: str, task: Optional[dict] = None
+    ) -> Tuple[str, Optional[Dict[str, int]]]:
+        response = self.model.generate_content(
+            prompt,
+            generation_config=(task or {}).get("generation_config"),
+            request_options={"timeout": GEMINI_ATTEMPT_TIMEOUT_SECONDS},
+        )
+        metadata = getattr(response, "usage_metadata", None)
+        usage = None
+        if metadata is not None:
+            usage = {
+                "prompt_tokens": getattr(metadata, "prompt_token_count", 0) or 0,
+                "output_tokens": (getattr(metadata, "candidates_token_count", 0) or 0)
+                + (getattr(metadata, "thoughts_token_count", 0) or 0),
+            }
+        return response.text, usage
+
+
+class StubBackend(ModelBackend):
+    """
+    Deterministic offline backend for benchmarks and CI. Returns a canned or
+    name-derived plan and canned or template TypeScript, after an optional
+    fixed latency. Injected failures are transient server errors, so they go
+    through the normal retry path; whether a call fails depends only on the
+    prompt and its attempt number, not on thread scheduling.
+    """
+
+    model_name = "stub"
+    cacheable = False
+
+    def __init__(
+        self,
+        plan: Optional[dict] = None,
+        canned_code: Optional[Dict[str, str]] = None,
+        latency: float = STUB_LATENCY_SECONDS,
+        failure_rate: float = STUB_FAILURE_RATE,
+        seed: int = 0,
+    ):
+        self.plan = plan
+        self.canned_code = canned_code or {}
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.attempts: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def _should_fail(self, prompt: str) -> bool:
+        if self.failure_rate <= 0:
+            return False
+        digest = hashlib.blake2b(prompt.encode("utf-8"), digest_size=8).hexdigest()
+        with self.lock:
+            attempt = self.attempts.get(digest, 0)
+            self.attempts[digest] = attempt + 1
+        roll = random.Random(f"{self.seed}:{digest}:{attempt}").random()
+        return roll < self.failure_rate
+
+    def _template_code(self, name: str, schema_type: str, plan: dict) -> str:
+        title = to_title_case(name)
+        fields = [
+            "    defineField({name: 'title', title: 'Title', type: 'internationalizedArrayString'}),"
+        ]
+        if name == "page":
+            members = "\n".join(
+                f"        {{type: '{obj}'}}," for obj in page_builder_objects(plan)
+            )
+            fields.append("    defineField({name: 'slug', title: 'Slug', type: 'slug'}),")
+            fields.append(
+                "    defineField({\n      name: 'pageBuilder',\n      title: 'Page Builder',\n"
+                f"      type: 'array',\n      of: [\n{members}\n      ],\n    }}),"
+            )
+        body = "\n".join(fields)
+        return (
+            "```typescript\n"
+            "import {defineType, defineField} from 'sanity'\n\n"
+            "export default defineType({\n"
+            f"  name: '{name}',\n  title: '{title}',\n  type: '{schema_type}',\n"
+            f"  fields: [\n{body}\n  ],\n}})\n"
+            "```"
+        )
+
+    def _template_ir(self, name: str, schema_type: str, plan: dict) -> dict:
+        """The schema _template_code() writes, as phase-two IR."""
+        fields: List[dict] = [{"name": "title", "type": "string", "i18n": True}]
+        if name == "page":
+            fields.append({"name": "slug", "type": "slug"})
+            fields.append(
+                {
+                    "name": "pageBuilder",
+                    "type": "array",
+                    "of": page_builder_objects(plan),
+                }
+            )
+        return {"name": name, "type": schema_type, "fields": fields}
+
+    def generate(
+        self, prompt: str, task: Optional[dict] = None
+    ) -> Tuple[str, Optional[Dict[str, int]]]:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self._should_fail(prompt):
+            raise google_exceptions.ServiceUnavailable("Injected stub failure.")
+        text = self._respond(task or {})
+        usage = {
+            "prompt_tokens": estimate_tokens(prompt),
+            "output_tokens": estimate_tokens(text),
+        }
+        return text, usage
+
+    def _respond(self, task: dict) -> str:
+        if task.get("phase") == "plan":
+            plan = self.plan or heuristic_plan(task.get("sections", []))
+            if task.get("generation_config", {}).get("response_schema"):
+                return json.dumps(plan)
+            return f"```json\n{json.dumps(plan, indent=2)}\n```"
+        if task.get("phase") == "schema":
+            name = task["name"]
+            if name in self.canned_code:
+                return self.canned_code[name]
+            if task.get("format") == "ir":
+                return json.dumps(self._template_ir(name, task["type"], task.get("plan", {})))
+            return self._template_code(name, task["type"], task.get("plan", {}))
+        raise ValueError("StubBackend needs a task describing the request.")
+
+
+class TrafficArchive:
+    """
+    Compact capture of a run's external inputs: the Figma main frame and every
+    model prompt/response pair with its latency, stored as gzipped JSON.
+    Replay looks calls up by prompt hash, falling back to the task (phase and
+    schema name) so runs with changed prompt encodings can still be replayed.
+    """
+
+    VERSION = 1
+
+    def __init__(self, simulate_latency: bool = False):
+        self.simulate_latency = simulate_latency
+        self.figma_frame: Optional[dict] = None
+        self.figma_latency = 0.0
+        self.calls: List[dict] = []
+        self.lock = threading.Lock()
+        self._by_prompt: Dict[str, List[dict]] = {}
+        self._by_task: Dict[str, List[dict]] = {}
+
+    @staticmethod
+    def prompt_hash(prompt: str) -> str:
+        return hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).hexdigest()
+
+    @staticmethod
+    def task_key(task: Optional[dict]) -> str:
+        task = task or {}
+        return f"{task.get('phase')}:{task.get('name', '')}"
+
+    def record_figma_frame(self, frame: dict, latency: float):
+        self.figma_frame = frame
+        self.figma_latency = latency
+
+    def replay_figma_frame(self) -> Optional[dict]:
+        if self.simulate_latency:
+            time.sleep(self.figma_latency)
+        return self.figma_frame
+
+    def record_call(
+        self,
+        prompt: str,
+        task: Optional[dict],
+        response: str,
+        latency: float,
+        usage: Optional[Dict[str, int]] = None,
+    ):
+        with self.lock:
+            self.calls.append(
+                {
+                    "prompt_hash": self.prompt_hash(prompt),
+                    "task": self.task_key(task),
+                    "prompt": prompt,
+                    "response": response,
+                    "latency": round(latency, 4),
+                    "usage": usage,
+                }
+            )
+
+    def replay_call(self, prompt: str, task: Optional[dict]) -> dict:
+        with self.lock:
+            queue = self._by_prompt.get(self.prompt_hash(prompt))
+            if not queue:
+                queue = self._by_task.get(self.task_key(task))
+                if queue:
+                    logging.debug(
+                        f"Replay: prompt changed, matched by task {self.task_key(task)}."
+                    )
+            if not queue:
+                raise KeyError(f"No recorded response for {self.task_key(task)}.")
+            call = queue[0]
+            if len(queue) > 1:
+                # Consume it from both indexes so they stay in step; the last
+                # response for a prompt keeps answering repeats of it.
+                for index, key in (
+                    (self._by_prompt, call["prompt_hash"]),
+                    (self._by_task, call["task"]),
+                ):
+                    calls = index[key]
+                    del calls[next(i for i, other in enumerate(calls) if other is call)]
+        return call
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        payload = {
+            "version": self.VERSION,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "figma": {"frame": self.figma_frame, "latency": self.figma_latency},
+            "calls": self.calls,
+        }
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(payload, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+        logging.info(
+            f"📼 Recorded Figma frame and {len(self.calls)} model call(s) to {path} "
+            f"({os.path.getsize(path) / 1024:.0f} KB)."
+        )
+
+    @classmethod
+    def load(cls, path: str, simulate_latency: bool = False) -> "TrafficArchive":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            payload = json.load(f)
+        if payload.get("version") != cls.VERSION:
+            raise ValueError(f"Unsupported archive version {payload.get('version')}.")
+        archive = cls(simulate_latency)
+        archive.figma_frame = payload["figma"]["frame"]
+        archive.figma_latency = payload["figma"]["latency"]
+        archive.calls = payload["calls"]
+        for call in archive.calls:
+            archive._by_prompt.setdefault(call["prompt_hash"], []).append(call)
+            archive._by_task.setdefault(call["task"], []).append(call)
+        return archive
+
+
+class RecordingBackend(ModelBackend):
+    """Wraps another backend and records each successful call into an archive."""
+
+    cacheable = False
+
+    def __init__(self, inner: ModelBackend, archive: TrafficArchive):
+        self.inner = inner
+        self.archive = archive
+        self.model_name = inner.model_name
+        self.prices = inner.prices
+
+    def generate(
+        self, prompt: str, task: Optional[dict] = None
+    ) -> Tuple[str, Optional[Dict[str, int]]]:
+        started = time.monotonic()
+        text, usage = self.inner.generate(prompt, task)
+        self.archive.record_call(prompt, task, text, time.monotonic() - started, usage)
+        return text, usage
+
+
+class ReplayBackend(ModelBackend):
+    """Serves recorded responses, optionally sleeping for the recorded latency."""
+
+    model_name = "replay"
+    cacheable = False
+
+    def __init__(self, archive: TrafficArchive):
+        self.archive = archive
+
+    def generate(
+        self, prompt: str, task: Optional[dict] = None
+    ) -> Tuple[str, Optional[Dict[str, int]]]:
+        call = self.archive.replay_call(prompt, task)
+        if self.archive.simulate_latency:
+            time.sleep(call["latency"])
+        return call["response"], call.get("usage")
+
+
+def create_backend(
+    name: str = MODEL_BACKEND,
+    latency: float = STUB_LATENCY_SECONDS,
+    failure_rate: float = STUB_FAILURE_RATE,
+) -> ModelBackend:
+    if name == "stub":
+        return StubBackend(latency=latency, failure_rate=failure_rate)
+    if name == "gemini":
+        return GeminiBackend(GEMINI_MODEL_NAME, GEMINI_GENERATION_CONFIG)
+    raise ValueError(f"Unknown model backend '{name}'.")
+
+
+class BudgetExceededError(RuntimeError):
+    pass
+
+
+class UsageLedger:
+    """
+    Per-call, per-schema and per-run token and cost totals. With a token or
+    USD cap, check() refuses new model calls once the cap is reached; calls
+    already in flight still complete, so the cap can be overshot by up to
+    --concurrency calls. Cache hits cost nothing and are always allowed; the
+    usage stored with them is tallied separately as savings. Usage is priced
+    at the backend's rates, so stub and replay runs cost $0.
+    """
+
+    def __init__(self):
+        self.model_name = GEMINI_MODEL_NAME
+        self.prices = (GEMINI_PRICE_PER_MILLION_INPUT_TOKENS, GEMINI_PRICE_PER_MILLION_OUTPUT_TOKENS)
+        self.cache_hits = 0
+        self.cached_prompt_tokens = 0
+        self.cached_output_tokens = 0
+        self.max_tokens: Optional[int] = None
+        self.max_cost_usd: Optional[float] = None
+        self.calls = 0
+        self.unmetered_calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.per_schema: Dict[str, Dict[str, Any]] = {}
+        self.exhausted = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cost(
+        prompt_tokens: int,
+        output_tokens: int,
+        prices: Tuple[float, float] = (
+            GEMINI_PRICE_PER_MILLION_INPUT_TOKENS,
+            GEMINI_PRICE_PER_MILLION_OUTPUT_TOKENS,
+        ),
+    ) -> float:
+        return (prompt_tokens * prices[0] + output_tokens * prices[1]) / 1_000_000
+
+    @property
+    def total_cost(self) -> float:
+        return self.cost(self.prompt_tokens, self.output_tokens, self.prices)
+
+    def set_backend(self, backend: ModelBackend):
+        self.model_name = backend.model_name
+        self.prices = backend.prices or (0.0, 0.0)
+
+    def set_budget(self, max_tokens: Optional[int], max_cost_usd: Optional[float]):
+        self.max_tokens = max_tokens
+        self.max_cost_usd = max_cost_usd
+
+    def check(self):
+        with self.lock:
+            over = (
+                self.max_tokens is not None
+                and self.prompt_tokens + self.output_tokens >= self.max_tokens
+            ) or (
+                self.max_cost_usd is not None and self.total_cost >= self.max_cost_usd
+            )
+            if over and not self.exhausted:
+                self.exhausted = True
+                logging.warning(
+                    f"💸 Token budget exhausted ({self.prompt_tokens + self.output_tokens} tokens, "
+                    f"${self.total_cost:.4f}); skipping all further model calls."
+                )
+        if over:
+            raise BudgetExceededError("Token budget exhausted.")
+
+    def record(self, schema: Optional[str], usage: Optional[Dict[str, int]]):
+        with self.lock:
+            self.calls += 1
+            if not usage:
+                self.unmetered_calls += 1
+                return
+            self.prompt_tokens += usage["prompt_tokens"]
+            self.output_tokens += usage["output_tokens"]
+            entry = self.per_schema.setdefault(
+                schema or "(plan)", {"calls": 0, "prompt_tokens": 0, "output_tokens": 0}
+            )
+            entry["calls"] += 1
+            entry["prompt_tokens"] += usage["prompt_tokens"]
+            entry["output_tokens"] += usage["output_tokens"]
+
+    def record_cache_hit(self, usage: Optional[Dict[str, int]]):
+        with self.lock:
+            self.cache_hits += 1
+            if usage:
+                self.cached_prompt_tokens += usage["prompt_tokens"]
+                self.cached_output_tokens += usage["output_tokens"]
+
+    def log_summary(self, top: int = 5) -> dict:
+        saved = self.cost(self.cached_prompt_tokens, self.cached_output_tokens, self.prices)
+        summary = {
+            "model": self.model_name,
+            "calls": self.calls,
+            "unmetered_calls": self.unmetered_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "cost_usd": round(self.total_cost, 6),
+            "cache_hits": self.cache_hits,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "cached_output_tokens": self.cached_output_tokens,
+            "saved_usd": round(saved, 6),
+            "budget_tokens": self.max_tokens,
+            "budget_usd": self.max_cost_usd,
+            "budget_exhausted": self.exhausted,
+            "per_schema": {
+                name: {
+                    **entry,
+                    "cost_usd": round(
+                        self.cost(entry["prompt_tokens"], entry["output_tokens"], self.prices), 6
+                    ),
+                }
+                for name, entry in self.per_schema.items()
+            },
+        }
+        costliest = sorted(
+            summary["per_schema"].items(), key=lambda kv: -kv[1]["cost_usd"]
+        )[:top]
+        totals = (
+            f"calls={self.calls} input={self.prompt_tokens} "
+            f"output={self.output_tokens} cost=${self.total_cost:.4f}"
+        )
+        if self.unmetered_calls:
+            totals += f" ({self.unmetered_calls} call(s) without usage data)"
+        if self.cache_hits:
+            totals += (
+                f"; {self.cache_hits} cache hit(s) saved "
+                f"{self.cached_prompt_tokens + self.cached_output_tokens} tokens (${saved:.4f})"
+            )
+        lines = [totals]
+        lines += [
+            f"  {name:<24} {entry['prompt_tokens']:>8} in {entry['output_tokens']:>7} out  ${entry['cost_usd']:.4f}"
+            for name, entry in costliest
+        ]
+        logging.info("\n--- 💰 TOKEN USAGE ---\n" + "\n".join(lines))
+        return summary
+
+
+usage_ledger = UsageLedger()
+
+
+def generate_text(
+    backend: ModelBackend,
+    prompt: str,
+    llm_cache: Optional[LLMResponseCache] = None,
+    rate_limiter: Optional[TokenBucket] = None,
+    task: Optional[dict] = None,
+) -> str:
+    """
+    Single entry point for model calls: serves cached responses when possible
+    and only applies the rate limiter and retries to real requests.
+    """
+    task = task or {}
+    with run_trace.span(
+        "model_call",
+        phase=task.get("phase"),
+        schema=task.get("name"),
+        prompt_bytes=len(prompt.encode("utf-8")),
+        retries=0,
+    ) as span:
+        cache_key = None
+        if llm_cache and not backend.cacheable:
+            llm_cache = None
+        if llm_cache:
+            cache_key = LLMResponseCache.make_key(
+                backend.model_name,
+                {**GEMINI_GENERATION_CONFIG, **task.get("generation_config", {})},
+                prompt,
+            )
+            cached = llm_cache.get(cache_key)
+            if cached is not None:
+                cached_text, cached_usage = cached
+                logging.debug(f"LLM cache hit: {cache_key[:12]}")
+                usage_ledger.record_cache_hit(cached_usage)
+                span.update(cache="hit", response_bytes=len(cached_text.encode("utf-8")))
+                return cached_text
+        span["cache"] = "miss" if llm_cache else "off"
+        usage_ledger.check()
+        text, usage = call_with_retries(
+            lambda: backend.generate(prompt, task),
+            rate_limiter,
+        )
+        usage_ledger.record(task.get("name"), usage)
+        if usage:
+            span.update(usage)
+        span["response_bytes"] = len((text or "").encode("utf-8"))
+        if llm_cache and text:
+            try:
+                llm_cache.put(cache_key, text, usage)
+            except OSError as e:
+                logging.warning(f"⚠️  Could not write LLM cache entry: {e}")
+        return text
+
+
+def build_plan_prompt(section_index: Dict[str, dict]) -> str:
     sections_summary = [
-        {"name": section["name"], "structure": clean_node_for_ai(section["node"])}
-        for section in sections
+        {"name": entry["name"], "structure": structure}
+        for entry in section_index.values()
+        for structure in entry["instances"]
     ]
     prompt = f"""
 You are a top-tier Sanity.io Lead Architect. Analyze the lightweight JSON representation of a Figma design and create a high-level, scalable, and DRY schema plan.
@@ -176,82 +2058,99 @@ You are a top-tier Sanity.io Lead Architect. Analyze the lightweight JSON repres
 **Architectural Rules:**
 1.  **Documents vs. Objects:** `documents` are for queryable data collections (e.g., `post`, `page`, `siteSettings`, `header`, `footer`). `objects` are for structural components used on pages (e.g., `heroSection`, `ctaButton`).
 2.  **Header and Footer Rule (CRITICAL):** If you see 'Header' or 'Footer' sections in the Figma design, they MUST be created as `documents` (not objects). These will be referenced by `siteSettings`.
-3.  **The Grid Rule:** When you see a "structure" with repeating children of the same name (e.g., a "Team" section with multiple "Team Member" children), define a `document` for the underlying data (e.g., `teamMember`) and an `object` for the page section (e.g., `teamSection`) that will hold an array of `references` to those documents.
+3.  **The Grid Rule:** When you see a "structure" with repeating children of the same name (e.g., a "Team" section with multiple "Team Member" children), define a `document` for the underlying data (e.g., `teamMember`) and an `object` for the page section (e.g., `teamSection`) that will hold an array of `references` to those documents. A child with a `repeat` count stands for that many identical siblings; `sampleTexts` shows text from the others, and `omittedChildren` counts children left out for brevity.
 4.  **Global Content Rule:** Always plan a `siteSettings` document. If header or footer sections are detected, create separate `header` and `footer` documents that will be referenced by `siteSettings`.
 5.  **CRITICAL NAMING:** All names in your output MUST be in EXACT camelCase format (e.g., "metricsSection", "companyLogo", "heroSection", "header", "footer").
 6.  **Always include a `page` document.**
 
 **Figma JSON Structure:**
-{json.dumps(sections_summary, indent=2)}
+{structure_format_note()}
+{serialize_structure(sections_summary)}
 
 **Your Output:**
 Return ONLY a valid JSON object with `documents` and `objects` keys. The values for these keys must be arrays of camelCase schema names. Do not include a 'blocks' key.
 
 **Remember: Header and Footer MUST be documents if they exist in the design.**
 """
+    return prompt
+
+
+SITE_SETTINGS_VARIANTS = {"sitesettings", "siteconfig", "globalsettings", "settings"}
+# Global objects that live in siteSettings rather than on pages.
+PAGE_BUILDER_EXCLUDED_OBJECTS = {"siteSettings", "header", "footer"}
+
+
+def page_builder_objects(plan: dict) -> List[str]:
+    """The planned section objects page.pageBuilder should offer."""
+    return [obj for obj in plan.get("objects", []) if obj not in PAGE_BUILDER_EXCLUDED_OBJECTS]
+
+
+def normalize_plan(raw_plan: dict, section_index: Dict[str, dict]) -> dict:
+    """
+    Normalizes a raw phase-one plan in one pass per category: camelCase,
+    deduplicated names; siteSettings variants folded into siteSettings; the
+    mandatory page/siteSettings documents; header/footer forced to documents
+    when the design has them.
+    """
+    plan = {}
+    for category in ["documents", "objects"]:
+        names = raw_plan.get(category) or []
+        plan[category] = {
+            to_camel_case(name) for name in names if isinstance(name, str) and name
+        }
+    documents, objects = plan["documents"], plan["objects"]
+    documents = {
+        "siteSettings" if name.lower() in SITE_SETTINGS_VARIANTS else name
+        for name in documents
+    }
+    documents |= {"page", "siteSettings"}
+    for section_name in section_index:
+        lowered = section_name.lower()
+        for fixed in ("header", "footer"):
+            if fixed in lowered:
+                documents.add(fixed)
+                objects.discard(fixed)
+                break
+    return {"documents": sorted(documents), "objects": sorted(objects)}
+
+
+def phase_one_architect_plan(
+    section_index: Dict[str, dict],
+    backend: ModelBackend,
+    llm_cache: Optional[LLMResponseCache] = None,
+) -> Optional[dict]:
+    logging.info("🤖 PHASE 1: Creating architectural plan from Figma JSON...")
+    prompt = build_plan_prompt(section_index)
+    logging.info(f"  Phase 1 prompt size: ~{estimate_tokens(prompt)} tokens.")
+    task = {"phase": "plan", "sections": list(section_index)}
+    if PLAN_STRUCTURED_OUTPUT:
+        task["generation_config"] = {
+            "response_mime_type": "application/json",
+            "response_schema": PLAN_RESPONSE_SCHEMA,
+        }
     logging.debug(
         f"\n--- PHASE 1: PROMPT SENT TO AI ---\n{prompt}\n---------------------------------"
     )
     try:
-        response = model.generate_content(prompt)
+        response_text = generate_text(
+            backend,
+            prompt,
+            llm_cache,
+            task=task,
+        )
         logging.debug(
-            f"\n--- PHASE 1: RAW AI RESPONSE ---\n{response.text}\n------------------------------"
+            f"\n--- PHASE 1: RAW AI RESPONSE ---\n{response_text}\n------------------------------"
         )
-        plan = extract_json_from_response(response.text)
-        if not plan:
+        raw_plan = parse_json_strict(response_text)
+        if isinstance(raw_plan, dict):
+            run_trace.annotate(parse="strict")
+        else:
+            logging.info("  Plan response is not strict JSON; repairing it.")
+            run_trace.annotate(parse="repair")
+            raw_plan = extract_json_from_response(response_text)
+        if not isinstance(raw_plan, dict):
             raise ValueError("Phase 1 response did not contain valid JSON.")
-
-        # Ensure all keys exist and normalize names to proper camelCase
-        for category in ["documents", "objects"]:
-            plan.setdefault(category, [])
-            plan[category] = sorted(
-                list(set([to_camel_case(name) for name in plan[category]]))
-            )
-
-        # Deduplicate siteSettings variants (critical fix)
-        sitesettings_variants = [
-            "siteSettings",
-            "siteConfig",
-            "globalSettings",
-            "settings",
-        ]
-        sitesettings_found = [
-            name
-            for name in plan["documents"]
-            if any(variant.lower() == name.lower() for variant in sitesettings_variants)
-        ]
-        if sitesettings_found:
-            # Remove all variants and add only "siteSettings"
-            for variant in sitesettings_found:
-                if variant in plan["documents"]:
-                    plan["documents"].remove(variant)
-            plan["documents"].append("siteSettings")
-
-        # Ensure essential documents exist
-        if "page" not in plan["documents"]:
-            plan["documents"].append("page")
-        if "siteSettings" not in plan["documents"]:
-            plan["documents"].append("siteSettings")
-
-        # Check if header/footer sections exist in Figma and ensure they're documents
-        section_names = [to_camel_case(section["name"]) for section in sections]
-        for section_name in section_names:
-            if "header" in section_name.lower():
-                if "header" not in plan["documents"]:
-                    plan["documents"].append("header")
-                # Remove from objects if it was incorrectly placed there
-                if "header" in plan["objects"]:
-                    plan["objects"].remove("header")
-            elif "footer" in section_name.lower():
-                if "footer" not in plan["documents"]:
-                    plan["documents"].append("footer")
-                # Remove from objects if it was incorrectly placed there
-                if "footer" in plan["objects"]:
-                    plan["objects"].remove("footer")
-
-        # Sort final lists
-        plan["documents"].sort()
-        plan["objects"].sort()
+        plan = normalize_plan(raw_plan, section_index)
 
         logging.info(f"✅ PHASE 1: Architectural plan received.")
         logging.debug(f"Plan details: {json.dumps(plan, indent=2)}")
@@ -261,38 +2160,41 @@ Return ONLY a valid JSON object with `documents` and `objects` keys. The values
         return None
 
 
-def phase_two_generate_schema_code(
-    schema_name: str, classification: str, plan: dict, sections: List[dict], model
-) -> Optional[str]:
-    logging.info(
-        f"  🤖 PHASE 2: Generating TypeScript code for '{schema_name}' ({classification})..."
-    )
-
-    all_objects = plan.get("objects", [])
-    all_documents = plan.get("documents", [])
-    page_builder_objects = [
-        obj for obj in all_objects if obj not in ["siteSettings", "header", "footer"]
-    ]
+def _schema_prompt_context(
+    schema_name: str, plan: dict, section_index: Dict[str, dict]
+) -> tuple:
+    """
+    The parts both phase-two prompts share: the schema's Figma structure and
+    its special instructions.
+    """
+    sections = page_builder_objects(plan)
 
-    relevant_section_json = next(
-        (
-            clean_node_for_ai(s["node"])
-            for s in sections
-            if to_camel_case(s["name"]) == schema_name
-        ),
-        None,
-    )
+    section_entry = section_index.get(schema_name)
     structure_info = (
-        json.dumps(relevant_section_json, indent=2)
-        if relevant_section_json
+        section_entry["structure_text"]
+        if section_entry and section_entry["structure_text"]
         else "No specific Figma structure found for this schema. Please generate a logical schema based on its name and classification."
     )
 
     special_instructions = ""
     if schema_name == "page":
-        special_instructions = f"**SPECIAL INSTRUCTION FOR 'page':** This document MUST contain a `pageBuilder` field of type `array`. The `of` property for this array should be an array of objects, where each object has a `type` referencing one of the page sections from this list: {page_builder_objects}."
+        special_instructions = f"**SPECIAL INSTRUCTION FOR 'page':** This document MUST contain a `pageBuilder` field of type `array`. The `of` property for this array should be an array of objects, where each object has a `type` referencing one of the page sections from this list: {sections}."
     elif schema_name == "siteSettings":
         special_instructions = "**SPECIAL INSTRUCTION FOR 'siteSettings':** This document must contain a `header` field of type `reference` to `header` document, and a `footer` field of type `reference` to `footer` document."
+    return structure_info, special_instructions
+
+
+def build_schema_prompt(
+    schema_name: str,
+    classification: str,
+    plan: dict,
+    section_index: Dict[str, dict],
+) -> str:
+    all_objects = plan.get("objects", [])
+    all_documents = plan.get("documents", [])
+    structure_info, special_instructions = _schema_prompt_context(
+        schema_name, plan, section_index
+    )
 
     # --- MODIFIED: Enhanced prompt with specific fixes for the identified issues ---
     prompt = f"""
@@ -408,351 +2310,1873 @@ preview: {{
 - Container or wrapper elements
 - Every single visual element you see
 
-### **Field Naming Convention:**
-- Use simple, clear names: `title`, `description`, `image`, `button`
-- Avoid verbose names like `primaryHeaderTitle`, `mainContentDescription`
+### **Field Naming Convention:**
+- Use simple, clear names: `title`, `description`, `image`, `button`
+- Avoid verbose names like `primaryHeaderTitle`, `mainContentDescription`
+
+---
+**Your Task:**
+Generate a MINIMAL, focused TypeScript schema for **`{schema_name}`** of type **'{classification}'** with ONLY essential content fields.
+
+**Figma Structure to Analyze:**
+(A node with `repeat: N` stands for N identical siblings; `sampleTexts` lists text from the collapsed ones; `omittedChildren: N` means N more children were left out for brevity.)
+{structure_format_note()}
+```{"text" if PROMPT_STRUCTURE_FORMAT == "outline" else "json"}
+{structure_info}
+```
+{special_instructions}
+
+**REMEMBER: The schema type MUST be '{classification}'. Focus on the CONTENT, not the visual design. Keep it simple and essential.**
+
+Output ONLY the raw TypeScript code. Do not wrap it in markdown backticks or add any explanation.
+"""
+    return prompt
+
+
+def build_schema_ir_prompt(
+    schema_name: str,
+    classification: str,
+    plan: dict,
+    section_index: Dict[str, dict],
+) -> str:
+    """
+    Phase-two prompt for PHASE_TWO_OUTPUT_FORMAT = "ir": the model describes
+    the schema as compact JSON and emit_schema_ts() writes the TypeScript, so
+    the Sanity syntax rules of the TypeScript prompt are not needed.
+    """
+    structure_info, special_instructions = _schema_prompt_context(
+        schema_name, plan, section_index
+    )
+    return f"""
+You are an expert Sanity.io schema designer. Describe the schema for **`{schema_name}`** as compact JSON; a compiler turns it into Sanity TypeScript.
+
+### Format
+{{"type": "{classification}", "fields": [FIELD, ...], "preview": {{"title": "<field>", "subtitle": "<field>", "media": "<field>"}}}}
+FIELD = {{"name": "camelCase", "type": "...", "i18n": true, "required": true, "of": [...], "to": [...], "fields": [FIELD, ...], "options": {{...}}}}
+- Omit every key you don't need. `title` is derived from `name`; add it only if the wording differs.
+- `type`: string, text, image, file, url, slug, number, boolean, date, datetime, array, object, reference, or a schema name listed below.
+- `i18n: true` on user-facing string, text, image, file, url and slug fields. Do not write internationalizedArray* type names.
+- `required: true` only for essential fields.
+- `of` (arrays only): schema names like ["heroSection"], or items like {{"type": "reference", "to": ["page"]}} or {{"type": "object", "name": "item", "fields": [...]}}. Never mix primitive items (url, string, number) with reference/object items.
+- `to` (references only): document names.
+- `fields` only on object fields.
+- `preview` (optional) names the fields to show.
+
+### Rules
+- This schema MUST be of type '{classification}'.
+- Only essential content fields: 3-5 fields unless absolutely necessary; nothing for styling, layout or decoration.
+- Simple field names (`title`, `description`, `image`, `button`), never `primaryHeaderTitle`-style names.
+- References don't need i18n.
+- Available Documents for References: {plan.get("documents", [])}
+- Available Objects for Embedding: {plan.get("objects", [])}
+{special_instructions}
+
+**Figma Structure to Analyze:**
+(A node with `repeat: N` stands for N identical siblings; `sampleTexts` lists text from the collapsed ones; `omittedChildren: N` means N more children were left out for brevity.)
+{structure_format_note()}
+```{"text" if PROMPT_STRUCTURE_FORMAT == "outline" else "json"}
+{structure_info}
+```
+
+Output ONLY the JSON object.
+"""
+
+
+def phase_two_generate_schema_code(
+    schema_name: str,
+    classification: str,
+    plan: dict,
+    section_index: Dict[str, dict],
+    backend: ModelBackend,
+    rate_limiter: Optional[TokenBucket] = None,
+    llm_cache: Optional[LLMResponseCache] = None,
+) -> Optional[str]:
+    """
+    Returns the raw phase-two response: TypeScript, or schema IR JSON when
+    PHASE_TWO_OUTPUT_FORMAT is "ir".
+    """
+    ir_mode = PHASE_TWO_OUTPUT_FORMAT == "ir"
+    output_name = "schema IR" if ir_mode else "TypeScript code"
+    logging.info(
+        f"  🤖 PHASE 2: Generating {output_name} for '{schema_name}' ({classification})..."
+    )
+
+    build_prompt = build_schema_ir_prompt if ir_mode else build_schema_prompt
+    prompt = build_prompt(schema_name, classification, plan, section_index)
+    task = {
+        "phase": "schema",
+        "name": schema_name,
+        "type": classification,
+        "plan": plan,
+        "format": PHASE_TWO_OUTPUT_FORMAT,
+    }
+    if ir_mode:
+        task["generation_config"] = {"response_mime_type": "application/json"}
+    logging.debug(
+        f"\n--- PHASE 2: PROMPT SENT TO AI for '{schema_name}' (~{estimate_tokens(prompt)} tokens) ---\n{prompt}\n----------------------------------"
+    )
+    try:
+        response_text = generate_text(
+            backend,
+            prompt,
+            llm_cache,
+            rate_limiter,
+            task=task,
+        )
+        logging.debug(
+            f"\n--- PHASE 2: RAW AI RESPONSE for '{schema_name}' ---\n{response_text}\n------------------------------"
+        )
+        if response_text:
+            logging.info(f" ✅ {output_name[:1].upper()}{output_name[1:]} for '{schema_name}' generated.")
+            return response_text
+        raise ValueError("AI returned an empty response.")
+    except BudgetExceededError:
+        logging.warning(f"  💸 Skipping '{schema_name}': token budget exhausted.")
+        return None
+    except Exception as e:
+        logging.error(
+            f"❌ Gemini Error during Phase 2 for '{schema_name}': {e}", exc_info=True
+        )
+        return None
+
+
+def _generate_schema(
+    info: dict,
+    plan: dict,
+    section_index: Dict[str, dict],
+    backend: ModelBackend,
+    rate_limiter: Optional[TokenBucket],
+    llm_cache: Optional[LLMResponseCache],
+    on_result: Optional[Callable[[dict], dict]],
+) -> Optional[dict]:
+    with run_trace.span("phase_two", schema=info["name"]):
+        code = phase_two_generate_schema_code(
+            info["name"], info["type"], plan, section_index, backend, rate_limiter, llm_cache
+        )
+    if not code:
+        return None
+    schema = {"name": info["name"], "type": info["type"], "code": code}
+    if PHASE_TWO_OUTPUT_FORMAT == "ir":
+        with run_trace.span("emit", schema=info["name"]):
+            emitted = schema_from_ir_response(
+                code, info, set(plan.get("documents", []) + plan.get("objects", []))
+            )
+        if not emitted:
+            return None
+        schema.update(emitted)
+    if not on_result:
+        return schema
+    try:
+        return on_result(schema)
+    except Exception as e:
+        logging.error(f"❌ Failed to process '{info['name']}': {e}", exc_info=True)
+        return None
+
+
+def generate_all_schema_code(
+    planned_schemas: List[dict],
+    plan: dict,
+    section_index: Dict[str, dict],
+    backend: ModelBackend,
+    concurrency: int = PHASE_TWO_CONCURRENCY,
+    requests_per_minute: float = GEMINI_REQUESTS_PER_MINUTE,
+    llm_cache: Optional[LLMResponseCache] = None,
+    on_result: Optional[Callable[[dict], dict]] = None,
+) -> List[dict]:
+    """
+    Runs phase two for every planned schema on a thread pool. When on_result is
+    given, each schema is handed to it as soon as its code arrives (on the same
+    worker), and its return value replaces the raw result. Each worker's logs
+    are buffered and flushed in plan order, and results keep plan order too.
+    """
+    rate_limiter = TokenBucket(requests_per_minute / 60, capacity=max(1, concurrency))
+    results: List[Optional[dict]] = [None] * len(planned_schemas)
+    task_args = (plan, section_index, backend, rate_limiter, llm_cache, on_result)
+    if concurrency <= 1:
+        for i, info in enumerate(planned_schemas):
+            results[i] = _generate_schema(info, *task_args)
+    else:
+        root_logger = logging.getLogger()
+        log_filter = _BufferedLogFilter()
+        root_logger.addFilter(log_filter)
+        buffered_logs: List[Optional[list]] = [None] * len(planned_schemas)
+        next_to_flush = 0
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                futures = {
+                    pool.submit(run_with_buffered_logs, _generate_schema, info, *task_args): i
+                    for i, info in enumerate(planned_schemas)
+                }
+                for future in as_completed(futures):
+                    i = futures[future]
+                    results[i], buffered_logs[i] = future.result()
+                    while (
+                        next_to_flush < len(planned_schemas)
+                        and buffered_logs[next_to_flush] is not None
+                    ):
+                        for record in buffered_logs[next_to_flush]:
+                            root_logger.handle(record)
+                        buffered_logs[next_to_flush] = []
+                        next_to_flush += 1
+        finally:
+            root_logger.removeFilter(log_filter)
+    return [schema for schema in results if schema]
+
+
+def estimate_run(
+    section_index: Dict[str, dict],
+    concurrency: int = PHASE_TWO_CONCURRENCY,
+    requests_per_minute: float = GEMINI_REQUESTS_PER_MINUTE,
+) -> dict:
+    """
+    Builds the phase-one prompt and every phase-two prompt for the heuristic
+    plan without calling the model, and projects tokens, cost and wall-clock
+    time. Phase two is simulated as `concurrency` workers behind the same
+    token bucket the real run uses.
+    """
+    plan = heuristic_plan(list(section_index))
+    plan_tokens = estimate_tokens(build_plan_prompt(section_index))
+    if PHASE_TWO_OUTPUT_FORMAT == "ir":
+        build_prompt, schema_output_tokens = build_schema_ir_prompt, DRY_RUN_SCHEMA_IR_OUTPUT_TOKENS
+    else:
+        build_prompt, schema_output_tokens = build_schema_prompt, DRY_RUN_SCHEMA_OUTPUT_TOKENS
+    schemas = []
+    for name in plan["documents"] + plan["objects"]:
+        schema_type = "document" if name in plan["documents"] else "object"
+        prompt = build_prompt(name, schema_type, plan, section_index)
+        entry = section_index.get(name) or {}
+        schemas.append(
+            {
+                "name": name,
+                "type": schema_type,
+                "prompt_tokens": estimate_tokens(prompt),
+                "structure_tokens": entry.get("tokens", 0),
+                "detail_level": entry.get("detail_level", 0),
+            }
+        )
+
+    def call_seconds(output_tokens: int) -> float:
+        return DRY_RUN_CALL_OVERHEAD_SECONDS + output_tokens / DRY_RUN_OUTPUT_TOKENS_PER_SECOND
+
+    # Greedy schedule: each call starts when a worker is free and the token
+    # bucket (bursting up to `concurrency`) has a token for it.
+    workers = [0.0] * max(1, concurrency)
+    interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+    burst = max(1, concurrency)
+    phase_two_seconds = 0.0
+    for i, _ in enumerate(schemas):
+        worker = min(range(len(workers)), key=workers.__getitem__)
+        start = max(workers[worker], max(0, i - burst + 1) * interval)
+        workers[worker] = start + call_seconds(schema_output_tokens)
+        phase_two_seconds = max(phase_two_seconds, workers[worker])
+
+    input_tokens = plan_tokens + sum(s["prompt_tokens"] for s in schemas)
+    output_tokens = DRY_RUN_PLAN_OUTPUT_TOKENS + schema_output_tokens * len(schemas)
+    return {
+        "plan": plan,
+        "plan_prompt_tokens": plan_tokens,
+        "schemas": schemas,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cost_usd": UsageLedger.cost(input_tokens, output_tokens),
+        "plan_seconds": call_seconds(DRY_RUN_PLAN_OUTPUT_TOKENS),
+        "phase_two_seconds": phase_two_seconds,
+        "needs_splitting": [
+            s["name"] for s in schemas if s["detail_level"] > 0
+        ],
+    }
+
+
+def log_dry_run_report(estimate: dict, concurrency: int):
+    lines = [
+        f"{'schema':<28}{'type':<10}{'prompt tok':>11}{'structure tok':>15}",
+        f"{'(plan)':<28}{'':<10}{estimate['plan_prompt_tokens']:>11}{'':>15}",
+    ]
+    for s in sorted(estimate["schemas"], key=lambda s: -s["prompt_tokens"]):
+        flag = "  ⚠️ trimmed" if s["detail_level"] > 0 else ""
+        lines.append(
+            f"{s['name']:<28}{s['type']:<10}{s['prompt_tokens']:>11}{s['structure_tokens']:>15}{flag}"
+        )
+    logging.info("\n--- 🧮 DRY RUN ESTIMATE ---\n" + "\n".join(lines))
+    total_seconds = estimate["plan_seconds"] + estimate["phase_two_seconds"]
+    logging.info(
+        f"   {1 + len(estimate['schemas'])} model call(s): ~{estimate['input_tokens']:,} input + "
+        f"~{estimate['output_tokens']:,} output tokens ≈ ${estimate['cost_usd']:.4f} ({GEMINI_MODEL_NAME})."
+    )
+    logging.info(
+        f"   Projected wall-clock: ~{total_seconds:.0f}s at concurrency {concurrency} "
+        f"(plan ~{estimate['plan_seconds']:.0f}s, phase two ~{estimate['phase_two_seconds']:.0f}s)."
+    )
+    if estimate["needs_splitting"]:
+        logging.warning(
+            f"   ⚠️  {len(estimate['needs_splitting'])} section(s) exceed the "
+            f"{PHASE_TWO_TOKEN_BUDGET}-token phase-two budget and were trimmed; consider "
+            f"splitting them in Figma: {', '.join(estimate['needs_splitting'])}"
+        )
+    logging.info(
+        "   Estimates assume the plan keeps one object per section; grid splits add calls."
+    )
+
+
+# --- 📜 5. SANITY FILE GENERATOR & CORRECTION ---
+
+
+# --- NEW: Comprehensive Correction Function ---
+# Built-in Sanity types never need their casing corrected.
+BUILT_IN_TYPES = {
+    "string",
+    "text",
+    "image",
+    "file",
+    "url",
+    "slug",
+    "number",
+    "boolean",
+    "array",
+    "object",
+    "reference",
+    "block",
+    "date",
+    "datetime",
+}
+# Available i18n types are String, Text, Image, File, Url and Slug.
+INVALID_I18N_TYPES = {
+    "internationalizedArrayOfPortableText": "internationalizedArrayText",
+    "internationalizedArrayPortableText": "internationalizedArrayText",
+    "internationalizedArrayRichText": "internationalizedArrayText",
+    "internationalizedArrayBlock": "internationalizedArrayText",
+    "internationalizedArrayContent": "internationalizedArrayText",
+    "internationalizedArrayArray": "internationalizedArrayText",
+    "internationalizedArrayReference": "reference",
+    "internationalizedArrayCrossDatasetReference": "crossDatasetReference",
+    "internationalizedArrayDocument": "reference",
+}
+# Anti-over-engineering: verbose field names collapse to the simple ones.
+VERBOSE_FIELD_NAMES = {
+    "primarytitle": "title",
+    "maintitle": "title",
+    "headertitle": "title",
+    "sectiontitle": "title",
+    "primarydescription": "description",
+    "maindescription": "description",
+    "sectiondescription": "description",
+    "primarytext": "text",
+    "maintext": "text",
+    "heroimage": "image",
+    "mainimage": "image",
+    "primaryimage": "image",
+    "featuredimage": "image",
+}
+I18N_NO_FIELDS_TYPES = {"internationalizedArrayImage", "internationalizedArrayFile"}
+I18N_NO_OF_TYPES = {
+    "internationalizedArrayText",
+    "internationalizedArrayString",
+    "internationalizedArrayUrl",
+    "internationalizedArraySlug",
+}
+URL_OBJECT_FIELDS = 'fields: [defineField({name: "url", title: "URL", type: "url", validation: (Rule) => Rule.required()})],'
+
+_MARKDOWN_OPEN_RE = re.compile(r"^```(?:typescript|javascript|ts|js)?\s*", re.MULTILINE)
+# The lookbehind pins the match to the start of a whitespace run; a bare
+# leading \s* retries from every position in the run and goes quadratic.
+_MARKDOWN_CLOSE_RE = re.compile(r"(?<!\s)\s*```\s*$", re.MULTILINE)
+# Every rewrite rule is one named branch of a single alternation, so the code
+# is scanned once; specific branches come before the generic ones they share
+# a prefix with.
+_CORRECTION_RE = re.compile(
+    # The lookahead lists each branch's first character, so positions that
+    # cannot start a match are skipped without trying every branch.
+    r"(?=[;(otni])(?:"
+    + "|".join(
+        [
+            r"(?P<stray_markdown>;```\w*\s*)",
+            r"(?P<validation>\(Rule:\s*[A-Za-z_][A-Za-z0-9_]*\))",
+            r"(?P<define_in_array>of:\s*\[\s*defineType\s*\(\s*\{)",
+            r"(?P<missing_type>of:\s*\[\s*\{\s*(?P<mt_q>['\"])(?P<mt_name>[^'\"]+)(?P=mt_q)\s*\}\s*\])",
+            r"(?P<array>of:\s*\[)",
+            r"(?P<type>type:\s*(?P<t_q>['\"])(?P<t_value>[^'\"]+)(?P=t_q))",
+            r"(?P<verbose>name:\s*['\"](?P<v_name>(?i:primary|main|header|section|hero|featured)(?i:title|description|text|image))['\"])",
+            r"(?P<invalid_i18n>\binternationalizedArray(?:OfPortableText|PortableText|RichText|Block|Content|Array|Reference|CrossDatasetReference|Document)\b)",
+        ]
+    )
+    + ")"
+)
+_FIELDS_KEY_RE = re.compile(r",\s*fields:\s*\[")
+_OF_KEY_RE = re.compile(r",\s*of:\s*\[")
+_FLAT_TAIL_RE = re.compile(r"[^{}'\"`]*\}")
+_ITEM_TYPE_RE = re.compile(r"type:\s*['\"]([^'\"]+)['\"]")
+_ARRAY_OPEN_RE = re.compile(r"of:\s*\[")
+_NAME_KEY_RE = re.compile(r"\bname:\s*['\"][^'\"]+['\"]")
+# What CorrectionEngine._needs_tree looks for before parsing. No leading \b:
+# it stops re from skipping ahead to the literal, which costs 10x here.
+_SINGLE_STRING_OBJECT_RE = re.compile(r"\{\s*(?:/[/*]|(['\"])[^'\"\n]*\1\s*,?\s*\})")
+_DEFINE_TYPE_CALL_RE = re.compile(r"defineType\s*\(")
+_ROOT_OBJECT_RE = re.compile(r"define(?:Type|Field|ArrayMember)\s*\(\s*\{|(?:default|=)\s*\{")
+_OPENER_RE = re.compile(r"[{\[(]")
+_I18N_KEYED_TYPE_RE = re.compile(r"type:\s*['\"]internationalizedArray(Image|File|Text|String|Url|Slug)['\"]")
+_I18N_KEY_RE = re.compile(r"\s*(?:fields|of)\s*:")
+_FIRST_I18N_KEY_RES = {"fields": re.compile(r"fields\s*:"), "of": re.compile(r"of\s*:")}
+_TITLE_KEY_RE = re.compile(r"\btitle:\s*['\"][^'\"]+['\"]")
+
+
+_BRACKET_TOKEN_RE = re.compile(r"[{}\[\]()'\"`\\]")
+_WALK_TOKEN_RE = re.compile(r"[{\[('\"`,]|type")
+
+
+class _BracketIndex:
+    """
+    One linear pass over the code that records string spans and matches
+    brackets with a stack. "Which literal is position p inside, and where does
+    it close?" is then one bisect and a lookup instead of a fresh scan, which
+    is what keeps the rules linear on unbalanced or deeply nested model output.
+    Only flat lists of ints and one dict are built, however deep the nesting.
+    """
+
+    def __init__(self, code: str):
+        self.code = code
+        self.length = len(code)
+        self.string_ends: Dict[int, int] = {}
+        # Every bracket in order, and the literal open just after it (-1 at top level).
+        self._event_positions: List[int] = []
+        self._event_opens: List[int] = []
+        self._closes: Dict[int, int] = {}
+        self._keys: Dict[tuple, List[int]] = {}
+        self._array_items: Optional[Dict[int, List[tuple]]] = None
+        stack: List[int] = []
+        quote_start = None
+        escaped_at = -1
+        for match in _BRACKET_TOKEN_RE.finditer(code):
+            i = match.start()
+            char = code[i]
+            if quote_start is not None:
+                if i == escaped_at:
+                    continue
+                if char == "\\":
+                    escaped_at = i + 1
+                elif char == code[quote_start]:
+                    self.string_ends[quote_start] = i + 1
+                    quote_start = None
+            elif char in "'\"`":
+                quote_start = i
+            elif char in "{[(":
+                stack.append(i)
+                self._event_positions.append(i)
+                self._event_opens.append(i)
+            elif char in "}])":
+                if stack:
+                    self._closes[stack.pop()] = i
+                self._event_positions.append(i)
+                self._event_opens.append(stack[-1] if stack else -1)
+        if quote_start is not None:
+            self.string_ends[quote_start] = self.length
+        self._string_starts = list(self.string_ends)
+
+    def open_of(self, position: int) -> int:
+        """Index of the bracket opening the literal `position` is inside; -1 at top level."""
+        event = bisect.bisect_left(self._event_positions, position) - 1
+        return self._event_opens[event] if event >= 0 else -1
+
+    def close_of(self, position: int) -> int:
+        """
+        Index of the bracket closing the literal `position` is inside;
+        len(code) if it never closes or `position` is at the top level.
+        """
+        return self._closes.get(self.open_of(position), self.length)
+
+    def in_string(self, position: int) -> bool:
+        found = bisect.bisect_right(self._string_starts, position) - 1
+        return found >= 0 and position < self.string_ends[self._string_starts[found]]
+
+    def string_end(self, position: int) -> int:
+        """Index just past the string opened at `position` (or position + 1)."""
+        return self.string_ends.get(position, position + 1)
+
+    def top_level(self, start: int, end: int):
+        """
+        Yields (position, token) for each opener, quote, comma and `type` at
+        the top level of start..end, jumping over nested literals and strings.
+        """
+        position = start
+        while position < end:
+            match = _WALK_TOKEN_RE.search(self.code, position, end)
+            if not match:
+                return
+            position = match.start()
+            token = match.group()
+            yield position, token
+            if token in "{[(":
+                position = self.close_of(position + 1) + 1
+            elif token in "'\"`":
+                position = self.string_end(position)
+            else:
+                position = match.end()
+
+    def find_key(self, position: int, key_re: "re.Pattern") -> Optional["re.Match"]:
+        """
+        First top-level `, key: [` of the object holding `position`, after it.
+        Key positions are collected once per object, so a run of matches
+        inside one object does not rescan it.
+        """
+        object_end = self.close_of(position)
+        cache_key = (self.open_of(position), key_re.pattern)
+        keys = self._keys.get(cache_key)
+        if keys is None:
+            keys = [
+                i
+                for i, token in self.top_level(position, object_end)
+                if token == "," and key_re.match(self.code, i)
+            ]
+            self._keys[cache_key] = keys
+        found = bisect.bisect_left(keys, position)
+        return key_re.match(self.code, keys[found]) if found < len(keys) else None
+
+    def array_items(self) -> Dict[int, List[tuple]]:
+        """
+        (start, end, type) of each typed `{...}` item of every `of: [` array,
+        keyed by the index just past the `[`. Built once from the `type:`
+        matches, so it costs the same however many arrays there are or how
+        deeply they nest. Only an item's own top-level `type:` counts, not a
+        nested field's.
+        """
+        if self._array_items is None:
+            arrays = {match.end() for match in _ARRAY_OPEN_RE.finditer(self.code)}
+            items: Dict[int, List[tuple]] = {}
+            typed = set()
+            for match in _ITEM_TYPE_RE.finditer(self.code):
+                item = self.open_of(match.start())
+                if item < 0 or item in typed or self.code[item] != "{":
+                    continue
+                array = self.open_of(item)
+                if array + 1 not in arrays or self.in_string(match.start()):
+                    continue
+                typed.add(item)
+                items.setdefault(array + 1, []).append(
+                    (item, self.close_of(item + 1), match.group(1))
+                )
+            self._array_items = items
+        return self._array_items
+
+
+# --- Schema tree: tokenizer, parser and printer for the defineType subset ---
+
+
+class TsParseError(ValueError):
+    """Raised when generated code falls outside the subset _TsParser understands."""
+
+
+_TS_TOKEN_RE = re.compile(
+    r"""
+    (?P<ws>\s+)
+    | (?P<comment>//[^\n]*|/\*.*?\*/)
+    | (?P<string>'(?:[^'\\\n]|\\.)*'|"(?:[^"\\\n]|\\.)*")
+    | (?P<template>`(?:[^`\\]|\\.)*`)
+    | (?P<number>\d[\w.]*)
+    | (?P<ident>[A-Za-z_$][\w$]*)
+    | (?P<bad>['"`]|/\*)
+    | (?P<punct>=>|\.\.\.|\?\.|[^\s\w])
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+_TS_REGEX_LITERAL_RE = re.compile(r"/(?:[^/\\\n\[]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[a-z]*")
+_TS_REGEX_AFTER = {"(", ",", "=", ":", "[", "!", "&", "|", "?", "{", "}", ";", "=>", "return", "typeof"}
+_STRAY_MARKDOWN_RE = re.compile(r";```\w*\s*")
+_RULE_PARAM_RE = re.compile(r"\(Rule:\s*[A-Za-z_][A-Za-z0-9_]*\)")
+_INVALID_I18N_RE = re.compile(
+    r"\binternationalizedArray(?:OfPortableText|PortableText|RichText|Block|Content|Array|Reference|CrossDatasetReference|Document)\b"
+)
+
+
+def _tokenize_ts(code: str) -> List[tuple]:
+    """
+    Splits TypeScript into (kind, text, start, end, newline_before) tokens,
+    dropping whitespace. A '/' starts a regex literal only where a value may
+    start, judged by the previous token as a JS lexer does.
+    """
+    tokens: List[tuple] = []
+    position = 0
+    newline = False
+    previous = None
+    length = len(code)
+    while position < length:
+        for match in _TS_TOKEN_RE.finditer(code, position):
+            kind = match.lastgroup
+            text = match.group()
+            start = match.start()
+            if kind == "ws":
+                newline = newline or "\n" in text
+                continue
+            if kind == "bad":
+                raise TsParseError(f"unterminated string or comment at offset {start}")
+            if text == "/" and (previous is None or previous in _TS_REGEX_AFTER):
+                literal = _TS_REGEX_LITERAL_RE.match(code, start)
+                if literal:
+                    tokens.append(("regex", literal.group(), start, literal.end(), newline))
+                    newline = False
+                    previous = "regex"
+                    position = literal.end()
+                    break  # Resume tokenizing after the literal
+            tokens.append((kind, text, start, match.end(), newline))
+            newline = False
+            if kind != "comment":
+                previous = text
+        else:
+            break
+    return tokens
+
+
+class TsNode:
+    """
+    Base of the schema tree. Comments on their own lines before a node are
+    kept in `comments`; one on the same line after it in `trailing_comment`.
+    """
+
+    def __init__(self):
+        self.comments: List[str] = []
+        self.trailing_comment: Optional[str] = None
+
+
+class TsRaw(TsNode):
+    """Source kept verbatim: functions, identifiers, numbers, expressions."""
+
+    def __init__(self, text: str, source_indent: Optional[int] = 0):
+        super().__init__()
+        self.text = text
+        # Indent of the source line the text started on; continuation lines
+        # keep their offset from it. None keeps the text as is (multi-line
+        # template literals).
+        self.source_indent = source_indent
+
+
+class TsString(TsNode):
+    def __init__(self, text: str):
+        super().__init__()
+        self.text = text
+
+    @classmethod
+    def quoted(cls, value: str) -> "TsString":
+        escaped = value.replace("\\", "\\\\").replace("'", "\\'").replace("\n", "\\n")
+        return cls(f"'{escaped}'")
+
+    @property
+    def value(self) -> str:
+        return self.text[1:-1]
+
+    @value.setter
+    def value(self, value: str):
+        self.text = f"{self.text[0]}{value}{self.text[0]}"
+
+
+class TsEntry(TsNode):
+    """`key: value`; key is None for shorthand, spread and method entries."""
+
+    def __init__(self, key: Optional[str], value: TsNode):
+        super().__init__()
+        self.key = key
+        self.value = value
+
+    @property
+    def name(self) -> Optional[str]:
+        if self.key and self.key[0] in "'\"":
+            return self.key[1:-1]
+        return self.key
+
+
+class TsObject(TsNode):
+    def __init__(self, entries: Optional[List[TsEntry]] = None, multiline: bool = False):
+        super().__init__()
+        self.entries = entries or []
+        self.trailing_comments: List[str] = []
+        self.multiline = multiline
+
+    def get(self, key: str) -> Optional[TsNode]:
+        for entry in self.entries:
+            if entry.name == key:
+                return entry.value
+        return None
+
+    def string(self, key: str) -> Optional[str]:
+        value = self.get(key)
+        return value.value if isinstance(value, TsString) else None
+
+    def remove(self, key: str) -> bool:
+        kept = [entry for entry in self.entries if entry.name != key]
+        removed = len(kept) != len(self.entries)
+        self.entries = kept
+        return removed
+
+
+class TsArray(TsNode):
+    def __init__(self, items: Optional[List[TsNode]] = None, multiline: bool = False):
+        super().__init__()
+        self.items = items or []
+        self.trailing_comments: List[str] = []
+        self.multiline = multiline
 
----
-**Your Task:**
-Generate a MINIMAL, focused TypeScript schema for **`{schema_name}`** of type **'{classification}'** with ONLY essential content fields.
 
-**Figma Structure to Analyze:**
-```json
-{structure_info}
-```
-{special_instructions}
+class TsCall(TsNode):
+    """A defineType/defineField/defineArrayMember call."""
 
-**REMEMBER: The schema type MUST be '{classification}'. Focus on the CONTENT, not the visual design. Keep it simple and essential.**
+    def __init__(self, callee: str, args: Optional[List[TsNode]] = None):
+        super().__init__()
+        self.callee = callee
+        self.args = args or []
+        self.trailing_comments: List[str] = []
 
-Output ONLY the raw TypeScript code. Do not wrap it in markdown backticks or add any explanation.
-"""
-    logging.debug(
-        f"\n--- PHASE 2: PROMPT SENT TO AI for '{schema_name}' ---\n{prompt}\n----------------------------------"
-    )
-    try:
-        time.sleep(1.2)  # Rate limiting
-        response = model.generate_content(prompt)
-        logging.debug(
-            f"\n--- PHASE 2: RAW AI RESPONSE for '{schema_name}' ---\n{response.text}\n------------------------------"
-        )
-        if response.text:
-            logging.info(f" ✅ TypeScript code for '{schema_name}' generated.")
-            return response.text
-        raise ValueError("AI returned an empty response.")
-    except Exception as e:
-        logging.error(
-            f"❌ Gemini Error during Phase 2 for '{schema_name}': {e}", exc_info=True
-        )
-        return None
 
+class TsModule:
+    """The file as alternating verbatim source chunks (str) and parsed trees."""
 
-# --- 📜 5. SANITY FILE GENERATOR & CORRECTION ---
+    def __init__(self, parts: List[Any]):
+        self.parts = parts
 
+    def trees(self) -> List[TsNode]:
+        return [part for part in self.parts if isinstance(part, TsNode)]
 
-# --- NEW: Comprehensive Correction Function ---
-def correct_generated_code(
-    code: str, all_valid_names: Set[str], expected_type: str = None
-) -> str:
+
+class _TsParser:
     """
-    Applies a series of corrections to the AI-generated code to fix common, predictable errors.
+    Recursive-descent parser for the object-literal subset the model emits.
+    Objects, arrays, strings and define* calls become tree nodes; any other
+    value is kept as TsRaw up to the next top-level ',' or closing bracket.
+    Each token is consumed once (a value that turns out not to end at a ','
+    or closer is re-read as raw once), so parsing is linear in the input.
     """
-    original_code = code
-    corrections_applied = []
-
-    # Correction 0: Remove markdown formatting from generated code
-    # Pattern: ```typescript or ```javascript or ``` at start/end of code
-    if code.startswith("```") or code.endswith("```"):
-        # Remove markdown code blocks
-        code = re.sub(
-            r"^```(?:typescript|javascript|ts|js)?\s*", "", code, flags=re.MULTILINE
-        )
-        code = re.sub(r"\s*```\s*$", "", code, flags=re.MULTILINE)
-        corrections_applied.append("removed markdown formatting")
-
-    # Also remove any stray markdown that might be in the middle
-    if re.search(r";```\w*", code):
-        code = re.sub(r";```\w*\s*", "", code)
-        corrections_applied.append("removed stray markdown syntax")
-
-    # Correction 0.5: Fix incorrect schema type (CRITICAL FIX for the main issue)
-    if expected_type:
-        # Find current type declaration
-        type_pattern = r"type:\s*['\"]([^'\"]+)['\"]"
-        type_match = re.search(type_pattern, code)
-        if type_match:
-            current_type = type_match.group(1)
-            if current_type != expected_type:
-                # Replace the type with the expected type
-                code = re.sub(type_pattern, f"type: '{expected_type}'", code)
-                corrections_applied.append(
-                    f"schema type: '{current_type}' → '{expected_type}'"
-                )
 
-    # Correction 1: Fix incorrect validation function typing, e.g., (Rule: Rule) -> (Rule)
-    validation_pattern = r"\(Rule:\s*[A-Za-z_][A-Za-z0-9_]*\)"
-    code = re.sub(validation_pattern, r"(Rule)", code)
-    if original_code != code:
-        corrections_applied.append("validation function syntax (Rule: Rule) → (Rule)")
-
-    # Correction 2: Fix defineType inside array 'of' properties
-    # Pattern: of: [ defineType({ ... }) ] -> of: [ { ... } ]
-    defineType_in_array_pattern = r"of:\s*\[\s*defineType\s*\(\s*\{"
-    if re.search(defineType_in_array_pattern, code):
-        code = re.sub(r"of:\s*\[\s*defineType\s*\(\s*\{", "of: [{", code)
-        # Also fix the closing: }),] -> },]
-        code = re.sub(r"\}\s*\)\s*,?\s*\]", "}]", code)
-        corrections_applied.append("defineType inside arrays → plain objects")
-
-    # Correction 3: Fix missing 'type:' property in array items
-    # Pattern: of: [{'typeName'}] -> of: [{type: 'typeName'}]
-    missing_type_pattern = r"of:\s*\[\s*\{\s*['\"]([^'\"]+)['\"]\s*\}\s*\]"
-    if re.search(missing_type_pattern, code):
-        code = re.sub(missing_type_pattern, r"of: [{type: '\1'}]", code)
-        corrections_applied.append("added missing 'type:' property in array items")
-
-    # Correction 4: Remove 'fields' property from internationalizedArray image types
-    # Pattern: type: 'internationalizedArrayImage', ... fields: [...] -> type: 'internationalizedArrayImage', ...
-    i18n_image_fields_pattern = r"(type:\s*['\"]internationalizedArray(Image|File)['\"][^}]*?),\s*fields:\s*\[[^\]]*?\]"
-    if re.search(i18n_image_fields_pattern, code, re.DOTALL):
-        code = re.sub(i18n_image_fields_pattern, r"\1", code, flags=re.DOTALL)
-        corrections_applied.append("removed 'fields' from internationalizedArray type")
-
-    # Correction 5: Remove 'of' property from internationalizedArray text/array types
-    # Pattern: type: 'internationalizedArrayText', ... of: [...] -> type: 'internationalizedArrayText', ...
-    i18n_array_of_pattern = r"(type:\s*['\"]internationalizedArray(?:Text|String|Url|Slug)['\"][^}]*?),\s*of:\s*\[[^\]]*?\]"
-    if re.search(i18n_array_of_pattern, code, re.DOTALL):
-        code = re.sub(i18n_array_of_pattern, r"\1", code, flags=re.DOTALL)
-        corrections_applied.append("removed 'of' from internationalizedArray type")
-
-    # Correction 6: Fix type name casing (existing logic)
-    name_map = {name.lower(): name for name in all_valid_names}
-    type_corrections = []
-
-    def replace_type_reference(match):
-        quote_char = match.group(1)
-        type_name = match.group(2)
-        # Skip correcting built-in types or i18n types
-        built_in_types = {
-            "string",
-            "text",
-            "image",
-            "file",
-            "url",
-            "slug",
-            "number",
-            "boolean",
-            "array",
-            "object",
-            "reference",
-            "block",
-            "date",
-            "datetime",
-        }
-        if type_name in built_in_types or "internationalizedArray" in type_name:
-            return match.group(0)
+    DEFINE_CALLS = {"defineType", "defineField", "defineArrayMember"}
+
+    def __init__(self, code: str):
+        self.code = code
+        self.tokens = _tokenize_ts(code)
+        self.position = 0
+        self.depth = 0
+
+    def _peek(self, offset: int = 0) -> Optional[tuple]:
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else None
+
+    def _is(self, token: Optional[tuple], *texts: str) -> bool:
+        return token is not None and token[0] == "punct" and token[1] in texts
+
+    def _expect(self, text: str):
+        token = self._peek()
+        if not self._is(token, text):
+            found = token[1] if token else "end of file"
+            raise TsParseError(f"expected '{text}' but found '{found}'")
+        self.position += 1
+        return token
+
+    def _enter(self):
+        self.depth += 1
+        if self.depth > TS_MAX_NESTING:
+            raise TsParseError(f"nesting deeper than {TS_MAX_NESTING}")
+
+    def parse_module(self) -> TsModule:
+        parts: List[Any] = []
+        chunk_start = 0
+        while self.position < len(self.tokens):
+            token = self.tokens[self.position]
+            if not self._starts_tree():
+                self.position += 1
+                continue
+            parts.append(self.code[chunk_start : token[2]])
+            parts.append(self.parse_value(at_module_level=True))
+            chunk_start = self.tokens[self.position - 1][3]
+        parts.append(self.code[chunk_start:])
+        module = TsModule(parts)
+        if not module.trees():
+            raise TsParseError("no defineType/defineField call or exported object")
+        return module
+
+    def _starts_tree(self) -> bool:
+        token = self._peek()
+        if token[0] == "ident" and token[1] in self.DEFINE_CALLS:
+            return self._is(self._peek(1), "(")
+        if self._is(token, "{", "[") and self.position > 0:
+            previous = self.tokens[self.position - 1]
+            return previous[1] in ("default", "=")
+        return False
+
+    def _at_value_end(self) -> bool:
+        offset = 0
+        while True:
+            token = self._peek(offset)
+            if token is None:
+                return False
+            if token[0] != "comment":
+                return self._is(token, ",", "}", "]", ")")
+            offset += 1
+
+    def parse_value(self, at_module_level: bool = False) -> TsNode:
+        start = self.position
+        token = self._peek()
+        if token is None:
+            raise TsParseError("expected a value but found end of file")
+        if self._is(token, "{"):
+            node = self._parse_object()
+        elif self._is(token, "["):
+            node = self._parse_array()
+        elif token[0] == "ident" and token[1] in self.DEFINE_CALLS and self._is(self._peek(1), "("):
+            node = self._parse_call()
+        elif token[0] == "string":
+            node = TsString(token[1])
+            self.position += 1
+        else:
+            return self._parse_raw()
+        if at_module_level or self._at_value_end():
+            return node
+        # Part of a larger expression (`{...} as const`, `'a' + b`): keep it raw.
+        self.position = start
+        return self._parse_raw()
+
+    def _parse_raw(self) -> TsRaw:
+        start = self.position
+        depth = 0
+        last = None
+        line_start = self.code.rfind("\n", 0, self.tokens[start][2]) + 1
+        line = self.code[line_start : self.tokens[start][2]]
+        source_indent: Optional[int] = len(line) - len(line.lstrip(" "))
+        while self.position < len(self.tokens):
+            kind, text = self.tokens[self.position][:2]
+            if kind == "punct":
+                if text in ("{", "[", "("):
+                    depth += 1
+                elif text in ("}", "]", ")"):
+                    if depth == 0:
+                        break
+                    depth -= 1
+                elif text == "," and depth == 0:
+                    break
+            elif kind == "template" and "\n" in text:
+                source_indent = None
+            if kind != "comment":
+                last = self.position
+            self.position += 1
+        if depth or self.position >= len(self.tokens):
+            raise TsParseError("unterminated value")
+        if last is None:
+            raise TsParseError(f"expected a value but found '{self.tokens[start][1]}'")
+        # Trailing comments belong to the container, not inside the raw text.
+        self.position = last + 1
+        return TsRaw(self.code[self.tokens[start][2] : self.tokens[last][3]], source_indent)
+
+    def _collect_comments(self, siblings: List[TsNode]) -> List[str]:
+        leading = []
+        while True:
+            token = self._peek()
+            if token is None or token[0] != "comment":
+                return leading
+            if siblings and not token[4] and not leading:
+                previous = siblings[-1]
+                previous.trailing_comment = " ".join(filter(None, [previous.trailing_comment, token[1]]))
+            else:
+                leading.append(token[1])
+            self.position += 1
+
+    def _parse_items(self, closer: str, parse_item: Callable[[], TsNode], container) -> List[TsNode]:
+        self._enter()
+        items: List[TsNode] = []
+        while True:
+            comments = self._collect_comments(items)
+            if self._peek() is None:
+                raise TsParseError(f"expected '{closer}' but found end of file")
+            if self._is(self._peek(), closer):
+                container.trailing_comments = comments
+                self.position += 1
+                self.depth -= 1
+                return items
+            item = parse_item()
+            item.comments = comments
+            items.append(item)
+            token = self._peek()
+            while token is not None and token[0] == "comment" and not token[4]:
+                self._collect_comments(items)
+                token = self._peek()
+            if self._is(token, ","):
+                self.position += 1
+            elif not self._is(token, closer):
+                found = token[1] if token else "end of file"
+                raise TsParseError(f"expected ',' or '{closer}' but found '{found}'")
+
+    def _parse_object(self) -> TsObject:
+        self._expect("{")
+        node = TsObject(multiline=bool(self._peek() and self._peek()[4]))
+        node.entries = self._parse_items("}", self._parse_entry, node)
+        return node
+
+    def _parse_entry(self) -> TsEntry:
+        token = self._peek()
+        following = self._peek(1)
+        if token[0] in ("ident", "string", "number"):
+            if self._is(following, ":"):
+                self.position += 2
+                return TsEntry(token[1], self.parse_value())
+            if self._is(following, ",", "}"):
+                self.position += 1
+                value = TsString(token[1]) if token[0] == "string" else TsRaw(token[1])
+                return TsEntry(None, value)
+        # Method shorthand, spread or computed key: keep the whole entry as text.
+        return TsEntry(None, self._parse_raw())
+
+    def _parse_array(self) -> TsArray:
+        self._expect("[")
+        node = TsArray(multiline=bool(self._peek() and self._peek()[4]))
+        node.items = self._parse_items("]", self.parse_value, node)
+        return node
+
+    def _parse_call(self) -> TsCall:
+        callee = self.tokens[self.position][1]
+        self.position += 1
+        self._expect("(")
+        node = TsCall(callee)
+        node.args = self._parse_items(")", self.parse_value, node)
+        return node
+
+
+def parse_schema_code(code: str) -> TsModule:
+    """Parses generated schema code into a TsModule; raises TsParseError."""
+    return _TsParser(code).parse_module()
+
+
+class _TsPrinter:
+    """
+    Prints a schema tree back to TypeScript. A container stays on one line
+    when it was on one line in the source, has no comments and fits within
+    TS_PRINT_WIDTH; otherwise it is expanded with one item per line and
+    trailing commas. Inline forms are computed once per node, so printing is
+    linear in the tree size (times nesting depth for the string joins).
+    """
 
-        type_name_lower = type_name.lower()
-        if type_name_lower in name_map:
-            correct_name = name_map[type_name_lower]
-            if type_name != correct_name:
-                type_corrections.append(f"'{type_name}' → '{correct_name}'")
-                return f"{quote_char}{correct_name}{quote_char}"
-        return match.group(0)
+    def __init__(self, width: int = TS_PRINT_WIDTH):
+        self.width = width
+        self._inline: Dict[int, Optional[str]] = {}
+
+    def print_module(self, module: TsModule) -> str:
+        out = []
+        column = 0
+        for part in module.parts:
+            text = part if isinstance(part, str) else self.render(part, 0, column)
+            out.append(text)
+            line_start = text.rfind("\n")
+            column = len(text) - line_start - 1 if line_start >= 0 else column + len(text)
+        return "".join(out)
+
+    def inline(self, node: TsNode) -> Optional[str]:
+        """The node on one line, or None when it must span lines."""
+        key = id(node)
+        if key in self._inline:
+            return self._inline[key]
+        text = None
+        if isinstance(node, TsRaw):
+            text = node.text if "\n" not in node.text else None
+        elif isinstance(node, TsString):
+            text = node.text
+        elif isinstance(node, TsEntry):
+            value = self.inline(node.value)
+            if value is not None:
+                text = f"{node.key}: {value}" if node.key is not None else value
+        else:
+            open_, close, items, multiline = self._container(node)
+            if not multiline and not node.trailing_comments and not any(
+                item.comments or item.trailing_comment for item in items
+            ):
+                parts = [self.inline(item) for item in items]
+                if None not in parts:
+                    text = open_ + ", ".join(parts) + close
+        self._inline[key] = text
+        return text
+
+    @staticmethod
+    def _container(node: TsNode) -> tuple:
+        if isinstance(node, TsObject):
+            return "{", "}", node.entries, node.multiline
+        if isinstance(node, TsArray):
+            return "[", "]", node.items, node.multiline
+        return f"{node.callee}(", ")", node.args, False
+
+    def render(self, node: TsNode, indent: int, column: int) -> str:
+        text = self.inline(node)
+        if text is not None and column + len(text) <= self.width:
+            return text
+        if isinstance(node, TsRaw):
+            return self._reindent(node, indent)
+        if isinstance(node, TsString):
+            return node.text
+        if isinstance(node, TsEntry):
+            if node.key is None:
+                return self.render(node.value, indent, column)
+            prefix = f"{node.key}: "
+            return prefix + self.render(node.value, indent, column + len(prefix))
+        if isinstance(node, TsCall) and len(node.args) == 1 and not node.trailing_comments:
+            argument = node.args[0]
+            if isinstance(argument, (TsObject, TsArray)) and not argument.comments:
+                # Hug a single object/array argument: defineField({ ... })
+                prefix = f"{node.callee}("
+                return prefix + self.render(argument, indent, column + len(prefix)) + ")"
+        open_, close, items, _ = self._container(node)
+        inner = indent + 2
+        pad = " " * inner
+        lines = [open_]
+        for item in items:
+            lines.extend(pad + comment for comment in item.comments)
+            line = pad + self.render(item, inner, inner) + ","
+            if item.trailing_comment:
+                line += " " + item.trailing_comment
+            lines.append(line)
+        lines.extend(pad + comment for comment in node.trailing_comments)
+        lines.append(" " * indent + close)
+        return "\n".join(lines)
+
+    @staticmethod
+    def _reindent(node: TsRaw, indent: int) -> str:
+        lines = node.text.split("\n")
+        if node.source_indent is None or len(lines) == 1:
+            return node.text
+        shifted = [lines[0]]
+        for line in lines[1:]:
+            margin = min(node.source_indent, len(line) - len(line.lstrip(" ")))
+            shifted.append(" " * indent + line[margin:] if line.strip() else "")
+        return "\n".join(shifted)
+
+
+def print_schema_code(module: TsModule) -> str:
+    """Prints a (possibly corrected) TsModule back to TypeScript."""
+    return _TsPrinter().print_module(module)
+
+
+# --- Schema IR: the compact JSON phase two can produce instead of TypeScript ---
+#
+# {"name": "heroSection", "title": "Hero Section", "type": "object",
+#  "fields": [{"name": "title", "type": "string", "i18n": true, "required": true},
+#             {"name": "items", "type": "array", "of": ["card", {"type": "reference", "to": ["page"]}]}],
+#  "preview": {"title": "title", "media": "image"}}
+#
+# Field keys: name, title, type, description, i18n, required, of, to, fields,
+# options. normalize_schema_ir() turns model output into this canonical form
+# (fixed key order, camelCase names, planned type casing) so IR files diff
+# cleanly, and emit_schema_ts() renders it deterministically.
+
+I18N_CAPABLE_TYPES = {"string", "text", "image", "file", "url", "slug"}
+PRIMITIVE_IR_TYPES = {"string", "text", "number", "boolean", "url", "date", "datetime", "slug"}
+IR_PREVIEW_KEYS = ["title", "subtitle", "media"]
+_TS_IDENTIFIER_RE = re.compile(r"^[A-Za-z_$][\w$]*$")
+
+
+def _normalize_ir_type(raw_type: Any, name_map: Dict[str, str]) -> tuple:
+    """Returns (type, i18n) for a model-written type name."""
+    schema_type = str(raw_type or "string").strip()
+    schema_type = INVALID_I18N_TYPES.get(schema_type, schema_type)
+    i18n = False
+    if schema_type.startswith("internationalizedArray"):
+        schema_type, i18n = schema_type[len("internationalizedArray") :].lower(), True
+    if schema_type.lower() in BUILT_IN_TYPES:
+        return schema_type.lower(), i18n
+    return name_map.get(schema_type.lower(), schema_type), i18n
+
+
+def _normalize_ir_field(raw: Any, name_map: Dict[str, str]) -> Optional[dict]:
+    if not isinstance(raw, dict):
+        return None
+    name = to_camel_case(str(raw.get("name") or raw.get("title") or ""))
+    if not name:
+        return None
+    schema_type, typed_i18n = _normalize_ir_type(raw.get("type"), name_map)
+    field: Dict[str, Any] = {"name": name}
+    title = str(raw.get("title") or "")
+    if title and title != to_title_case(name):
+        field["title"] = title
+    field["type"] = schema_type
+    if raw.get("description"):
+        field["description"] = str(raw["description"])
+    i18n = bool(raw.get("i18n")) or typed_i18n
+    if i18n and schema_type in I18N_CAPABLE_TYPES:
+        field["i18n"] = True
+    if raw.get("required") is True or raw.get("validation") == "required":
+        field["required"] = True
+    if schema_type == "array":
+        field["of"] = _normalize_ir_items(raw.get("of"), name_map)
+    if schema_type == "reference":
+        field["to"] = _normalize_ir_targets(raw.get("to"), name_map)
+    # i18n types take no subfields; objects and plain images/files may.
+    if schema_type in ("object", "image", "file") and not field.get("i18n"):
+        subfields = _normalize_ir_fields(raw.get("fields"), name_map)
+        if subfields or schema_type == "object":
+            field["fields"] = subfields
+    if isinstance(raw.get("options"), dict) and raw["options"]:
+        field["options"] = raw["options"]
+    return field
+
+
+def _normalize_ir_fields(raw_fields: Any, name_map: Dict[str, str]) -> List[dict]:
+    fields = []
+    seen = set()
+    for raw in raw_fields if isinstance(raw_fields, list) else []:
+        field = _normalize_ir_field(raw, name_map)
+        if field and field["name"] not in seen:
+            seen.add(field["name"])
+            fields.append(field)
+    return fields
+
+
+def _normalize_ir_targets(raw_targets: Any, name_map: Dict[str, str]) -> List[str]:
+    targets = []
+    for target in raw_targets if isinstance(raw_targets, list) else [raw_targets]:
+        if isinstance(target, dict):
+            target = target.get("type")
+        if target:
+            target = name_map.get(str(target).lower(), str(target))
+            if target not in targets:
+                targets.append(target)
+    return targets
+
+
+def _normalize_ir_items(raw_items: Any, name_map: Dict[str, str]) -> List[Any]:
+    items: List[Any] = []
+    for raw in raw_items if isinstance(raw_items, list) else []:
+        if isinstance(raw, str):
+            raw = {"type": raw}
+        if not isinstance(raw, dict):
+            continue
+        item_type, _ = _normalize_ir_type(raw.get("type"), name_map)
+        if item_type == "reference":
+            items.append({"type": "reference", "to": _normalize_ir_targets(raw.get("to"), name_map)})
+        elif item_type == "object" or raw.get("fields"):
+            item = {"type": "object", "name": to_camel_case(str(raw.get("name") or "item"))}
+            item["fields"] = _normalize_ir_fields(raw.get("fields"), name_map)
+            items.append(item)
+        elif item_type not in BUILT_IN_TYPES and not raw.get("name"):
+            items.append(item_type)  # Plain schema reference: keep the short form
+        else:
+            item = {"type": item_type}
+            if raw.get("name"):
+                item["name"] = to_camel_case(str(raw["name"]))
+            items.append(item)
+    # Sanity rejects arrays mixing primitive and object/reference members, so
+    # primitives next to those are wrapped in an object with a single field.
+    item_types = [item if isinstance(item, str) else item["type"] for item in items]
+    if any(t in PRIMITIVE_IR_TYPES for t in item_types) and any(
+        t not in PRIMITIVE_IR_TYPES for t in item_types
+    ):
+        items = [
+            {
+                "type": "object",
+                "name": f"{item['type']}Item",
+                "fields": [{"name": item["type"], "type": item["type"], "required": True}],
+            }
+            if isinstance(item, dict) and item["type"] in PRIMITIVE_IR_TYPES
+            else item
+            for item in items
+        ]
+    return items
 
-    type_pattern = r"type:\s*(['\"])([^'\"]+)\1"
-    code = re.sub(type_pattern, replace_type_reference, code)
 
-    if type_corrections:
-        corrections_applied.append(
-            f"type name casing: {', '.join(sorted(list(set(type_corrections))))}"
+def normalize_schema_ir(
+    raw_ir: Any, schema_name: str, classification: str, all_valid_names: Set[str]
+) -> dict:
+    """
+    Canonicalizes a model-written IR for `schema_name`. The plan decides the
+    schema's name and type; everything else is cleaned up rather than
+    rejected, like the text corrections do for TypeScript.
+    """
+    if not isinstance(raw_ir, dict):
+        raise ValueError(f"Schema IR must be a JSON object, got {type(raw_ir).__name__}.")
+    name_map = {name.lower(): name for name in all_valid_names}
+    ir: Dict[str, Any] = {"name": schema_name}
+    title = str(raw_ir.get("title") or "")
+    if title and title != to_title_case(schema_name):
+        ir["title"] = title
+    ir["type"] = classification
+    ir["fields"] = _normalize_ir_fields(raw_ir.get("fields"), name_map)
+    preview = raw_ir.get("preview")
+    field_names = {field["name"] for field in ir["fields"]}
+    if isinstance(preview, dict):
+        preview = {
+            key: str(preview[key]).split(".")[0]
+            for key in IR_PREVIEW_KEYS
+            if preview.get(key) and str(preview[key]).split(".")[0] in field_names
+        }
+        if preview:
+            ir["preview"] = preview
+    return ir
+
+
+def _ir_literal(value: Any) -> TsNode:
+    """Plain JSON (field options) as a TypeScript literal."""
+    if isinstance(value, dict):
+        return TsObject(
+            [
+                TsEntry(key if _TS_IDENTIFIER_RE.match(key) else TsString.quoted(key).text, _ir_literal(item))
+                for key, item in value.items()
+            ]
+        )
+    if isinstance(value, list):
+        return TsArray([_ir_literal(item) for item in value])
+    if isinstance(value, str):
+        return TsString.quoted(value)
+    return TsRaw(json.dumps(value))
+
+
+def _ir_type_name(field: dict) -> str:
+    if field.get("i18n"):
+        return f"internationalizedArray{field['type'].capitalize()}"
+    return field["type"]
+
+
+def _ir_targets(targets: List[str]) -> TsArray:
+    return TsArray([TsObject([TsEntry("type", TsString.quoted(target))]) for target in targets])
+
+
+def _ir_item(item: Any) -> TsObject:
+    # Array members are plain objects, never defineType()/defineField().
+    if isinstance(item, str):
+        item = {"type": item}
+    entries = [TsEntry("type", TsString.quoted(item["type"]))]
+    if item.get("name"):
+        entries.append(TsEntry("name", TsString.quoted(item["name"])))
+    if item["type"] == "reference":
+        entries.append(TsEntry("to", _ir_targets(item.get("to", []))))
+    if item["type"] == "object":
+        entries.append(TsEntry("fields", TsArray([_ir_field(f) for f in item.get("fields", [])])))
+    return TsObject(entries)
+
+
+def _ir_field(field: dict) -> TsCall:
+    entries = [
+        TsEntry("name", TsString.quoted(field["name"])),
+        TsEntry("title", TsString.quoted(field.get("title") or to_title_case(field["name"]))),
+        TsEntry("type", TsString.quoted(_ir_type_name(field))),
+    ]
+    if field.get("description"):
+        entries.append(TsEntry("description", TsString.quoted(field["description"])))
+    if "to" in field:
+        entries.append(TsEntry("to", _ir_targets(field["to"])))
+    if "of" in field:
+        entries.append(TsEntry("of", TsArray([_ir_item(item) for item in field["of"]])))
+    if "fields" in field:
+        entries.append(TsEntry("fields", TsArray([_ir_field(f) for f in field["fields"]])))
+    if field.get("options"):
+        entries.append(TsEntry("options", _ir_literal(field["options"])))
+    if field.get("required"):
+        entries.append(TsEntry("validation", TsRaw("(Rule) => Rule.required()")))
+    return TsCall("defineField", [TsObject(entries)])
+
+
+def _ir_preview_path(field: dict) -> str:
+    path = f"{field['name']}.0.value" if field.get("i18n") else field["name"]
+    return f"{path}.asset" if field["type"] in ("image", "file") else path
+
+
+def emit_schema_ts(ir: dict) -> str:
+    """
+    Renders a normalized schema IR as a Sanity schema module, through the
+    same printer the corrections use; equal IR always gives equal output.
+    """
+    fields = {field["name"]: field for field in ir["fields"]}
+    root = TsObject(
+        [
+            TsEntry("name", TsString.quoted(ir["name"])),
+            TsEntry("title", TsString.quoted(ir.get("title") or to_title_case(ir["name"]))),
+            TsEntry("type", TsString.quoted(ir["type"])),
+            TsEntry("fields", TsArray([_ir_field(f) for f in ir["fields"]], multiline=True)),
+        ],
+        multiline=True,
+    )
+    preview = ir.get("preview") or {}
+    if preview:
+        select = TsObject(
+            [
+                TsEntry(key, TsString.quoted(_ir_preview_path(fields[preview[key]])))
+                for key in IR_PREVIEW_KEYS
+                if preview.get(key) in fields
+            ]
         )
+        root.entries.append(TsEntry("preview", TsObject([TsEntry("select", select)])))
+    module = TsModule(
+        [
+            "import {defineType, defineField} from 'sanity'\n\nexport default ",
+            TsCall("defineType", [root]),
+            "\n",
+        ]
+    )
+    return print_schema_code(module)
 
-    # Correction 5: Ensure imports are present (existing logic)
-    if "defineType" not in code and "defineField" not in code:
-        if "name:" in code and "title:" in code and "type:" in code:
-            code = f"import {{defineType, defineField}} from 'sanity'\n\n{code}"
-            corrections_applied.append("added missing defineType/defineField import")
-
-    # Correction 6: Fix invalid internationalizedArray type names
-    # Available types: String, Text, Image, File, Url, Slug
-    invalid_i18n_types = {
-        "internationalizedArrayOfPortableText": "internationalizedArrayText",
-        "internationalizedArrayPortableText": "internationalizedArrayText",
-        "internationalizedArrayRichText": "internationalizedArrayText",
-        "internationalizedArrayBlock": "internationalizedArrayText",
-        "internationalizedArrayContent": "internationalizedArrayText",
-        "internationalizedArrayArray": "internationalizedArrayText",
-        "internationalizedArrayReference": "reference",
-        "internationalizedArrayCrossDatasetReference": "crossDatasetReference",
-        "internationalizedArrayDocument": "reference",
-    }
-    for incorrect_name, correct_name in invalid_i18n_types.items():
-        if incorrect_name in code:
-            code = code.replace(incorrect_name, correct_name)
-            corrections_applied.append(
-                f"corrected invalid i18n type: {incorrect_name} → {correct_name}"
-            )
 
-    # Correction 7: Simplify verbose field names (anti-over-engineering)
-    verbose_replacements = {
-        r"name:\s*['\"]primaryTitle['\"]": "name: 'title'",
-        r"name:\s*['\"]mainTitle['\"]": "name: 'title'",
-        r"name:\s*['\"]headerTitle['\"]": "name: 'title'",
-        r"name:\s*['\"]sectionTitle['\"]": "name: 'title'",
-        r"name:\s*['\"]primaryDescription['\"]": "name: 'description'",
-        r"name:\s*['\"]mainDescription['\"]": "name: 'description'",
-        r"name:\s*['\"]sectionDescription['\"]": "name: 'description'",
-        r"name:\s*['\"]primaryText['\"]": "name: 'text'",
-        r"name:\s*['\"]mainText['\"]": "name: 'text'",
-        r"name:\s*['\"]heroImage['\"]": "name: 'image'",
-        r"name:\s*['\"]mainImage['\"]": "name: 'image'",
-        r"name:\s*['\"]primaryImage['\"]": "name: 'image'",
-        r"name:\s*['\"]featuredImage['\"]": "name: 'image'",
-    }
+def schema_from_ir_response(
+    response_text: str, schema_info: dict, all_valid_names: Set[str]
+) -> Optional[dict]:
+    """Parses a phase-two IR response into {"code", "ir"}; None if unusable."""
+    raw_ir = parse_json_strict(response_text)
+    if raw_ir is None:
+        logging.info(f"  IR for '{schema_info['name']}' is not strict JSON; repairing it.")
+        raw_ir = extract_json_from_response(response_text)
+    try:
+        ir = normalize_schema_ir(raw_ir, schema_info["name"], schema_info["type"], all_valid_names)
+    except ValueError as e:
+        logging.error(f"❌ Unusable schema IR for '{schema_info['name']}': {e}")
+        return None
+    return {"code": emit_schema_ts(ir), "ir": ir}
 
-    simplified_names = []
-    for pattern, replacement in verbose_replacements.items():
-        if re.search(pattern, code, re.IGNORECASE):
-            code = re.sub(pattern, replacement, code, flags=re.IGNORECASE)
-            simplified_names.append(pattern.split("'")[1])  # Extract the original name
 
-    if simplified_names:
-        corrections_applied.append(
-            f"simplified verbose field names: {', '.join(simplified_names[:3])}{'...' if len(simplified_names) > 3 else ''}"
-        )
+class CorrectionEngine:
+    """
+    Fixes the model's predictable mistakes. The text rules run first: one
+    finditer over _CORRECTION_RE collecting (start, end, replacement) edits,
+    placed with the bracket index and spliced in a single join. Where a
+    structural rule applies somewhere those edits cannot reach (see
+    _needs_tree), the code is parsed once into a schema tree instead, the
+    rules edit the tree and the tree is printed back. Fired rules are counted
+    so callers can log or measure them.
+    """
+
+    def __init__(self, all_valid_names: Set[str]):
+        self.name_map = {name.lower(): name for name in all_valid_names}
+
+    def correct(self, code: str, expected_type: Optional[str] = None) -> tuple:
+        """Returns (corrected_code, list of human-readable corrections)."""
+        corrections: List[str] = []
+        if code.startswith("```") or code.endswith("```"):
+            code = _MARKDOWN_OPEN_RE.sub("", code)
+            code = _MARKDOWN_CLOSE_RE.sub("", code)
+            corrections.append("removed markdown formatting")
+
+        fired: Dict[str, List[str]] = {}
+        state = {"first_type": True, "index": None, "mixable": "url" in code and "reference" in code}
+        corrected = self._correct_text(code, expected_type, fired, state)
+        if self._needs_tree(code, expected_type, fired, state):
+            try:
+                tree_fired: Dict[str, List[str]] = {}
+                corrected = self._correct_tree(code, expected_type, tree_fired)
+                fired = tree_fired
+            except TsParseError as error:
+                fired["text_fallback"] = [str(error)]
+        code = corrected
+
+        if "defineType" not in code and "defineField" not in code:
+            if "name:" in code and "title:" in code and "type:" in code:
+                code = f"import {{defineType, defineField}} from 'sanity'\n\n{code}"
+                fired.setdefault("import", []).append("")
+
+        for rule, details in fired.items():
+            corrections.append(self._describe(rule, details))
+        return code, corrections
+
+    def _needs_tree(self, code: str, expected_type: Optional[str], fired: dict, state: dict) -> bool:
+        """
+        Whether a structural rule applies where the text rules could not
+        place it: `{'name'}` items outside a one-item `of` array, defineType
+        items past the first of an array, a root type that is not the first
+        `type:` in the file, or an i18n `fields`/`of` key written before the
+        type. Everything else the text rules correct exactly as the tree would.
+        """
+        if len(code) > TS_TREE_MAX_CHARS:
+            return False
+        if len(_SINGLE_STRING_OBJECT_RE.findall(code)) > len(fired.get("missing_type", [])):
+            return True
+        root = _ROOT_OBJECT_RE.search(code)
+        root_calls = 1 if root and root.group().startswith("defineType") else 0
+        if len(_DEFINE_TYPE_CALL_RE.findall(code)) > root_calls + len(fired.get("define_in_array", [])):
+            return True
+        if expected_type:
+            # The first `type:` is the root's own if no literal opens before it.
+            first_type = _ITEM_TYPE_RE.search(code)
+            if (
+                not root
+                or not first_type
+                or first_type.start() < root.end()
+                or _OPENER_RE.search(code, root.end(), first_type.start())
+            ):
+                return True
+        first_keys = {key: key_re.search(code) for key, key_re in _FIRST_I18N_KEY_RES.items()}
+        checked = set()
+        for match in _I18N_KEYED_TYPE_RE.finditer(code):
+            first_key = first_keys["fields" if match.group(1) in ("Image", "File") else "of"]
+            if not first_key or first_key.start() > match.start():
+                continue  # No such key anywhere before this type
+            index = self._index(code, state)
+            start = index.open_of(match.start())
+            if start < 0 or start in checked:
+                continue
+            # Only each object's first type counts, so each object is walked once.
+            checked.add(start)
+            if _I18N_KEY_RE.match(code, start + 1) or any(
+                token == "," and _I18N_KEY_RE.match(code, position + 1)
+                for position, token in index.top_level(start + 1, match.start())
+            ):
+                return True
+        return False
+
+    def _correct_tree(self, code: str, expected_type: Optional[str], fired: dict) -> str:
+        code, stray = _STRAY_MARKDOWN_RE.subn("", code)
+        if stray:
+            fired.setdefault("stray_markdown", []).append("")
+        module = parse_schema_code(code)
+        trees = module.trees()
+        root = trees[0].args[0] if isinstance(trees[0], TsCall) and trees[0].args else trees[0]
+        if expected_type and isinstance(root, TsObject):
+            # Only the schema's own type, never a field's.
+            schema_type = root.get("type")
+            if isinstance(schema_type, TsString) and schema_type.value != expected_type:
+                fired.setdefault("schema_type", []).append(
+                    f"'{schema_type.value}' → '{expected_type}'"
+                )
+                schema_type.value = expected_type
+        for tree in trees:
+            self._fix_node(tree, None, fired)
+        return print_schema_code(module)
+
+    def _fix_node(self, node: TsNode, key: Optional[str], fired: dict):
+        if isinstance(node, TsObject):
+            self._fix_object(node, fired)
+        elif isinstance(node, TsArray):
+            self._fix_array(node, key, fired)
+        elif isinstance(node, TsCall):
+            for argument in node.args:
+                self._fix_node(argument, None, fired)
+        elif isinstance(node, TsRaw):
+            node.text, count = _RULE_PARAM_RE.subn("(Rule)", node.text)
+            if count:
+                fired.setdefault("validation", []).append("")
+            node.text = _INVALID_I18N_RE.sub(
+                lambda m: self._note_invalid_i18n(m.group(), fired), node.text
+            )
+        elif isinstance(node, TsString):
+            if _INVALID_I18N_RE.search(node.text):
+                node.text = _INVALID_I18N_RE.sub(
+                    lambda m: self._note_invalid_i18n(m.group(), fired), node.text
+                )
 
-    # Correction 8: Fix mixed primitive/object types in arrays (CRITICAL SANITY FIX)
-    mixed_array_pattern = r'of:\s*\[\s*\{[^}]*type:\s*[\'"]url[\'"][^}]*\}[^}]*\{[^}]*type:\s*[\'"]reference[\'"]'
-    if re.search(mixed_array_pattern, code, re.DOTALL):
-        # Fix url type by wrapping it in object structure
-        url_object_fix = r'(\s*\{\s*type:\s*[\'"])url([\'"][^}]*name:\s*[\'"]([^\'\"]+)[\'"][^}]*title:\s*[\'"]([^\'\"]+)[\'"][^}]*)\},'
-        code = re.sub(
-            url_object_fix,
-            r'\1object\2fields: [defineField({name: "url", title: "URL", type: "url", validation: (Rule) => Rule.required()})],},',
-            code,
-            flags=re.DOTALL,
+    @staticmethod
+    def _note_invalid_i18n(value: str, fired: dict) -> str:
+        corrected = INVALID_I18N_TYPES[value]
+        fired.setdefault("invalid_i18n", []).append(f"{value} → {corrected}")
+        return corrected
+
+    def _fix_object(self, node: TsObject, fired: dict):
+        if len(node.entries) == 1:
+            only = node.entries[0]
+            if only.key is None and isinstance(only.value, TsString):
+                # {'heroSection'} → {type: 'heroSection'}
+                name = self.name_map.get(only.value.value.lower(), only.value.value)
+                node.entries[0] = TsEntry("type", TsString.quoted(name))
+                fired.setdefault("missing_type", []).append("")
+        for entry in node.entries:
+            self._fix_node(entry.value, entry.name, fired)
+            if not isinstance(entry.value, TsString):
+                continue
+            if entry.name == "type":
+                value = entry.value.value
+                if value not in BUILT_IN_TYPES and "internationalizedArray" not in value:
+                    correct_name = self.name_map.get(value.lower())
+                    if correct_name and correct_name != value:
+                        entry.value.value = correct_name
+                        fired.setdefault("casing", []).append(f"'{value}' → '{correct_name}'")
+            elif entry.name == "name":
+                simple = VERBOSE_FIELD_NAMES.get(entry.value.value.lower())
+                if simple:
+                    fired.setdefault("verbose", []).append(entry.value.value)
+                    entry.value.value = simple
+        schema_type = node.string("type")
+        if schema_type in I18N_NO_FIELDS_TYPES and node.remove("fields"):
+            fired.setdefault("i18n_fields", []).append("")
+        elif schema_type in I18N_NO_OF_TYPES and node.remove("of"):
+            fired.setdefault("i18n_of", []).append("")
+
+    def _fix_array(self, node: TsArray, key: Optional[str], fired: dict):
+        if key == "of":
+            for i, item in enumerate(node.items):
+                if isinstance(item, TsCall) and item.callee == "defineType" and item.args:
+                    # of: [defineType({...})] → of: [{...}]
+                    argument = item.args[0]
+                    argument.comments = item.comments + argument.comments
+                    node.items[i] = argument
+                    fired.setdefault("define_in_array", []).append("")
+        for item in node.items:
+            self._fix_node(item, None, fired)
+        objects = [item for item in node.items if isinstance(item, TsObject)]
+        types = [item.string("type") for item in objects]
+        if "url" not in types or "reference" not in types:
+            return
+        for item, item_type in zip(objects, types):
+            if item_type == "url" and item.get("name") is not None and item.get("title") is not None:
+                # A url next to a reference gets wrapped in an object.
+                item.get("type").value = "object"
+                item.entries.extend(_TsParser("{" + URL_OBJECT_FIELDS + "}").parse_value(at_module_level=True).entries)
+                fired.setdefault("mixed_array", []).append("")
+
+    def _correct_text(self, code: str, expected_type: Optional[str], fired: dict, state: dict) -> str:
+        # state["mixable"]: a url item can only need wrapping if the file
+        # mentions both kinds. state["index"] is built on first use.
+        edits: List[tuple] = []
+        for match in _CORRECTION_RE.finditer(code):
+            # lastgroup is the outermost group, i.e. the branch that matched
+            self._RULES[match.lastgroup](
+                self, code, match, expected_type, state, edits, fired
+            )
+        return self._apply(code, edits)
+
+    @staticmethod
+    def _index(code: str, state: dict) -> _BracketIndex:
+        # Built on first use: most schemas never need a bracket lookup.
+        if state["index"] is None:
+            state["index"] = _BracketIndex(code)
+        return state["index"]
+
+    @staticmethod
+    def _apply(code: str, edits: List[tuple]) -> str:
+        if not edits:
+            return code
+        edits.sort(key=lambda edit: (edit[0], edit[1]))
+        parts = []
+        position = 0
+        for start, end, replacement in edits:
+            if start < position:
+                continue  # Overlaps an earlier edit; the first rule wins
+            parts.append(code[position:start])
+            parts.append(replacement)
+            position = end
+        parts.append(code[position:])
+        return "".join(parts)
+
+    @staticmethod
+    def _describe(rule: str, details: List[str]) -> str:
+        unique = sorted(set(d for d in details if d))
+        if rule == "stray_markdown":
+            return "removed stray markdown syntax"
+        if rule == "schema_type":
+            return f"schema type: {details[0]}"
+        if rule == "validation":
+            return "validation function syntax (Rule: Rule) → (Rule)"
+        if rule == "define_in_array":
+            return "defineType inside arrays → plain objects"
+        if rule == "missing_type":
+            return "added missing 'type:' property in array items"
+        if rule == "i18n_fields":
+            return "removed 'fields' from internationalizedArray type"
+        if rule == "i18n_of":
+            return "removed 'of' from internationalizedArray type"
+        if rule == "casing":
+            return f"type name casing: {', '.join(unique)}"
+        if rule == "import":
+            return "added missing defineType/defineField import"
+        if rule == "invalid_i18n":
+            return "corrected invalid i18n type: " + ", ".join(unique)
+        if rule == "verbose":
+            more = "..." if len(unique) > 3 else ""
+            return f"simplified verbose field names: {', '.join(unique[:3])}{more}"
+        if rule == "mixed_array":
+            return "fixed mixed primitive/object types in arrays"
+        if rule == "text_fallback":
+            return f"corrected as text ({details[0]})"
+        return rule
+
+    # --- Rules: each appends (start, end, replacement) edits and notes what fired.
+
+    def _stray_markdown(self, code, match, expected_type, state, edits, fired):
+        edits.append((match.start(), match.end(), ""))
+        fired.setdefault("stray_markdown", []).append("")
+
+    def _validation(self, code, match, expected_type, state, edits, fired):
+        edits.append((match.start(), match.end(), "(Rule)"))
+        fired.setdefault("validation", []).append("")
+
+    def _define_in_array(self, code, match, expected_type, state, edits, fired):
+        edits.append((match.start(), match.end(), "of: [{"))
+        # Drop the ')' that closed defineType( ... ), found by bracket matching.
+        brace_close = self._index(code, state).close_of(match.end())
+        if brace_close < len(code):
+            paren = brace_close + 1
+            while paren < len(code) and code[paren].isspace():
+                paren += 1
+            if paren < len(code) and code[paren] == ")":
+                edits.append((paren, paren + 1, ""))
+        fired.setdefault("define_in_array", []).append("")
+
+    def _missing_type(self, code, match, expected_type, state, edits, fired):
+        name = match.group("mt_name")
+        name = self.name_map.get(name.lower(), name)
+        edits.append((match.start(), match.end(), f"of: [{{type: '{name}'}}]"))
+        fired.setdefault("missing_type", []).append("")
+
+    def _array(self, code, match, expected_type, state, edits, fired):
+        """A url item next to a reference item gets wrapped in an object."""
+        if not state["mixable"]:
+            return
+        items = self._index(code, state).array_items().get(match.end(), [])
+        types = [item_type for _, _, item_type in items]
+        if "url" not in types or "reference" not in types:
+            return
+        for start, item_end, item_type in items:
+            if item_type != "url":
+                continue
+            item = code[start:item_end]
+            if not (_NAME_KEY_RE.search(item) and _TITLE_KEY_RE.search(item)):
+                continue
+            type_match = _ITEM_TYPE_RE.search(item)
+            value_start = start + type_match.start(1)
+            edits.append((value_start, value_start + 3, "object"))
+            tail = item.rstrip()
+            insert_at = start + len(tail)
+            separator = "" if tail.endswith(",") else ","
+            edits.append((insert_at, insert_at, f"{separator}{URL_OBJECT_FIELDS}"))
+            fired.setdefault("mixed_array", []).append("")
+
+    def _type(self, code, match, expected_type, state, edits, fired):
+        value = match.group("t_value")
+        value_start, value_end = match.start("t_value"), match.end("t_value")
+        if state["first_type"]:
+            state["first_type"] = False
+            if expected_type and value != expected_type:
+                # Only the schema's own type: the first declaration in the file.
+                edits.append((value_start, value_end, expected_type))
+                fired.setdefault("schema_type", []).append(
+                    f"'{value}' → '{expected_type}'"
+                )
+                return
+        if value in INVALID_I18N_TYPES:
+            corrected = INVALID_I18N_TYPES[value]
+            edits.append((value_start, value_end, corrected))
+            fired.setdefault("invalid_i18n", []).append(f"{value} → {corrected}")
+            value = corrected
+        elif value not in BUILT_IN_TYPES and "internationalizedArray" not in value:
+            correct_name = self.name_map.get(value.lower())
+            if correct_name and correct_name != value:
+                edits.append((value_start, value_end, correct_name))
+                fired.setdefault("casing", []).append(f"'{value}' → '{correct_name}'")
+            return
+        if value in I18N_NO_FIELDS_TYPES:
+            self._drop_key(code, state, match.end(), _FIELDS_KEY_RE, "i18n_fields", edits, fired)
+        elif value in I18N_NO_OF_TYPES:
+            self._drop_key(code, state, match.end(), _OF_KEY_RE, "i18n_of", edits, fired)
+
+    def _drop_key(self, code, state, position, key_re, rule, edits, fired):
+        """Removes `, key: [...]` from the rest of the object holding position."""
+        flat_tail = _FLAT_TAIL_RE.match(code, position)
+        if flat_tail and not key_re.search(code, position, flat_tail.end()):
+            return  # The object closes with no nested literal and no such key
+        index = self._index(code, state)
+        key_match = index.find_key(position, key_re)
+        if not key_match:
+            return
+        object_end = index.close_of(position)
+        list_end = index.close_of(key_match.end())
+        edits.append((key_match.start(), min(list_end + 1, object_end), ""))
+        fired.setdefault(rule, []).append("")
+
+    def _verbose(self, code, match, expected_type, state, edits, fired):
+        name = match.group("v_name")
+        simple = VERBOSE_FIELD_NAMES.get(name.lower())
+        if simple:
+            edits.append((match.start(), match.end(), f"name: '{simple}'"))
+            fired.setdefault("verbose", []).append(name)
+
+    def _invalid_i18n(self, code, match, expected_type, state, edits, fired):
+        value = match.group("invalid_i18n")
+        edits.append((match.start(), match.end(), INVALID_I18N_TYPES[value]))
+        fired.setdefault("invalid_i18n", []).append(
+            f"{value} → {INVALID_I18N_TYPES[value]}"
         )
-        corrections_applied.append("fixed mixed primitive/object types in arrays")
 
+    _RULES = {
+        "stray_markdown": _stray_markdown,
+        "validation": _validation,
+        "define_in_array": _define_in_array,
+        "missing_type": _missing_type,
+        "array": _array,
+        "type": _type,
+        "verbose": _verbose,
+        "invalid_i18n": _invalid_i18n,
+    }
+
+
+def correct_generated_code(
+    code: str,
+    all_valid_names: Set[str],
+    expected_type: str = None,
+    engine: Optional[CorrectionEngine] = None,
+) -> str:
+    """
+    Applies a series of corrections to the AI-generated code to fix common, predictable errors.
+    Pass a shared engine when correcting many schemas against the same names.
+    """
+    engine = engine or CorrectionEngine(all_valid_names)
+    code, corrections_applied = engine.correct(code, expected_type)
+    run_trace.annotate(corrections=len(corrections_applied))
     # Log all corrections applied
     if corrections_applied:
         logging.info(
             f"    🔧 Auto-corrections applied: {' | '.join(corrections_applied)}"
         )
-
     return code
 
 
-def validate_generated_code(code: str, schema_name: str) -> List[str]:
-    """
-    Validates the generated code and returns a list of potential issues found.
-    """
-    issues = []
-
-    # Check for markdown formatting that shouldn't be in TypeScript files
+# Each validation rule takes the code and its bracket index and returns the
+# issues it found. Every rule is linear in the size of the code: regexes are
+# anchored on a literal prefix with no nested or DOTALL wildcards, and anything
+# that needs the surrounding object or array asks the bracket index.
+_I18N_FIELDS_TYPE_RE = re.compile(r"type:\s*['\"]internationalizedArray(?:Image|File)['\"]")
+_I18N_OF_TYPE_RE = re.compile(r"type:\s*['\"]internationalizedArray(?:Text|String|Url|Slug)['\"]")
+PRIMITIVE_ARRAY_ITEM_TYPES = {"url", "string", "number", "boolean"}
+VALIDATION_BUILT_IN_TYPES = {
+    "String",
+    "Text",
+    "Image",
+    "File",
+    "Url",
+    "Slug",
+    "Number",
+    "Boolean",
+    "Array",
+    "Object",
+    "Reference",
+    "Block",
+    "Date",
+    "Datetime",
+}
+
+
+def _check_markdown(code: str, index: _BracketIndex) -> List[str]:
+    # Markdown formatting shouldn't be in TypeScript files
     if re.search(r"```\w*", code) or code.startswith("```") or code.endswith("```"):
-        issues.append("❌ Found markdown formatting in TypeScript code")
+        return ["❌ Found markdown formatting in TypeScript code"]
+    return []
 
-    # Check for defineType inside arrays (should be caught by correction, but double-check)
+
+def _check_define_in_array(code: str, index: _BracketIndex) -> List[str]:
+    # Should be caught by correction, but double-check
     if re.search(r"of:\s*\[\s*defineType\s*\(", code):
-        issues.append("❌ Found defineType inside array 'of' property")
+        return ["❌ Found defineType inside array 'of' property"]
+    return []
+
 
-    # Check for missing 'type:' property in array items
+def _check_missing_item_type(code: str, index: _BracketIndex) -> List[str]:
     if re.search(r"of:\s*\[\s*\{\s*['\"][^'\"]+['\"]\s*\}", code):
-        issues.append("❌ Found missing 'type:' property in array items")
+        return ["❌ Found missing 'type:' property in array items"]
+    return []
 
-    # Check for fields property on i18n image types
-    if re.search(
-        r"type:\s*['\"]internationalizedArray(Image|File)['\"].*?fields:\s*\[",
-        code,
-        re.DOTALL,
-    ):
-        issues.append("❌ Found 'fields' property on internationalizedArray type")
 
-    # Check for 'of' property on i18n text/array types
-    if re.search(
-        r"type:\s*['\"]internationalizedArray(?:Text|String|Url|Slug)['\"].*?of:\s*\[",
-        code,
-        re.DOTALL,
-    ):
+def _check_i18n_keys(code: str, index: _BracketIndex) -> List[str]:
+    # Only keys of the object that declares the i18n type count, not any
+    # `fields:`/`of:` later in the file.
+    issues = []
+    if any(index.find_key(m.end(), _FIELDS_KEY_RE) for m in _I18N_FIELDS_TYPE_RE.finditer(code)):
+        issues.append("❌ Found 'fields' property on internationalizedArray type")
+    if any(index.find_key(m.end(), _OF_KEY_RE) for m in _I18N_OF_TYPE_RE.finditer(code)):
         issues.append("❌ Found 'of' property on internationalizedArray type")
+    return issues
 
-    # Check for invalid internationalizedArray type names
+
+def _check_invalid_i18n_types(code: str, index: _BracketIndex) -> List[str]:
+    issues = []
     invalid_i18n_pattern = r"type:\s*['\"]internationalizedArray(?:OfPortableText|PortableText|RichText|Block|Content|Array|Of\w+)['\"]"
     if re.search(invalid_i18n_pattern, code):
         issues.append(
             "❌ Found invalid internationalizedArray type (only String, Text, Image, File, Url, Slug are available)"
         )
-
-    # Check for invalid internationalizedArray reference types
     invalid_ref_pattern = r"type:\s*['\"]internationalizedArray(?:Reference|CrossDatasetReference|Document)['\"]"
     if re.search(invalid_ref_pattern, code):
         issues.append(
             "❌ Found invalid internationalizedArray reference type (use 'reference' instead - references don't need internationalization)"
         )
+    return issues
 
-    # Check for explicit typing in validation functions
+
+def _check_validation_typing(code: str, index: _BracketIndex) -> List[str]:
     if re.search(r"\(Rule:\s*[A-Za-z]", code):
-        issues.append("❌ Found explicit typing in validation function parameter")
+        return ["❌ Found explicit typing in validation function parameter"]
+    return []
 
-    # Check for missing imports
-    if ("defineType" in code or "defineField" in code) and not re.search(
-        r"import.*defineType.*from.*sanity", code
-    ):
-        issues.append("⚠️  Missing import for defineType/defineField")
-
-    # Check for camelCase violations in type references
-    type_references = re.findall(r"type:\s*['\"]([^'\"]+)['\"]", code)
-    for type_ref in type_references:
-        if type_ref[0].isupper() and "internationalizedArray" not in type_ref:
-            # Skip built-in types
-            built_in_types = {
-                "String",
-                "Text",
-                "Image",
-                "File",
-                "Url",
-                "Slug",
-                "Number",
-                "Boolean",
-                "Array",
-                "Object",
-                "Reference",
-                "Block",
-                "Date",
-                "Datetime",
-            }
-            if type_ref not in built_in_types:
-                issues.append(f"⚠️  Type reference '{type_ref}' should be camelCase")
 
-    # Check for schemas with too many fields (over-engineering detection)
+def _check_imports(code: str, index: _BracketIndex) -> List[str]:
+    if "defineType" not in code and "defineField" not in code:
+        return []
+    # Same as matching import.*defineType.*from.*sanity per line, but with
+    # ordered find() calls instead of three backtracking wildcards.
+    for line in code.splitlines():
+        position = line.find("import")
+        for word in ("defineType", "from", "sanity"):
+            if position < 0:
+                break
+            position = line.find(word, position)
+        if position >= 0:
+            return []
+    return ["⚠️  Missing import for defineType/defineField"]
+
+
+def _check_type_casing(code: str, index: _BracketIndex) -> List[str]:
+    issues = []
+    for type_ref in re.findall(r"type:\s*['\"]([^'\"]+)['\"]", code):
+        if (
+            type_ref[0].isupper()
+            and "internationalizedArray" not in type_ref
+            and type_ref not in VALIDATION_BUILT_IN_TYPES
+        ):
+            issues.append(f"⚠️  Type reference '{type_ref}' should be camelCase")
+    return issues
+
+
+def _check_field_count(code: str, index: _BracketIndex) -> List[str]:
+    # Over-engineering detection
     field_count = len(re.findall(r"defineField\s*\(", code))
     if field_count > 6:
-        issues.append(
+        return [
             f"⚠️  Schema has {field_count} fields - consider simplifying (recommended: 3-5 fields max)"
-        )
+        ]
+    return []
 
-    # Check for verbose field names that suggest over-engineering
+
+def _check_verbose_names(code: str, index: _BracketIndex) -> List[str]:
     verbose_patterns = [
         r'name:\s*[\'"][a-z]*Title[A-Z][a-z]*[\'"]',  # e.g., "primaryTitle", "headerTitle"
         r'name:\s*[\'"][a-z]*Description[A-Z][a-z]*[\'"]',  # e.g., "mainDescription"
         r'name:\s*[\'"][a-z]*Text[A-Z][a-z]*[\'"]',  # e.g., "primaryText"
         r'name:\s*[\'"][a-z]*Image[A-Z][a-z]*[\'"]',  # e.g., "heroImage", "mainImage"
     ]
-
     for pattern in verbose_patterns:
         if re.search(pattern, code):
-            issues.append(
+            # Only show this warning once
+            return [
                 "⚠️  Found verbose field names - consider simpler naming (e.g., 'title', 'description', 'image')"
-            )
-            break  # Only show this warning once
+            ]
+    return []
+
+
+def _check_mixed_arrays(code: str, index: _BracketIndex) -> List[str]:
+    # Critical Sanity rule: a primitive item followed by an object/reference
+    # item in the same array, judged on each item's own top-level type.
+    for items in index.array_items().values():
+        seen_primitive = False
+        for _, _, item_type in items:
+            if item_type in PRIMITIVE_ARRAY_ITEM_TYPES:
+                seen_primitive = True
+            elif seen_primitive and item_type in ("reference", "object"):
+                return [
+                    "❌ Found mixed primitive/object types in array - will break Sanity Studio"
+                ]
+    return []
+
+
+VALIDATION_RULES: List[Tuple[str, Callable[[str, _BracketIndex], List[str]]]] = [
+    ("markdown", _check_markdown),
+    ("define_in_array", _check_define_in_array),
+    ("missing_item_type", _check_missing_item_type),
+    ("i18n_keys", _check_i18n_keys),
+    ("invalid_i18n_types", _check_invalid_i18n_types),
+    ("validation_typing", _check_validation_typing),
+    ("imports", _check_imports),
+    ("type_casing", _check_type_casing),
+    ("field_count", _check_field_count),
+    ("verbose_names", _check_verbose_names),
+    ("mixed_arrays", _check_mixed_arrays),
+]
 
-    # Check for mixed primitive/object types in arrays (critical Sanity rule)
-    mixed_array_pattern = r'of:\s*\[\s*\{[^}]*type:\s*[\'"](?:url|string|number|boolean)[\'"][^}]*\}[^}]*\{[^}]*type:\s*[\'"](?:reference|object)[\'"]'
-    if re.search(mixed_array_pattern, code, re.DOTALL):
-        issues.append(
-            "❌ Found mixed primitive/object types in array - will break Sanity Studio"
-        )
+
+def validate_generated_code(code: str, schema_name: str) -> List[str]:
+    """
+    Validates the generated code and returns a list of potential issues found.
+    """
+    issues = []
+    index = _BracketIndex(code)
+    for _, rule in VALIDATION_RULES:
+        issues.extend(rule(code, index))
 
     if issues:
         logging.warning(f"  ⚠️  Validation issues found in '{schema_name}':")
@@ -762,6 +4186,293 @@ def validate_generated_code(code: str, schema_name: str) -> List[str]:
     return issues
 
 
+# --- Cross-schema reference graph ---
+# Types a Studio knows without a schema file: Sanity's own and the ones
+# sanity-plugin-internationalized-array registers.
+GRAPH_KNOWN_TYPES = (
+    BUILT_IN_TYPES
+    | I18N_NO_FIELDS_TYPES
+    | I18N_NO_OF_TYPES
+    | {"document", "span", "geopoint", "email", "crossDatasetReference"}
+)
+_DECLARED_NAME_RE = re.compile(r"\bname:\s*['\"]([^'\"]+)['\"]")
+_TO_ARRAY_RE = re.compile(r"\bto:\s*\[")
+
+
+def _unwrap_define(node: TsNode) -> TsNode:
+    """defineField({...}) / defineArrayMember({...}) → {...}."""
+    if isinstance(node, TsCall) and node.args:
+        return node.args[0]
+    return node
+
+
+def _collect_type_refs(node: TsNode, in_to: bool, refs: List[tuple]):
+    """
+    Appends (type, kind) for every schema type used under node: kind is
+    "reference" for `to:` targets and "embed" for everything else.
+    """
+    if isinstance(node, TsObject):
+        type_name = node.string("type")
+        if type_name and type_name not in GRAPH_KNOWN_TYPES:
+            refs.append((type_name, "reference" if in_to else "embed"))
+        for entry in node.entries:
+            _collect_type_refs(entry.value, entry.name == "to", refs)
+    elif isinstance(node, TsArray):
+        for item in node.items:
+            _collect_type_refs(item, in_to, refs)
+    elif isinstance(node, TsCall):
+        for argument in node.args:
+            _collect_type_refs(argument, False, refs)
+
+
+def _scan_type_refs(code: str) -> tuple:
+    """(declared name, refs) straight from the text, for code the parser rejects."""
+    index = _BracketIndex(code)
+    to_starts, to_ends = [], []
+    for match in _TO_ARRAY_RE.finditer(code):
+        to_starts.append(match.end())
+        to_ends.append(index.close_of(match.end()))
+    refs = []
+    for match in _ITEM_TYPE_RE.finditer(code):
+        type_name = match.group(1)
+        if type_name in GRAPH_KNOWN_TYPES:
+            continue
+        found = bisect.bisect_right(to_starts, match.start()) - 1
+        in_to = found >= 0 and match.start() < to_ends[found]
+        refs.append((type_name, "reference" if in_to else "embed"))
+    declared = _DECLARED_NAME_RE.search(code)
+    return (declared.group(1) if declared else None), refs
+
+
+def _page_builder_types(root: TsObject) -> Optional[Set[str]]:
+    """Item types of page's pageBuilder array; None if it has no such field."""
+    fields = root.get("fields")
+    for field in fields.items if isinstance(fields, TsArray) else []:
+        field = _unwrap_define(field)
+        if isinstance(field, TsObject) and field.string("name") == "pageBuilder":
+            members = field.get("of")
+            items = members.items if isinstance(members, TsArray) else []
+            return {
+                _unwrap_define(item).string("type")
+                for item in items
+                if isinstance(_unwrap_define(item), TsObject)
+            }
+    return None
+
+
+def _strongly_connected(graph: Dict[str, List[str]]) -> List[List[str]]:
+    """
+    Tarjan's strongly connected components, with an explicit stack so long
+    embedding chains cannot hit the recursion limit. Linear in nodes + edges.
+    """
+    order: Dict[str, int] = {}
+    low: Dict[str, int] = {}
+    stack: List[str] = []
+    on_stack: Set[str] = set()
+    components = []
+    for start in graph:
+        if start in order:
+            continue
+        work = [(start, 0)]
+        while work:
+            node, i = work.pop()
+            neighbors = graph[node]
+            if i == 0:
+                order[node] = low[node] = len(order)
+                stack.append(node)
+                on_stack.add(node)
+            else:
+                # Back from neighbors[i - 1]
+                low[node] = min(low[node], low[neighbors[i - 1]])
+            while i < len(neighbors) and neighbors[i] in order:
+                if neighbors[i] in on_stack:
+                    low[node] = min(low[node], order[neighbors[i]])
+                i += 1
+            if i < len(neighbors):
+                work.append((node, i + 1))
+                work.append((neighbors[i], 0))
+                continue
+            if low[node] == order[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+
+class SchemaGraph:
+    """
+    Global index of the schema set, built in one pass over the final code:
+    which schema declares each type name and which schemas use each type.
+    Both are dicts, so "does this type resolve?" and "who uses it?" are
+    constant-time, and check() finds what would stop Sanity Studio from
+    loading the set (unknown or duplicate type names) plus the smells that
+    would not (unused objects, embedding cycles, pageBuilder gaps). The
+    planned names of the schemas behind the former end up in broken.
+    """
+
+    def __init__(self, schemas: List[dict], plan: Optional[dict] = None):
+        self.plan = plan or {}
+        self.declared: Dict[str, List[dict]] = {}
+        self.refs: Dict[str, List[tuple]] = {}
+        self.referrers: Dict[str, Set[str]] = {}
+        self.misnamed: List[tuple] = []
+        self.broken: Set[str] = set()
+        self.page_parsed = False
+        self.page_builder: Optional[Set[str]] = None
+        for schema in schemas:
+            self._add(schema)
+
+    def _add(self, schema: dict):
+        try:
+            trees = parse_schema_code(schema["code"]).trees()
+        except TsParseError:
+            trees = []
+        root = _unwrap_define(trees[0]) if trees else None
+        if isinstance(root, TsObject):
+            declared = root.string("name")
+            refs: List[tuple] = []
+            for tree in trees:
+                _collect_type_refs(tree, False, refs)
+            if declared == "page":
+                self.page_parsed = True
+                self.page_builder = _page_builder_types(root)
+        else:
+            declared, refs = _scan_type_refs(schema["code"])
+        if declared != schema["name"]:
+            self.misnamed.append((schema, declared))
+        name = declared or schema["name"]
+        self.declared.setdefault(name, []).append(schema)
+        self.refs.setdefault(name, []).extend(refs)
+        for type_name, _ in refs:
+            self.referrers.setdefault(type_name, set()).add(name)
+
+    def resolves(self, type_name: str) -> bool:
+        return type_name in GRAPH_KNOWN_TYPES or type_name in self.declared
+
+    def referrers_of(self, type_name: str) -> Set[str]:
+        return self.referrers.get(type_name, set())
+
+    def _blame(self, schemas: List[dict]):
+        self.broken.update(schema["name"] for schema in schemas)
+
+    def check(self) -> Dict[str, List[str]]:
+        """Issues per check, in the ❌/⚠️ style of validate_generated_code()."""
+        return {name: check(self) for name, check in GRAPH_CHECKS}
+
+    def _check_dangling(self) -> List[str]:
+        issues = []
+        for type_name, users in sorted(self.referrers.items()):
+            if not self.resolves(type_name):
+                issues.append(f"❌ Unknown type '{type_name}' used by {', '.join(sorted(users))}")
+                for user in users:
+                    self._blame(self.declared[user])
+        for name in sorted(self.refs):
+            targets = {t for t, kind in self.refs[name] if kind == "reference"}
+            for target in sorted(targets):
+                if target in self.declared and self.declared[target][0]["type"] != "document":
+                    issues.append(
+                        f"⚠️  '{name}' references '{target}', which is not a document"
+                    )
+        return issues
+
+    def _check_duplicates(self) -> List[str]:
+        issues = []
+        for name, schemas in sorted(self.declared.items()):
+            if len(schemas) == 1 and name not in GRAPH_KNOWN_TYPES:
+                continue
+            files = ", ".join(schema_file_path(s["name"], s["type"]) for s in schemas)
+            if len(schemas) > 1:
+                issues.append(f"❌ Type '{name}' is declared {len(schemas)} times ({files})")
+            if name in GRAPH_KNOWN_TYPES:
+                issues.append(f"❌ {files} redeclares the built-in type '{name}'")
+            self._blame(schemas)
+        for schema, declared in self.misnamed:
+            file_path = schema_file_path(schema["name"], schema["type"])
+            if declared is None:
+                issues.append(f"❌ {file_path} does not declare a type name")
+                self._blame([schema])
+            else:
+                issues.append(
+                    f"⚠️  {file_path} declares '{declared}' instead of the planned '{schema['name']}'"
+                )
+        return issues
+
+    def _check_unused(self) -> List[str]:
+        # pageBuilder gaps are reported by _check_page_builder instead.
+        sections = set(page_builder_objects(self.plan)) if self.page_parsed else set()
+        return [
+            f"⚠️  Object '{name}' is not used by any other schema"
+            for name, schemas in sorted(self.declared.items())
+            if schemas[0]["type"] == "object"
+            and name not in sections
+            and name not in GRAPH_KNOWN_TYPES
+            and not self.referrers_of(name) - {name}
+        ]
+
+    def _check_cycles(self) -> List[str]:
+        # References are links between documents and may form cycles freely;
+        # inline embedding cannot.
+        graph = {
+            name: sorted({t for t, kind in refs if kind == "embed" and t in self.declared})
+            for name, refs in self.refs.items()
+        }
+        issues = []
+        for component in _strongly_connected(graph):
+            if len(component) > 1:
+                issues.append(f"⚠️  Embedding cycle: {', '.join(sorted(component))} embed each other")
+            elif component[0] in graph[component[0]]:
+                issues.append(f"⚠️  Embedding cycle: '{component[0]}' embeds itself")
+        return issues
+
+    def _check_page_builder(self) -> List[str]:
+        if not self.page_parsed:
+            return []
+        if self.page_builder is None:
+            return ["⚠️  'page' has no pageBuilder array"]
+        missing = [
+            name
+            for name in page_builder_objects(self.plan)
+            if name in self.declared
+            and name not in self.page_builder
+            and not self.referrers_of(name) - {"page", name}
+        ]
+        if missing:
+            return [f"⚠️  pageBuilder does not offer section(s): {', '.join(missing)}"]
+        return []
+
+
+GRAPH_CHECKS: List[Tuple[str, Callable[[SchemaGraph], List[str]]]] = [
+    ("dangling", SchemaGraph._check_dangling),
+    ("duplicates", SchemaGraph._check_duplicates),
+    ("unused", SchemaGraph._check_unused),
+    ("cycles", SchemaGraph._check_cycles),
+    ("page_builder", SchemaGraph._check_page_builder),
+]
+
+
+def validate_schema_graph(all_schemas: List[dict], plan: dict) -> tuple:
+    """
+    Checks the schema set as a whole (every file on its own has already been
+    validated) and logs what it finds. Returns the issues per check and the
+    names of the schemas behind the ❌ ones.
+    """
+    graph = SchemaGraph(all_schemas, plan)
+    issues = graph.check()
+    found = [issue for check_issues in issues.values() for issue in check_issues]
+    if found:
+        logging.warning(f"  ⚠️  Cross-schema issues in {len(graph.declared)} schema type(s):")
+        for issue in found:
+            logging.warning(f"     {issue}")
+    else:
+        logging.info(f"   ✅ All references between {len(graph.declared)} schema type(s) resolve.")
+    return issues, graph.broken
+
+
 def validate_sanity_config():
     """
     Checks if sanity.config.ts configuration matches the chosen i18n approach.
@@ -822,118 +4533,532 @@ def validate_sanity_config():
         logging.warning(f"⚠️  Could not validate sanity.config.ts: {e}")
 
 
-def generate_all_files(all_schemas: List[dict], plan: dict):
-    logging.info("\n--- 💾 PHASE 4: Generating All Project Files ---")
-    if os.path.exists(SCHEMAS_DIR):
-        shutil.rmtree(SCHEMAS_DIR)
+def schema_file_path(schema_name: str, schema_type: str) -> str:
+    folder = "documents" if schema_type == "document" else "objects"
+    return os.path.join(SCHEMAS_DIR, folder, f"{to_kebab_case(schema_name)}.ts")
+
+
+def schema_fingerprint(
+    schema_info: dict,
+    plan: dict,
+    section_index: Dict[str, dict],
+    model_name: str = GEMINI_MODEL_NAME,
+) -> dict:
+    """
+    Hashes everything that shapes a schema's phase-two output: its Figma
+    subtree, its plan context, the prompt version/encoding and the model
+    that answers it.
+    """
+
+    def digest(value: Any) -> str:
+        return hashlib.sha256(
+            json.dumps(value, sort_keys=True, default=str).encode()
+        ).hexdigest()[:16]
+
+    section_entry = section_index.get(schema_info["name"])
+    parts = {
+        "figma": digest(section_entry["structure"] if section_entry else None),
+        "plan": digest(
+            {
+                "type": schema_info["type"],
+                "documents": plan.get("documents", []),
+                "objects": plan.get("objects", []),
+            }
+        ),
+        "prompt": digest(
+            [PHASE_TWO_PROMPT_VERSION, model_name, PROMPT_STRUCTURE_FORMAT]
+            # Only IR runs add the format, so TypeScript fingerprints stay valid.
+            + (["ir"] if PHASE_TWO_OUTPUT_FORMAT == "ir" else [])
+        ),
+    }
+    return {**parts, "fingerprint": digest(parts)}
+
+
+def load_schema_manifest() -> Dict[str, dict]:
+    if not os.path.exists(SCHEMA_MANIFEST_PATH):
+        return {}
+    try:
+        with open(SCHEMA_MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f).get("schemas", {})
+    except (OSError, ValueError) as e:
+        logging.warning(f"⚠️  Ignoring unreadable schema manifest: {e}")
+        return {}
+
+
+def save_schema_manifest(entries: Dict[str, dict]):
+    tmp_path = f"{SCHEMA_MANIFEST_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"prompt_version": PHASE_TWO_PROMPT_VERSION, "schemas": entries},
+            f,
+            indent=2,
+            sort_keys=True,
+        )
+    os.replace(tmp_path, SCHEMA_MANIFEST_PATH)
+
+
+def load_existing_schema(
+    schema_info: dict, manifest: Dict[str, dict], fingerprint: Optional[str] = None
+) -> Optional[dict]:
+    """
+    Returns the schema as written by a previous run, if the manifest knows it,
+    its file still exists and (when given) its fingerprint matches.
+    """
+    entry = manifest.get(schema_info["name"])
+    if not entry or entry.get("type") != schema_info["type"]:
+        return None
+    if fingerprint is not None and entry.get("fingerprint") != fingerprint:
+        return None
+    file_path = schema_file_path(schema_info["name"], schema_info["type"])
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, "r", encoding="utf-8") as f:
+        code = f.read()
+    return {**schema_info, "code": code, "carried_over": True}
+
+
+def write_file_atomic(path: str, content: str):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def prepare_schema_dirs():
     # --- MODIFIED: Only generate business schema directories
     for folder in ["documents", "objects"]:
         os.makedirs(os.path.join(SCHEMAS_DIR, folder), exist_ok=True)
 
-    # --- DISABLED: i18n helper schema generation - using plugin approach instead
-    # The sanity-plugin-internationalized-array provides better internationalization
 
-    # 1. Write the AI-generated schemas
-    all_schema_names = []
-    for schema_data in all_schemas:
-        schema_name = schema_data["name"]
-        # --- MODIFIED: Simplified folder logic
-        folder = "documents" if schema_data["type"] == "document" else "objects"
-        file_name = f"{to_kebab_case(schema_name)}.ts"
-        file_path = os.path.join(SCHEMAS_DIR, folder, file_name)
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(schema_data["code"])
-        logging.info(f"   ✅ Wrote {folder.upper()[:-1]} SCHEMA: {folder}/{file_name}")
-        all_schema_names.append(schema_name)
-
-    # 3. Generate the main index.ts file
-    all_final_names = sorted(all_schema_names)
+def remove_stale_schema_files(all_schemas: List[dict]):
+    expected_paths = {
+        os.path.normpath(schema_file_path(s["name"], s["type"])) for s in all_schemas
+    }
+    for folder in ["documents", "objects"]:
+        for file_name in os.listdir(os.path.join(SCHEMAS_DIR, folder)):
+            file_path = os.path.normpath(os.path.join(SCHEMAS_DIR, folder, file_name))
+            if file_name.endswith(".ts") and file_path not in expected_paths:
+                os.remove(file_path)
+                logging.info(f"   🗑️  Removed stale schema: {folder}/{file_name}")
+    expected_ir_paths = {
+        os.path.normpath(schema_ir_path(s["name"], s["type"])) for s in all_schemas
+    }
+    for folder in ["documents", "objects"]:
+        ir_folder = os.path.join(SCHEMA_IR_DIR, folder)
+        for file_name in os.listdir(ir_folder) if os.path.isdir(ir_folder) else []:
+            file_path = os.path.normpath(os.path.join(ir_folder, file_name))
+            if file_name.endswith(".json") and file_path not in expected_ir_paths:
+                os.remove(file_path)
+
+
+def write_schema_file(schema_data: dict):
+    # --- MODIFIED: Simplified folder logic
+    folder = "documents" if schema_data["type"] == "document" else "objects"
+    file_name = f"{to_kebab_case(schema_data['name'])}.ts"
+    write_file_atomic(os.path.join(SCHEMAS_DIR, folder, file_name), schema_data["code"])
+    logging.info(f"   ✅ Wrote {folder.upper()[:-1]} SCHEMA: {folder}/{file_name}")
+
+
+def schema_ir_path(schema_name: str, schema_type: str) -> str:
+    folder = "documents" if schema_type == "document" else "objects"
+    return os.path.join(SCHEMA_IR_DIR, folder, f"{to_kebab_case(schema_name)}.json")
+
+
+def write_schema_ir_file(schema_data: dict):
+    path = schema_ir_path(schema_data["name"], schema_data["type"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file_atomic(path, json.dumps(schema_data["ir"], indent=2) + "\n")
+
+
+def write_schema_index(all_schemas: List[dict]):
+    schemas_by_name = {s["name"]: s for s in all_schemas}
+    all_final_names = sorted(schemas_by_name)
     imports = []
-    for name in sorted(all_schema_names):
-        schema_info = next((s for s in all_schemas if s["name"] == name), None)
+    for name in all_final_names:
         # --- MODIFIED: Simplified folder logic
-        folder = "documents" if schema_info["type"] == "document" else "objects"
+        folder = "documents" if schemas_by_name[name]["type"] == "document" else "objects"
         imports.append(f"import {name} from './{folder}/{to_kebab_case(name)}'")
-
-    index_content = f"// This file is auto-generated by the AI Schema Architect.\n{chr(10).join(imports)}\n\nexport const schemaTypes = [\n  {',\n  '.join(all_final_names)},\n];\n"
-    with open(os.path.join(SCHEMAS_DIR, "index.ts"), "w", encoding="utf-8") as f:
-        f.write(index_content)
+    import_block = "\n".join(imports)
+    names_block = ",\n  ".join(all_final_names)
+    index_content = f"// This file is auto-generated by the AI Schema Architect.\n{import_block}\n\nexport const schemaTypes = [\n  {names_block},\n];\n"
+    write_file_atomic(os.path.join(SCHEMAS_DIR, "index.ts"), index_content)
     logging.info(f"   ✅ Wrote main schema index file: {SCHEMAS_DIR}/index.ts")
 
 
+def generate_all_files(all_schemas: List[dict], plan: dict):
+    """
+    Brings SCHEMAS_DIR in line with all_schemas: writes new or regenerated
+    schemas, leaves carried-over files untouched, deletes files that are no
+    longer part of the plan and rewrites index.ts.
+    """
+    logging.info("\n--- 💾 PHASE 4: Generating All Project Files ---")
+    prepare_schema_dirs()
+    remove_stale_schema_files(all_schemas)
+
+    # --- DISABLED: i18n helper schema generation - using plugin approach instead
+    # The sanity-plugin-internationalized-array provides better internationalization
+
+    for schema_data in all_schemas:
+        if not schema_data.get("carried_over"):
+            write_schema_file(schema_data)
+    write_schema_index(all_schemas)
+
+
+class SchemaWriter:
+    """
+    Consumer side of the phase-two pipeline: corrects, validates and atomically
+    writes each schema as soon as its code arrives, and records it in the
+    manifest right away so an interrupted run keeps every finished schema.
+    Offline runs pass save_manifest=False and leave the manifest alone.
+    """
+
+    def __init__(
+        self,
+        all_valid_names: Set[str],
+        fingerprints: Dict[str, dict],
+        manifest_entries: Dict[str, dict],
+        save_manifest: bool = True,
+    ):
+        self.all_valid_names = all_valid_names
+        self.fingerprints = fingerprints
+        self.manifest_entries = manifest_entries
+        self.save_manifest = save_manifest
+        self.engine = CorrectionEngine(all_valid_names)
+        self.lock = threading.Lock()
+
+    def process(self, schema: dict) -> dict:
+        logging.info(f"  -> Correcting {schema['name']}...")
+        # --- MODIFIED: Using the new, more powerful correction function with expected type
+        with run_trace.span("correct", schema=schema["name"], code_bytes=len(schema["code"])):
+            corrected_code = correct_generated_code(
+                schema["code"], self.all_valid_names, schema["type"], self.engine
+            )
+        # Validate the corrected code for any remaining issues
+        with run_trace.span("validate", schema=schema["name"]) as span:
+            issues = validate_generated_code(corrected_code, schema["name"])
+            span["issues"] = len(issues)
+        finalized = {**schema, "code": corrected_code, "issues": issues}
+        with run_trace.span("write", schema=schema["name"], bytes=len(corrected_code)):
+            write_schema_file(finalized)
+            if "ir" in schema:
+                write_schema_ir_file(finalized)
+        with self.lock:
+            self.manifest_entries[schema["name"]] = {
+                "type": schema["type"],
+                "file": schema_file_path(schema["name"], schema["type"]),
+                **self.fingerprints[schema["name"]],
+            }
+            if self.save_manifest:
+                save_schema_manifest(self.manifest_entries)
+        return finalized
+
+    def finish(self, all_schemas: List[dict], plan: dict) -> Dict[str, List[str]]:
+        """
+        Checks references across all_schemas, removes stale files, writes
+        index.ts and prunes the manifest. Schemas with cross-schema errors
+        are pruned too, so the next run regenerates them instead of keeping
+        them as unchanged. Returns the cross-schema issues.
+        """
+        with run_trace.span("graph", schemas=len(all_schemas)) as span:
+            graph_issues, broken = validate_schema_graph(all_schemas, plan)
+            span["issues"] = sum(len(issues) for issues in graph_issues.values())
+        with run_trace.span("write_index", schemas=len(all_schemas)):
+            remove_stale_schema_files(all_schemas)
+            write_schema_index(all_schemas)
+        with self.lock:
+            names = {schema["name"] for schema in all_schemas} - broken
+            for name in list(self.manifest_entries):
+                if name not in names:
+                    del self.manifest_entries[name]
+            if self.save_manifest:
+                if broken:
+                    logging.warning(
+                        f"  🔁 Not recording {', '.join(sorted(broken))} in the manifest; "
+                        "the next run regenerates them."
+                    )
+                save_schema_manifest(self.manifest_entries)
+                logging.info(f"   ✅ Wrote schema manifest: {SCHEMA_MANIFEST_PATH}")
+        return graph_issues
+
+
+class RunJournal:
+    """
+    Append-only JSONL journal of a run: the plan and each raw phase-two result
+    are recorded as soon as they arrive, so --resume can replay them and only
+    issue the LLM calls that are still missing.
+    """
+
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self.path = os.path.join(RUNS_DIR, f"{run_id}.jsonl")
+        self.plan: Optional[dict] = None
+        self.schemas: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            self._replay()
+        os.makedirs(RUNS_DIR, exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def _replay(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue  # A torn final line from a killed process
+                if event.get("event") == "plan":
+                    self.plan = event["plan"]
+                    self.schemas = {}
+                elif event.get("event") == "schema":
+                    self.schemas[event["name"]] = {
+                        "name": event["name"],
+                        "type": event["type"],
+                        "code": event["code"],
+                    }
+                    if "ir" in event:
+                        self.schemas[event["name"]]["ir"] = event["ir"]
+
+    def _append(self, event: dict):
+        with self.lock:
+            self.file.write(json.dumps(event) + "\n")
+            self.file.flush()
+
+    def record_plan(self, plan: dict):
+        self.plan = plan
+        self._append({"event": "plan", "plan": plan})
+
+    def record_schema(self, schema: dict) -> dict:
+        self.schemas[schema["name"]] = schema
+        event = {
+            "event": "schema",
+            "name": schema["name"],
+            "type": schema["type"],
+            "code": schema["code"],
+        }
+        if "ir" in schema:
+            event["ir"] = schema["ir"]
+        self._append(event)
+        return schema
+
+    def close(self):
+        self._append({"event": "done"})
+        self.file.close()
+
+
 # --- 🚀 6. MAIN EXECUTION FLOW ---
 
 
 def main():
-    setup_logging()
+    global PROMPT_STRUCTURE_FORMAT, PHASE_TWO_OUTPUT_FORMAT, SCHEMAS_DIR, SCHEMA_IR_DIR
+    args = parse_args()
+    run_id = args.resume or datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    setup_logging(run_id)
     logging.info("🚀 AI Schema Architect (Improved) Initializing... 🚀")
-    if not all([FIGMA_API_KEY, FIGMA_FILE_KEY, GEMINI_API_KEY]):
-        logging.critical("❌ CONFIGURATION ERROR: Missing API keys in .env file.")
-        sys.exit(1)
-
-    genai.configure(api_key=GEMINI_API_KEY)
-    ai_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-
-    sections = get_figma_page_sections()
-    if not sections:
-        logging.critical("❌ No Figma sections found. Check page/frame names. Exiting.")
+    if args.structure_format:
+        PROMPT_STRUCTURE_FORMAT = args.structure_format
+    if args.phase_two_format:
+        PHASE_TWO_OUTPUT_FORMAT = args.phase_two_format
+    if args.measure_formats:
+        sections = get_figma_page_sections()
+        if sections:
+            measure_structure_formats(build_section_index(sections))
         return
-
-    plan = phase_one_architect_plan(sections, ai_model)
-    if not plan:
-        logging.critical(
-            "❌ Failed to generate architectural plan. Check logs for details. Exiting."
+    archive = None
+    if args.replay:
+        try:
+            archive = TrafficArchive.load(args.replay, args.replay_latency)
+        except (OSError, ValueError, KeyError) as e:
+            logging.critical(f"❌ Could not load replay archive '{args.replay}': {e}")
+            sys.exit(1)
+        backend = ReplayBackend(archive)
+        logging.info(
+            f"📼 Replaying {len(archive.calls)} recorded call(s) from {args.replay}"
+            f"{' with recorded latencies' if args.replay_latency else ''}."
         )
-        return
-
-    # --- MODIFIED: Simplified valid names set
-    all_valid_names = set(plan.get("documents", [])) | set(plan.get("objects", []))
-    logging.info(
-        f"📋 Plan created. Valid schema names: {sorted(list(all_valid_names))}"
+    else:
+        required_keys = [FIGMA_API_KEY, FIGMA_FILE_KEY]
+        if args.backend == "gemini" and not args.dry_run:
+            required_keys.append(GEMINI_API_KEY)
+        if not all(required_keys):
+            logging.critical("❌ CONFIGURATION ERROR: Missing API keys in .env file.")
+            sys.exit(1)
+        backend = create_backend(
+            args.backend, args.stub_latency, args.stub_failure_rate
+        )
+        if args.record:
+            archive = TrafficArchive()
+            backend = RecordingBackend(backend, archive)
+    logging.info(f"🧠 Model backend: {backend.model_name}")
+    scratch_dir = (
+        REPLAY_SCHEMAS_DIR
+        if args.replay
+        else STUB_SCHEMAS_DIR if args.backend == "stub" else None
     )
+    if scratch_dir:
+        SCHEMAS_DIR, SCHEMA_IR_DIR = scratch_dir, f"{scratch_dir}.ir"
+        args.full = True  # Offline runs regenerate everything so runs are comparable
+        logging.info(f"🧪 Offline run: writing to '{SCHEMAS_DIR}'; the schema manifest is not used.")
+    run_trace.start(os.path.join(RUNS_DIR, f"{run_id}.trace.jsonl"))
+    journal = None
+    try:
+        usage_ledger.set_backend(backend)
+        usage_ledger.set_budget(args.max_tokens, args.max_cost)
+        llm_cache = None if args.no_cache else LLMResponseCache(refresh=args.refresh)
 
-    all_schema_data = []
-    # --- MODIFIED: Simplified planned schemas list
-    all_planned_schemas = [
-        {"name": name, "type": "document"} for name in plan.get("documents", [])
-    ] + [{"name": name, "type": "object"} for name in plan.get("objects", [])]
+        sections = get_figma_page_sections(archive, replay=bool(args.replay))
+        if not sections:
+            logging.critical("❌ No Figma sections found. Check page/frame names. Exiting.")
+            return
+        with run_trace.span("extract", sections=len(sections)):
+            section_index = build_section_index(sections)
+        del sections  # The raw Figma nodes are not needed past this point
+
+        if args.dry_run:
+            estimate = estimate_run(section_index, args.concurrency, args.requests_per_minute)
+            log_dry_run_report(estimate, args.concurrency)
+            return
+
+        if args.resume and not os.path.exists(os.path.join(RUNS_DIR, f"{run_id}.jsonl")):
+            logging.critical(f"❌ No run journal found for '{run_id}'. Exiting.")
+            return
+        journal = RunJournal(run_id)
+        logging.info(f"📓 Run journal: {journal.path} (resume with --resume {run_id})")
+        if journal.plan:
+            plan = journal.plan
+            logging.info("♻️  PHASE 1: Reusing the plan recorded in the run journal.")
+        else:
+            with run_trace.span("plan"):
+                plan = phase_one_architect_plan(section_index, backend, llm_cache)
+            if not plan:
+                logging.critical(
+                    "❌ Failed to generate architectural plan. Check logs for details. Exiting."
+                )
+                return
+            journal.record_plan(plan)
 
-    for schema_info in all_planned_schemas:
-        ts_code = phase_two_generate_schema_code(
-            schema_info["name"], schema_info["type"], plan, sections, ai_model
+        # --- MODIFIED: Simplified valid names set
+        all_valid_names = set(plan.get("documents", [])) | set(plan.get("objects", []))
+        logging.info(
+            f"📋 Plan created. Valid schema names: {sorted(list(all_valid_names))}"
         )
-        if ts_code:
-            all_schema_data.append(
-                {
-                    "name": schema_info["name"],
-                    "type": schema_info["type"],
-                    "code": ts_code,
-                }
-            )
 
-    if not all_schema_data:
-        logging.critical("❌ No schemas were generated in Phase 2. Exiting.")
-        return
+        # --- MODIFIED: Simplified planned schemas list
+        all_planned_schemas = [
+            {"name": name, "type": "document"} for name in plan.get("documents", [])
+        ] + [{"name": name, "type": "object"} for name in plan.get("objects", [])]
 
-    logging.info("\n🔍 PHASE 3: Correcting and validating all generated code...")
-    corrected_schemas = []
-    for schema in all_schema_data:
-        logging.info(f"  -> Correcting {schema['name']}...")
-        # --- MODIFIED: Using the new, more powerful correction function with expected type
-        corrected_code = correct_generated_code(
-            schema["code"], all_valid_names, schema["type"]
+        manifest = {} if args.full else load_schema_manifest()
+        fingerprints = {
+            info["name"]: schema_fingerprint(info, plan, section_index, backend.model_name)
+            for info in all_planned_schemas
+        }
+        carried_schemas, pending_schemas = [], []
+        for info in all_planned_schemas:
+            existing = load_existing_schema(
+                info, manifest, fingerprints[info["name"]]["fingerprint"]
+            )
+            if existing:
+                carried_schemas.append(existing)
+            else:
+                pending_schemas.append(info)
+        logging.info(
+            f"♻️  {len(carried_schemas)} schema(s) unchanged since the last run; "
+            f"regenerating {len(pending_schemas)}."
         )
 
-        # Validate the corrected code for any remaining issues
-        issues = validate_generated_code(corrected_code, schema["name"])
+        logging.info(
+            "\n🔍 PHASE 2-4: Generating, correcting, validating and writing each schema as it arrives..."
+        )
+        prepare_schema_dirs()
+        writer = SchemaWriter(
+            all_valid_names,
+            fingerprints,
+            {schema["name"]: manifest[schema["name"]] for schema in carried_schemas},
+            save_manifest=not scratch_dir,
+        )
+        generated_schemas = []
+        remaining_schemas = []
+        for info in pending_schemas:
+            journaled = journal.schemas.get(info["name"])
+            if journaled and journaled["type"] == info["type"]:
+                logging.info(f"  ♻️  Replaying '{info['name']}' from the run journal.")
+                generated_schemas.append(writer.process(journaled))
+            else:
+                remaining_schemas.append(info)
+
+        def handle_schema(schema: dict) -> dict:
+            return writer.process(journal.record_schema(schema))
+
+        generated_schemas += generate_all_schema_code(
+            remaining_schemas,
+            plan,
+            section_index,
+            backend,
+            concurrency=args.concurrency,
+            requests_per_minute=args.requests_per_minute,
+            llm_cache=llm_cache,
+            on_result=handle_schema,
+        )
 
-        corrected_schemas.append({**schema, "code": corrected_code})
-    logging.info("✅ PHASE 3: Code correction complete.")
+        if not generated_schemas and not carried_schemas:
+            logging.critical("❌ No schemas were generated in Phase 2. Exiting.")
+            return
+        generated_names = {schema["name"] for schema in generated_schemas}
+        for info in pending_schemas:
+            if info["name"] in generated_names:
+                continue
+            previous = load_existing_schema(info, manifest)
+            if previous:
+                logging.warning(
+                    f"⚠️  Keeping the previous version of '{info['name']}' after a failed regeneration."
+                )
+                carried_schemas.append(previous)
+                writer.manifest_entries[info["name"]] = manifest[info["name"]]
 
-    generate_all_files(corrected_schemas, plan)
+        plan_order = {info["name"]: i for i, info in enumerate(all_planned_schemas)}
+        final_schemas = sorted(
+            generated_schemas + carried_schemas, key=lambda schema: plan_order[schema["name"]]
+        )
+        logging.info("\n--- 💾 PHASE 4: Finalizing schema index ---")
+        graph_issues = writer.finish(final_schemas, plan)
+        summary = {
+            "run_id": run_id,
+            "schemas": len(final_schemas),
+            "graph": graph_issues,
+            "trace": run_trace.log_summary(),
+            "usage": usage_ledger.log_summary(),
+        }
+        try:
+            write_file_atomic(
+                os.path.join(RUNS_DIR, f"{run_id}.summary.json"),
+                json.dumps(summary, indent=2),
+            )
+        except OSError as e:
+            logging.error(f"❌ Could not write run summary: {e}")
+        broken = [
+            issue for issues in graph_issues.values() for issue in issues if issue.startswith("❌")
+        ]
+        if broken:
+            logging.critical(
+                f"❌ {len(broken)} cross-schema error(s); Sanity Studio would fail to load "
+                f"'{SCHEMAS_DIR}'. Fix them before copying it into the project, or rerun "
+                "(with --refresh if the cached responses repeat them)."
+            )
+    finally:
+        if journal:
+            journal.close()
+        run_trace.close()
+        if args.record:
+            # Saved even when the run fails: that is the run worth replaying.
+            try:
+                archive.save(os.path.join(ARCHIVES_DIR, f"{run_id}.json.gz"))
+            except OSError as e:
+                logging.error(f"❌ Could not write traffic archive: {e}")
 
     # Validate sanity.config.ts
     validate_sanity_config()
+    if broken:
+        sys.exit(1)
 
     logging.info("\n✨ All Done! High-Quality, Validated Schemas Generated! ✨")
     print("\n--- NEXT STEPS ---")
@@ -0,0 +1,105 @@
+import json
+import random
+
+import pytest
+
+import generate_schemam as gs
+
+PAGE = "Page 1"
+FRAME = "Desktop"
+
+
+def _text(name, characters):
+    return {"id": f"t-{name}", "name": name, "type": "TEXT", "characters": characters}
+
+
+def _frame(name, children, node_type="FRAME"):
+    return {"id": f"f-{name}", "name": name, "type": node_type, "children": children}
+
+
+def make_document():
+    """A file whose target frame sits next to decoys that must be skipped."""
+    target = _frame(
+        FRAME,
+        [
+            _text("Title", 'Grüße — 日本 "quoted" \\ back\\slash {not} [json]'),
+            _frame("Cards", [_text(f"Card {i}", f"Body {i}\n\t ") for i in range(5)]),
+            {"name": "Meta", "type": "RECTANGLE", "visible": False, "opacity": 0.5, "fills": [], "effects": None},
+        ],
+    )
+    return {
+        "name": "File",
+        "version": "1",
+        "document": {
+            "id": "0:0",
+            "type": "DOCUMENT",
+            "children": [
+                {
+                    "id": "0:1",
+                    "name": "Other page",
+                    "type": "CANVAS",
+                    "children": [_frame(FRAME, [_text("Wrong", "decoy on another page")])],
+                },
+                {
+                    # Page name after its children: the frame is only a candidate
+                    # until the name arrives.
+                    "id": "0:2",
+                    "type": "CANVAS",
+                    "children": [
+                        _frame("Mobile", [_text("Wrong", "decoy frame")]),
+                        _frame(FRAME, [_text("Wrong", "decoy group")], node_type="GROUP"),
+                        target,
+                    ],
+                    "name": PAGE,
+                },
+            ],
+        },
+        "components": {"1:1": {"name": "Button", "description": "}]\"{["}},
+    }
+
+
+def extract(raw: bytes, chunk_sizes) -> dict:
+    extractor = gs.FigmaFrameStreamExtractor(PAGE, FRAME)
+    position = 0
+    for size in chunk_sizes:
+        if position >= len(raw) or extractor.feed(raw[position : position + size]):
+            break
+        position += size
+    if not extractor.done:
+        extractor.feed(b"", final=True)
+    return extractor.result
+
+
+def expected_frame(raw: bytes) -> dict:
+    return json.loads(raw)["document"]["children"][1]["children"][2]
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_one_byte_chunks(indent):
+    raw = json.dumps(make_document(), indent=indent, ensure_ascii=False).encode("utf-8")
+    assert extract(raw, [1] * len(raw)) == expected_frame(raw)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_chunks(seed):
+    rng = random.Random(seed)
+    raw = json.dumps(make_document(), indent=rng.choice([None, 1, 2]), ensure_ascii=rng.random() < 0.5).encode("utf-8")
+    sizes = [rng.randint(1, 64) for _ in range(len(raw))]
+    assert extract(raw, sizes) == expected_frame(raw)
+
+
+def test_whole_document():
+    raw = json.dumps(make_document()).encode("utf-8")
+    assert extract(raw, [len(raw)]) == expected_frame(raw)
+
+
+def test_matches_find_main_frame():
+    raw = json.dumps(make_document()).encode("utf-8")
+    assert extract(raw, [7] * len(raw)) == gs.find_main_frame(json.loads(raw)["document"])
+
+
+def test_missing_frame():
+    document = make_document()
+    document["document"]["children"][1]["children"].pop()
+    raw = json.dumps(document).encode("utf-8")
+    assert extract(raw, [3] * len(raw)) is None
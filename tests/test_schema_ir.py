@@ -0,0 +1,102 @@
+import json
+import random
+
+import pytest
+
+import generate_schemam as gs
+
+NAMES = {"page", "post", "heroBlock"}
+
+RAW_IR = {
+    "title": "Landing Page",
+    "fields": [
+        {"name": "Title", "type": "internationalizedArrayString"},
+        {"name": "slug", "type": "slug", "required": True},
+        {"name": "hero", "type": "heroblock"},
+        {"name": "summary", "type": "text", "i18n": True, "description": "Shown in cards"},
+        {"name": "author", "type": "reference", "to": ["Post", {"type": "page"}]},
+        {"name": "image", "type": "image", "fields": [{"name": "alt", "type": "string"}], "options": {"hotspot": True}},
+        {
+            "name": "sections",
+            "type": "array",
+            "of": [
+                "HeroBlock",
+                "string",
+                {"type": "reference", "to": ["post"]},
+                {"type": "object", "name": "quote", "fields": [{"name": "text", "type": "text"}]},
+            ],
+        },
+        {"name": "tags", "type": "array", "of": ["string"]},
+        {"name": "meta", "type": "object", "fields": [{"name": "noIndex", "type": "boolean"}], "options": {"data-x": [1, "a"]}},
+        {"name": "slug", "type": "string"},
+        "junk",
+    ],
+    "preview": {"title": "title", "subtitle": "summary.0", "media": "image", "extra": "x"},
+}
+
+
+def _normalize(raw):
+    return gs.normalize_schema_ir(raw, "page", "document", NAMES)
+
+
+def _shuffled(value, rng):
+    """The same JSON with every object's keys in a random order."""
+    if isinstance(value, dict):
+        keys = list(value)
+        rng.shuffle(keys)
+        return {key: _shuffled(value[key], rng) for key in keys}
+    if isinstance(value, list):
+        return [_shuffled(item, rng) for item in value]
+    return value
+
+
+def test_normalize_is_idempotent():
+    ir = _normalize(RAW_IR)
+    assert _normalize(ir) == ir
+    assert _normalize(json.loads(json.dumps(ir))) == ir
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_emit_ignores_key_order(seed):
+    """Equal IR gives byte-identical TypeScript, however the model ordered its keys."""
+    expected = gs.emit_schema_ts(_normalize(RAW_IR))
+    assert gs.emit_schema_ts(_normalize(_shuffled(RAW_IR, random.Random(seed)))) == expected
+
+
+def test_emitted_code_round_trips_through_the_parser():
+    code = gs.emit_schema_ts(_normalize(RAW_IR))
+    assert gs.print_schema_code(gs.parse_schema_code(code)) == code
+
+
+def test_emitted_code_needs_no_corrections():
+    code = gs.emit_schema_ts(_normalize(RAW_IR))
+    assert gs.CorrectionEngine(NAMES).correct(code, "document") == (code, [])
+    issues = gs.validate_generated_code(code, "page")
+    assert not [issue for issue in issues if issue.startswith("❌")]
+
+
+def test_emit_keeps_canonical_ir_details():
+    code = gs.emit_schema_ts(_normalize(RAW_IR))
+    assert "type: 'internationalizedArrayString'" in code
+    assert "{type: 'heroBlock'}" in code
+    assert "name: 'stringItem'" in code  # Primitive next to objects is wrapped
+    assert code.count("name: 'slug'") == 1  # Duplicate field dropped
+    assert "preview: {select: {title: 'title.0.value', subtitle: 'summary.0.value', media: 'image.asset'}}" in code
+
+
+@pytest.mark.parametrize(
+    "response",
+    [
+        json.dumps(RAW_IR),
+        f"```json\n{json.dumps(RAW_IR, indent=2)}\n```",
+    ],
+)
+def test_fenced_and_strict_responses_emit_the_same_schema(response):
+    info = {"name": "page", "type": "document"}
+    schema = gs.schema_from_ir_response(response, info, NAMES)
+    assert schema["ir"] == _normalize(RAW_IR)
+    assert schema["code"] == gs.emit_schema_ts(schema["ir"])
+
+
+def test_unusable_ir_is_rejected():
+    assert gs.schema_from_ir_response("[1, 2]", {"name": "page", "type": "document"}, NAMES) is None
@@ -0,0 +1,45 @@
+import json
+
+import generate_schemam as gs
+
+PLAN = {"documents": ["page"], "objects": ["heroBlock", "ctaBlock"]}
+
+
+def _schema(name, schema_type, fields):
+    code = (
+        "import {defineType, defineField} from 'sanity'\n\n"
+        f"export default defineType({{name: '{name}', title: 'T', type: '{schema_type}', fields: [{fields}]}})\n"
+    )
+    return {"name": name, "type": schema_type, "code": code}
+
+
+SCHEMAS = [
+    _schema("page", "document", "defineField({name: 'hero', type: 'heroBlock'}), defineField({name: 'cta', type: 'ctaBlock'})"),
+    _schema("heroBlock", "object", "defineField({name: 'link', type: 'missingType'})"),
+    _schema("ctaBlock", "object", "defineField({name: 'label', type: 'string'})"),
+]
+
+
+def test_graph_blames_the_schemas_behind_errors():
+    graph = gs.SchemaGraph(SCHEMAS + [_schema("ctaBlock", "object", "")], PLAN)
+    issues = graph.check()
+    assert any(issue.startswith("❌ Unknown type 'missingType'") for issue in issues["dangling"])
+    assert graph.broken == {"heroBlock", "ctaBlock"}
+
+
+def test_broken_schemas_are_left_out_of_the_manifest(tmp_path, monkeypatch):
+    """A plain rerun must regenerate them rather than keep them as unchanged."""
+    monkeypatch.chdir(tmp_path)
+    gs.prepare_schema_dirs()
+    fingerprints = {schema["name"]: {"fingerprint": schema["name"]} for schema in SCHEMAS}
+    writer = gs.SchemaWriter({"page", "heroBlock", "ctaBlock"}, fingerprints, {})
+    finalized = [writer.process(schema) for schema in SCHEMAS]
+    assert set(writer.manifest_entries) == {"page", "heroBlock", "ctaBlock"}
+
+    issues = writer.finish(finalized, PLAN)
+
+    assert issues["dangling"]
+    with open(gs.SCHEMA_MANIFEST_PATH, encoding="utf-8") as f:
+        saved = json.load(f)["schemas"]
+    assert set(saved) == {"page", "ctaBlock"}
+    assert gs.load_existing_schema({"name": "heroBlock", "type": "object"}, saved) is None
@@ -0,0 +1,142 @@
+import pytest
+
+import generate_schemam as gs
+
+KNOWN = {"heroBlock", "page", "post"}
+
+PRETTY = """import {defineField, defineType} from 'sanity'
+
+// Hero section shown at the top of landing pages
+export default defineType({
+  name: 'heroBlock',
+  title: 'Hero Block',
+  type: 'object',
+  fields: [
+    defineField({name: 'title', title: 'Title', type: 'internationalizedArrayString'}),
+    defineField({
+      name: 'image',
+      title: 'Image',
+      type: 'image',
+      options: {hotspot: true}, // crop on the focal point
+    }),
+    defineField({
+      name: 'links',
+      title: 'Links',
+      type: 'array',
+      of: [{type: 'reference', to: [{type: 'page'}, {type: 'post'}]}],
+      validation: (Rule) => Rule.max(3).regex(/^[a-z]+$/i),
+    }),
+  ],
+  preview: {
+    select: {title: 'title.0.value', media: 'image'},
+    prepare({title, media}) {
+      return {title: title || 'Untitled', media}
+    },
+  },
+})
+"""
+
+MESSY = """import {defineField, defineType} from 'sanity'
+export default defineType({ name: 'cta', title: "Call to action", type: 'object', fields: [defineField({name: 'label', title: 'Label', type: 'string', validation: (Rule) => Rule.required().max(40)}), defineField({name: 'url', type: 'url'})],
+  // trailing note
+})
+"""
+
+
+def _schema(fields, schema_type="object"):
+    return f"export default defineType({{name: 'a', type: '{schema_type}', fields: [{fields}]}})"
+
+
+def _reprint(code):
+    return gs.print_schema_code(gs.parse_schema_code(code))
+
+
+def _routes_to_tree(engine, code, expected_type):
+    fired = {}
+    state = {"first_type": True, "index": None, "mixable": "url" in code and "reference" in code}
+    engine._correct_text(code, expected_type, fired, state)
+    return engine._needs_tree(code, expected_type, fired, state)
+
+
+def test_printer_style_code_round_trips_unchanged():
+    """Comments, methods, arrow functions and regex literals survive as written."""
+    assert _reprint(PRETTY) == PRETTY
+
+
+@pytest.mark.parametrize("code", [PRETTY, MESSY])
+def test_print_is_a_fixed_point(code):
+    once = _reprint(code)
+    assert _reprint(once) == once
+    assert once.count("//") == code.count("//")
+
+
+@pytest.mark.parametrize("code", [PRETTY, MESSY])
+def test_parse_is_deterministic(code):
+    assert {_reprint(code) for _ in range(5)} == {_reprint(code)}
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "export default defineType({name: 'a', title: 'unterminated})",
+        "export default defineType({name: 'a', fields: [})",
+        "export default defineType({name: 'a'",
+    ],
+)
+def test_malformed_code_raises(code):
+    with pytest.raises(gs.TsParseError):
+        gs.parse_schema_code(code)
+
+
+@pytest.mark.parametrize(
+    "code, expected_type, expected",
+    [
+        (
+            _schema("defineField({name: 'x', type: 'array', of: [{type: 'page'}, {'POST'}]})"),
+            "object",
+            "of: [{type: 'page'}, {type: 'post'}]",
+        ),
+        (
+            "export default defineType({name: 'a', fields: [defineField({name: 'x', type: 'string'})], type: 'document'})",
+            "object",
+            "  type: 'object',\n})",
+        ),
+        (
+            _schema(
+                "defineField({name: 'x', type: 'array', of: [{type: 'page'}, "
+                "defineType({name: 'i', type: 'object', fields: []})]})"
+            ),
+            "object",
+            "of: [{type: 'page'}, {name: 'i', type: 'object', fields: []}]",
+        ),
+        (
+            _schema("defineField({name: 'x', of: [{type: 'block'}], type: 'internationalizedArrayText'})"),
+            "object",
+            "fields: [defineField({name: 'x', type: 'internationalizedArrayText'})]",
+        ),
+    ],
+)
+def test_structural_hazards_are_corrected_on_the_tree(code, expected_type, expected):
+    engine = gs.CorrectionEngine(KNOWN)
+    assert _routes_to_tree(engine, code, expected_type)
+    corrected, fixes = engine.correct(code, expected_type)
+    assert expected in corrected
+    assert fixes
+    assert _reprint(corrected) == corrected
+
+
+@pytest.mark.parametrize(
+    "code, expected_type",
+    [
+        (PRETTY, "object"),
+        (MESSY.replace("type: 'object'", "type: 'document'"), "object"),
+        (_schema("defineField({name: 'x', type: 'array', of: [{type: 'Page'}, {type: 'heroblock'}]})"), "object"),
+        (_schema("defineField({name: 'x', type: 'internationalizedArrayImage', fields: []})"), "object"),
+    ],
+)
+def test_text_corrections_match_the_tree(code, expected_type):
+    """Where the text rules suffice, they correct exactly what the tree would."""
+    engine = gs.CorrectionEngine(KNOWN)
+    assert not _routes_to_tree(engine, code, expected_type)
+    corrected, _ = engine.correct(code, expected_type)
+    assert _reprint(corrected) == engine._correct_tree(code, expected_type, {})